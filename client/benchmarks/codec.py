@@ -0,0 +1,162 @@
+#!/usr/bin/env python3
+"""
+Microbenchmark of the frame and datagram codecs.
+
+When a large fleet answers a broadcast, every frame goes through the adapter
+decoder, the Frame constructor and the datagram reassembly. The answers
+benchmark reproduces this with 127 nodes answering a CRC request.
+
+Frame level codecs are measured in frames per second, datagram level ones in
+2 kB write commands (one flash page) per second. The capture rows measure the
+encoding done by the background thread of the pcap and pcapng writers.
+
+Run it from the client directory with `python -m benchmarks.codec`.
+"""
+import argparse
+import io
+import os
+
+import msgpack
+
+from cvra_bootloader import utils
+from cvra_bootloader.can import *
+from cvra_bootloader.can import pcap, pcapng
+from cvra_bootloader.can.adapters import SocketCANConnection
+
+from .slcan import frames_per_second
+
+
+class ReplayConnection:
+    """
+    Connection returning the given frames, then timing out.
+    """
+
+    def __init__(self, frames):
+        self.frames = iter(frames)
+
+    def receive_frame(self):
+        return next(self.frames, None)
+
+
+class ReplaySocket:
+    """
+    Socket returning the same packet forever.
+    """
+
+    def __init__(self, packet):
+        self.packet = packet
+
+    def recvfrom(self, size):
+        return self.packet, None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument(
+        "--frames", type=int, default=10000, help="Number of frames per run"
+    )
+    parser.add_argument(
+        "--datagrams", type=int, default=100, help="Number of datagrams per run"
+    )
+    parser.add_argument(
+        "--nodes", type=int, default=127, help="Number of answering nodes (up to 127)"
+    )
+    args = parser.parse_args()
+
+    payloads = [os.urandom(8) for _ in range(args.frames)]
+    frames = [Frame(id=i & 0x7FF, data=p) for i, p in enumerate(payloads)]
+
+    # A 2 kB write command, as sent for every page
+    page = os.urandom(2048)
+    datagram = encode_datagram(page, [1])
+    page_frames = list(datagram_to_frames(datagram, 0))
+
+    # The CRC answers of a whole fleet, interleaved as they arrive on the bus
+    answers = [
+        list(datagram_to_frames(encode_datagram(msgpack.packb(0xCAFEBABE), [0]), id))
+        for id in range(1, args.nodes + 1)
+    ]
+    answer_frames = [f for frames in zip(*answers) for f in frames]
+
+    socketcan = SocketCANConnection.__new__(SocketCANConnection)
+    socketcan.socket = ReplaySocket(socketcan._pack_frame(frames[0]))
+
+    def build_frames():
+        for p in payloads:
+            Frame(id=0x42, data=p)
+
+    def encode():
+        for _ in range(args.datagrams):
+            list(datagram_to_frames(encode_datagram(page, [1]), 0))
+
+    def decode():
+        for _ in range(args.datagrams):
+            decode_datagram(datagram)
+
+    def reassemble():
+        for _ in range(args.datagrams):
+            reader = DatagramReader()
+            for f in page_frames:
+                reader.input_bytes(f.data)
+
+    def read_answers():
+        reader = utils.read_can_datagrams(ReplayConnection(answer_frames))
+        while next(reader) is not None:
+            pass
+
+    def socketcan_pack():
+        for f in frames:
+            socketcan._pack_frame(f)
+
+    def socketcan_unpack():
+        for _ in range(args.frames):
+            socketcan.receive_frame()
+
+    # Writers to memory, only used for their encoding
+    writers = [pcap.PcapWriter(io.BytesIO()), pcapng.PcapngWriter(io.BytesIO())]
+    timestamp = 1700000000 * 10**9
+
+    def capture(writer):
+        def encode():
+            for f in frames:
+                writer.encode(timestamp, f)
+
+        return encode
+
+    results = [
+        ("Frame", frames_per_second(build_frames, args.frames), "frames"),
+        ("encode", frames_per_second(encode, args.datagrams), "pages"),
+        ("decode", frames_per_second(decode, args.datagrams), "pages"),
+        ("reassemble", frames_per_second(reassemble, args.datagrams), "pages"),
+        (
+            "read answers",
+            frames_per_second(read_answers, len(answer_frames)),
+            "frames",
+        ),
+        ("socketcan pack", frames_per_second(socketcan_pack, args.frames), "frames"),
+        (
+            "socketcan unpack",
+            frames_per_second(socketcan_unpack, args.frames),
+            "frames",
+        ),
+        (
+            "pcap encode",
+            frames_per_second(capture(writers[0]), args.frames),
+            "frames",
+        ),
+        (
+            "pcapng encode",
+            frames_per_second(capture(writers[1]), args.frames),
+            "frames",
+        ),
+    ]
+
+    for writer in writers:
+        writer.close()
+
+    for name, rate, unit in results:
+        print("{:17} {:10.0f} {}/s".format(name, rate, unit))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,337 @@
+#!/usr/bin/env python3
+"""
+End-to-end benchmark of the flash tool against a simulated bus.
+
+For every combination of image size, node count, page size, bitrate and loss
+rate, a fresh fleet is scanned, its configs are read, then the image is
+flashed and verified. Each phase reports its duration in simulated time (what
+it would take on a real bus), the host time spent simulating it and the
+traffic it generated.
+
+Results are written as JSON, which can be given back to --compare to spot
+regressions between commits.
+
+Run it from the client directory with `python -m benchmarks.flash`.
+"""
+import argparse
+import contextlib
+import io
+import itertools
+import json
+import platform
+import random
+import subprocess
+import sys
+import time
+
+from cvra_bootloader import bootloader_flash, commands, utils
+from cvra_bootloader.can import is_start_of_datagram
+from cvra_bootloader.can.simulation import simulated_fleet
+
+BASE_ADDRESS = 0x1000
+DEVICE_CLASS = "CVRA.dummy.v1"
+
+
+class BenchmarkTimeout(Exception):
+    """
+    Raised when a phase exceeds its budget of simulated time.
+    """
+
+
+class InstrumentedConnection:
+    """
+    Wraps a simulated bus to count the traffic of each phase, and to abort
+    phases which run for more than budget seconds of simulated time.
+    """
+
+    def __init__(self, bus, budget):
+        self.bus = bus
+        self.budget = budget
+        self.reset()
+
+    def reset(self):
+        self.frames_sent = 0
+        self.frames_received = 0
+        self.datagrams_sent = 0
+        self.deadline = self.bus.time + self.budget
+
+    def send_frame(self, frame):
+        self.send_frames([frame])
+
+    def send_frames(self, frames):
+        for frame in frames:
+            self.frames_sent += 1
+            if is_start_of_datagram(frame):
+                self.datagrams_sent += 1
+            self.bus.send_frame(frame)
+
+    def receive_frame(self):
+        if self.bus.time > self.deadline:
+            raise BenchmarkTimeout
+
+        frame = self.bus.receive_frame()
+        if frame is not None:
+            self.frames_received += 1
+        return frame
+
+
+def scan(conn, ids):
+    """
+    Discovers the boards by broadcasting a ping, like bootloader_read_config.
+    """
+    dispatcher = utils.get_dispatcher(conn)
+    futures = dispatcher.send(commands.encode_ping(), list(range(1, 128)))
+
+    try:
+        dispatcher.wait(futures.values())
+        found = set(id for id, f in futures.items() if f.done())
+    finally:
+        dispatcher.cancel(futures.values())
+
+    return found == set(ids)
+
+
+def read_config(conn, ids):
+    configs = utils.write_command_retry(conn, commands.encode_read_config(), ids)
+    return len(configs) == len(ids)
+
+
+def flash(conn, binary, ids, page_size, pipeline):
+    if pipeline:
+        flashed = bootloader_flash.flash_binary_pipelined(
+            conn,
+            binary,
+            BASE_ADDRESS,
+            DEVICE_CLASS,
+            ids,
+            page_size=page_size,
+            clock=lambda: conn.bus.time,
+        )
+        return len(flashed) == len(ids)
+
+    bootloader_flash.flash_binary(
+        conn, binary, BASE_ADDRESS, DEVICE_CLASS, ids, page_size=page_size
+    )
+    return True
+
+
+def check(conn, binary, ids):
+    valid = bootloader_flash.check_binary(conn, binary, BASE_ADDRESS, ids)
+    return len(valid) == len(ids)
+
+
+def run_phase(conn, function, *args):
+    """
+    Runs a single phase and returns its measurements.
+    """
+    conn.reset()
+    start, host_start = conn.bus.time, time.perf_counter()
+
+    try:
+        ok = function(conn, *args)
+    except (BenchmarkTimeout, IOError, SystemExit):
+        ok = False
+
+    duration = conn.bus.time - start
+    frames = conn.frames_sent + conn.frames_received
+
+    return {
+        "ok": ok,
+        "time": duration,
+        "host_time": time.perf_counter() - host_start,
+        "frames_sent": conn.frames_sent,
+        "frames_received": conn.frames_received,
+        "datagrams_sent": conn.datagrams_sent,
+        "frames_per_second": frames / duration if duration else None,
+    }
+
+
+def run_case(size, nodes, page_size, bitrate, loss, pipeline, seed, budget):
+    """
+    Runs every phase on a fresh fleet and returns the results.
+    """
+    ids = list(range(1, nodes + 1))
+    bus = simulated_fleet(
+        ids,
+        bitrate=bitrate,
+        loss=loss,
+        seed=seed,
+        page_size=page_size,
+        app_size=max(size, 256 * 1024),
+    )
+    conn = InstrumentedConnection(bus, budget)
+
+    rng = random.Random(seed)
+    binary = rng.getrandbits(8 * size).to_bytes(size, "little")
+    pages = -(-size // page_size)
+
+    phases = dict()
+    with contextlib.redirect_stdout(io.StringIO()):
+        with contextlib.redirect_stderr(io.StringIO()):
+            phases["scan"] = run_phase(conn, scan, ids)
+            phases["read_config"] = run_phase(conn, read_config, ids)
+            phases["flash"] = run_phase(conn, flash, binary, ids, page_size, pipeline)
+            phases["check"] = run_phase(conn, check, binary, ids)
+
+    flash_time = phases["flash"]["time"]
+
+    return {
+        "parameters": {
+            "size": size,
+            "nodes": nodes,
+            "page_size": page_size,
+            "bitrate": bitrate,
+            "loss": loss,
+            "pipeline": pipeline,
+        },
+        "ok": all(p["ok"] for p in phases.values()),
+        "bytes_per_second": size / flash_time if flash_time else None,
+        "round_trips_per_page": phases["flash"]["datagrams_sent"] / pages,
+        "total_time": bus.time,
+        "bus_load": bus.stats["bus_busy_time"] / bus.time if bus.time else None,
+        "frames_lost": bus.stats["frames_lost"],
+        "phases": phases,
+    }
+
+
+def current_commit():
+    try:
+        output = subprocess.check_output(
+            ["git", "rev-parse", "--short", "HEAD"], stderr=subprocess.DEVNULL
+        )
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+    return output.decode().strip()
+
+
+def parameters_key(result):
+    return tuple(sorted(result["parameters"].items()))
+
+
+def compare(baseline, report, output):
+    """
+    Prints the throughput change of every case also present in the baseline.
+    """
+    previous = {parameters_key(r): r for r in baseline["results"]}
+
+    print("Compared to {}:".format(baseline.get("commit") or "baseline"), file=output)
+
+    for result in report["results"]:
+        old = previous.get(parameters_key(result))
+        if old is None or not old["bytes_per_second"]:
+            continue
+
+        new_rate = result["bytes_per_second"] or 0
+        change = 100 * (new_rate / old["bytes_per_second"] - 1)
+        description = " ".join(
+            "{}={}".format(k, v) for k, v in sorted(result["parameters"].items())
+        )
+        print(
+            "{:10.0f} -> {:10.0f} bytes/s ({:+6.1f}%) {}".format(
+                old["bytes_per_second"], new_rate, change, description
+            ),
+            file=output,
+        )
+
+
+def comma_separated(kind):
+    def parse(value):
+        return [kind(v) for v in value.split(",")]
+
+    return parse
+
+
+def parse_commandline_args(args=None):
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument(
+        "--sizes",
+        type=comma_separated(int),
+        default=[16 * 1024, 64 * 1024],
+        help="Image sizes in bytes (default: 16384,65536)",
+    )
+    parser.add_argument(
+        "--nodes",
+        type=comma_separated(int),
+        default=[1, 8],
+        help="Node counts (default: 1,8)",
+    )
+    parser.add_argument(
+        "--page-sizes",
+        type=comma_separated(int),
+        default=[2048],
+        help="Flash page sizes in bytes (default: 2048)",
+    )
+    parser.add_argument(
+        "--bitrates",
+        type=comma_separated(int),
+        default=[1000000],
+        help="Bus bitrates in bits/s (default: 1000000)",
+    )
+    parser.add_argument(
+        "--losses",
+        type=comma_separated(float),
+        default=[0.0],
+        help="Frame loss probabilities (default: 0)",
+    )
+    parser.add_argument(
+        "--pipeline", action="store_true", help="Use the pipelined scheduler"
+    )
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument(
+        "--budget",
+        type=float,
+        default=600,
+        help="Simulated seconds after which a phase is aborted (default: 600)",
+    )
+    parser.add_argument(
+        "-o", "--output", type=argparse.FileType("w"), default=sys.stdout
+    )
+    parser.add_argument(
+        "--compare",
+        type=argparse.FileType("r"),
+        metavar="BASELINE",
+        help="Previous JSON report to compare the throughput with",
+    )
+
+    return parser.parse_args(args)
+
+
+def main():
+    args = parse_commandline_args()
+
+    cases = itertools.product(
+        args.sizes, args.nodes, args.page_sizes, args.bitrates, args.losses
+    )
+
+    results = []
+    for size, nodes, page_size, bitrate, loss in cases:
+        results.append(
+            run_case(
+                size,
+                nodes,
+                page_size,
+                bitrate,
+                loss,
+                args.pipeline,
+                args.seed,
+                args.budget,
+            )
+        )
+
+    report = {
+        "commit": current_commit(),
+        "python": platform.python_version(),
+        "seed": args.seed,
+        "results": results,
+    }
+
+    json.dump(report, args.output, indent=4, sort_keys=True)
+    args.output.write("\n")
+
+    if args.compare:
+        compare(json.load(args.compare), report, sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
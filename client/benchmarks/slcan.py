@@ -0,0 +1,64 @@
+#!/usr/bin/env python3
+"""
+Microbenchmark of the slcan codec.
+
+A saturated 1 Mbit/s bus carries about 9000 frames per second, which the
+codec must be able to keep up with.
+
+Run it from the client directory with `python -m benchmarks.slcan`.
+"""
+import argparse
+import os
+import timeit
+
+from cvra_bootloader.can import Frame, slcan
+
+
+def frames_per_second(function, count, repeat=5):
+    """
+    Returns the best rate of the given function processing count frames.
+    """
+    best = min(timeit.repeat(function, number=1, repeat=repeat))
+    return count / best
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument(
+        "--frames", type=int, default=10000, help="Number of frames per run"
+    )
+    args = parser.parse_args()
+
+    frames = [
+        Frame(id=i & 0x7FF, data=os.urandom(8), extended=bool(i % 2))
+        for i in range(args.frames)
+    ]
+    messages = [slcan.encode_frame(f) for f in frames]
+    stream = b"\r".join(messages) + b"\r"
+
+    def encode():
+        for f in frames:
+            slcan.encode_frame(f)
+
+    def decode():
+        for m in messages:
+            slcan.decode_frame(m)
+
+    def decode_stream():
+        decoder = slcan.StreamDecoder()
+        # Data arrives in USB packet sized chunks
+        for i in range(0, len(stream), 64):
+            decoder.feed(stream[i : i + 64])
+
+    results = [
+        ("encode", frames_per_second(encode, args.frames)),
+        ("decode", frames_per_second(decode, args.frames)),
+        ("stream decode", frames_per_second(decode_stream, args.frames)),
+    ]
+
+    for name, rate in results:
+        print("{:15} {:10.0f} frames/s".format(name, rate))
+
+
+if __name__ == "__main__":
+    main()
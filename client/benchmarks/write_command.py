@@ -0,0 +1,70 @@
+#!/usr/bin/env python3
+"""
+Measures the flash throughput gained by driving command completion from the
+boards' answers instead of sleeping a fixed 100 ms after each command.
+
+Run it from the client directory with `python -m benchmarks.write_command`.
+"""
+import argparse
+import contextlib
+import io
+import os
+from unittest.mock import patch
+
+from cvra_bootloader import bootloader_flash, utils
+from cvra_bootloader.can.simulation import simulated_fleet
+
+write_command = utils.write_command
+
+
+def flash_throughput(binary, page_size, bitrate, legacy=False):
+    """
+    Flashes the binary on a simulated node and returns the throughput in
+    bytes per second of simulated time.
+
+    In legacy mode, each command is followed by a 100 ms sleep.
+    """
+    bus = simulated_fleet([1], bitrate=bitrate, page_size=page_size)
+
+    def legacy_write_command(*args, **kwargs):
+        write_command(*args, **kwargs)
+        bus.time += 0.1
+
+    with contextlib.ExitStack() as stack:
+        stack.enter_context(contextlib.redirect_stdout(io.StringIO()))
+        stack.enter_context(contextlib.redirect_stderr(io.StringIO()))
+        if legacy:
+            stack.enter_context(
+                patch("cvra_bootloader.utils.write_command", legacy_write_command)
+            )
+
+        bootloader_flash.flash_binary(
+            bus, binary, 0x1000, "CVRA.dummy.v1", [1], page_size=page_size
+        )
+
+    return len(binary) / bus.time
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument(
+        "--size", type=int, default=32 * 1024, help="Image size in bytes"
+    )
+    parser.add_argument("--page-size", type=int, default=2048)
+    parser.add_argument(
+        "--bitrate", type=int, default=1000000, help="Bus bitrate in bits/s"
+    )
+    args = parser.parse_args()
+
+    binary = os.urandom(args.size)
+
+    legacy = flash_throughput(binary, args.page_size, args.bitrate, legacy=True)
+    current = flash_throughput(binary, args.page_size, args.bitrate)
+
+    print("fixed 100 ms sleep: {:10.0f} bytes/s".format(legacy))
+    print("response driven:    {:10.0f} bytes/s".format(current))
+    print("speedup:            {:10.1f}x".format(current / legacy))
+
+
+if __name__ == "__main__":
+    main()
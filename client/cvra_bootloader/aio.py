@@ -0,0 +1,311 @@
+"""
+Asyncio version of the bootloader client.
+
+The coroutines mirror the blocking helpers of utils and bootloader_flash, but
+run on asynchronous connections (see cvra_bootloader.can.aio). Each connection
+gets a receive task which routes the answers to the requests waiting for
+them, so many commands, boards and buses can be driven concurrently from a
+single thread, for example:
+
+    conns = [open_socketcan_connection(i) for i in ("can0", "can1")]
+    await asyncio.gather(*(flash_binary(c, binary, ...) for c in conns))
+
+As connections do not time out by themselves, every coroutine waiting for an
+answer takes a timeout in seconds.
+"""
+import asyncio
+import logging
+from zlib import crc32
+
+import msgpack
+
+from cvra_bootloader import commands, page, utils
+import cvra_bootloader.can
+
+
+class Dispatcher(utils.AnswerRouter):
+    """
+    Receive loop of an asynchronous connection, running as a task started on
+    first use. See utils.AnswerRouter for how answers are routed.
+
+    If the connection fails, every outstanding request gets its error.
+    """
+
+    def __init__(self, conn, source=0):
+        super(Dispatcher, self).__init__(source)
+        self.conn = conn
+        self.task = None
+
+    def create_future(self):
+        return asyncio.get_running_loop().create_future()
+
+    def start(self):
+        if self.task is None:
+            self.task = asyncio.ensure_future(self._run())
+
+    async def _run(self):
+        demultiplexer = cvra_bootloader.can.DatagramDemultiplexer()
+
+        try:
+            while True:
+                frame = await self.conn.receive_frame()
+                datagram = demultiplexer.input_frame(frame)
+
+                if datagram is not None:
+                    self.route(*datagram)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logging.error("Receive loop failed: {}".format(e))
+
+            for future in self.futures.values():
+                if not future.done():
+                    future.set_exception(e)
+
+            self.futures.clear()
+            self.outstanding.clear()
+            self.task = None
+
+    async def send(self, command, destinations, answer_ids=None):
+        """
+        Sends a command and returns a dictionary mapping each destination to
+        the future of its answer. See utils.Dispatcher.send.
+        """
+        self.start()
+        futures = self.register(answer_ids or destinations)
+        await self.write(command, destinations)
+        return futures
+
+    async def write(self, command, destinations):
+        """
+        Sends a command without waiting for an answer.
+        """
+        await write_command(self.conn, command, destinations, self.source)
+
+    async def wait(self, futures, timeout=None):
+        """
+        Waits until all the given futures are done, for up to timeout seconds.
+
+        Returns False if the timeout expired first.
+        """
+        futures = list(futures)
+
+        if futures:
+            await asyncio.wait(futures, timeout=timeout)
+
+        return all(f.done() for f in futures)
+
+    def close(self):
+        """
+        Stops the receive loop.
+        """
+        if self.task is not None:
+            self.task.cancel()
+            self.task = None
+
+
+def get_dispatcher(conn, source=0):
+    """
+    Returns the dispatcher of the given connection, creating it on first use.
+    """
+    return utils.get_dispatcher(conn, source, dispatcher_class=Dispatcher)
+
+
+async def write_command(conn, command, destinations, source=0):
+    """
+    Writes the given encoded command to the bus, without waiting for the
+    boards to answer.
+    """
+    datagram = cvra_bootloader.can.encode_datagram(command, destinations)
+    frames = cvra_bootloader.can.datagram_to_frames(datagram, source)
+
+    await conn.send_frames(frames)
+
+
+async def ping_board(conn, destination, timeout=0.5):
+    """
+    Checks if a board is up.
+
+    Returns True if it answered within timeout seconds, false otherwise.
+    """
+    dispatcher = get_dispatcher(conn)
+    futures = await dispatcher.send(commands.encode_ping(), [destination])
+
+    try:
+        return await dispatcher.wait(futures.values(), timeout)
+    finally:
+        dispatcher.cancel(futures.values())
+
+
+async def check_online_boards(conn, boards, timeout=0.5):
+    """
+    Returns a set containing the boards which answered a ping within timeout
+    seconds.
+    """
+    dispatcher = get_dispatcher(conn)
+    futures = await dispatcher.send(commands.encode_ping(), boards)
+
+    try:
+        await dispatcher.wait(futures.values(), timeout)
+        return set(id for id, f in futures.items() if f.done())
+    finally:
+        dispatcher.cancel(futures.values())
+
+
+async def write_command_retry(
+    conn,
+    command,
+    destinations,
+    source=0,
+    retry_limit=3,
+    timeout=0.5,
+    answer_ids=None,
+):
+    """
+    Writes a command, retries the boards which did not answer within timeout
+    seconds and returns a dictionary mapping each board ID to its answer.
+
+    Raises IOError once a board exhausted its retries. See
+    utils.write_command_retry.
+    """
+    answer_ids = answer_ids or destinations
+    dispatcher = get_dispatcher(conn, source)
+    futures = await dispatcher.send(command, destinations, answer_ids)
+
+    retry_count = 0
+
+    try:
+        while not await dispatcher.wait(futures.values(), timeout):
+            if retry_count == retry_limit:
+                logging.critical("No answer, aborting...")
+                raise IOError
+
+            timedout_boards = [
+                dst
+                for dst, id in zip(destinations, answer_ids)
+                if not futures[id].done()
+            ]
+            await dispatcher.write(command, timedout_boards)
+            msg = "The following boards did not answer: {}, retrying..".format(
+                " ".join(str(t) for t in timedout_boards)
+            )
+
+            logging.warning(msg)
+            retry_count += 1
+    finally:
+        dispatcher.cancel(futures.values())
+
+    return {id: f.result() for id, f in futures.items()}
+
+
+async def read_config(conn, destinations, timeout=0.5):
+    """
+    Returns a dictionary mapping each destination to its decoded config.
+    """
+    configs = await write_command_retry(
+        conn, commands.encode_read_config(), destinations, timeout=timeout
+    )
+
+    return {id: msgpack.unpackb(c, raw=False) for id, c in configs.items()}
+
+
+async def config_update_and_save(conn, config, destinations, timeout=0.5):
+    """
+    Updates the config of the given destinations, then saves it to flash.
+    Keys not in the given config are left unchanged.
+    """
+    command = commands.encode_update_config(config)
+    await write_command_retry(conn, command, destinations, timeout=timeout)
+
+    command = commands.encode_save_config()
+    await write_command_retry(conn, command, destinations, timeout=timeout)
+
+
+def _failed_boards(answers):
+    return [id for id, success in answers.items() if not msgpack.unpackb(success)]
+
+
+async def flash_binary(
+    conn,
+    binary,
+    base_address,
+    device_class,
+    destinations,
+    page_size=2048,
+    timeout=0.5,
+    erase_timeout=None,
+    compress=False,
+):
+    """
+    Writes a full binary to the flash of the given destinations, then updates
+    the application CRC and size in their config.
+
+    Like bootloader_flash.flash_binary, every page is erased then every page
+    is written, each command being multicast to all destinations. Erased
+    spans of the binary are not written (see page.written_spans). Erasing
+    large pages can take seconds, so erase_timeout (default: timeout) can be
+    given separately. If compress is true, the data is sent compressed when it
+    makes the commands shorter (see commands.encode_page_writes).
+
+    Raises IOError if a board does not answer or fails.
+    """
+    erase_timeout = erase_timeout or timeout
+
+    for offset in range(0, len(binary), page_size):
+        command = commands.encode_erase_flash_page(base_address + offset, device_class)
+        answers = await write_command_retry(
+            conn, command, destinations, timeout=erase_timeout
+        )
+
+        failed = _failed_boards(answers)
+        if failed:
+            raise IOError("Boards {} failed during page erase".format(failed))
+
+    for offset, chunk in enumerate(page.slice_into_pages(binary, page_size)):
+        for span_offset, span in page.written_spans(chunk):
+            address = base_address + offset * page_size + span_offset
+            for command in commands.encode_page_writes(
+                span, address, device_class, compress
+            ):
+                answers = await write_command_retry(
+                    conn, command, destinations, timeout=timeout
+                )
+
+                failed = _failed_boards(answers)
+                if failed:
+                    raise IOError("Boards {} failed during page write".format(failed))
+
+    config = {"application_size": len(binary), "application_crc": crc32(binary)}
+    await config_update_and_save(conn, config, destinations, timeout=timeout)
+
+
+async def check_binary(conn, binary, base_address, destinations, timeout=None):
+    """
+    Checks that the binary was correctly written to all destinations.
+
+    Returns the list of boards passing the test. Computing the CRC of a large
+    binary takes time, so by default there is no timeout.
+    """
+    command = commands.encode_crc_region(base_address, len(binary))
+    dispatcher = get_dispatcher(conn)
+    futures = await dispatcher.send(command, destinations)
+
+    try:
+        await dispatcher.wait(futures.values(), timeout)
+    finally:
+        dispatcher.cancel(futures.values())
+
+    expected_crc = crc32(binary)
+
+    return [
+        id
+        for id, f in futures.items()
+        if not f.cancelled() and msgpack.unpackb(f.result()) == expected_crc
+    ]
+
+
+async def run_application(conn, destinations):
+    """
+    Asks the given nodes to run the application. The boards do not answer.
+    """
+    await write_command(conn, commands.encode_jump_to_main(), destinations)
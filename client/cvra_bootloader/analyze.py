@@ -0,0 +1,441 @@
+#!/usr/bin/env python3
+"""
+Analyze bootloader sessions recorded with --pcap.
+
+Datagrams are reassembled per source, the host commands are paired with the
+answers of each board, and the tool reports the round trip latency of each
+command and board, the retries, the bus load over time and how the session
+time was spent.
+
+Captures are streamed frame by frame, so memory usage does not depend on
+their size.
+"""
+import argparse
+import json
+import math
+from zlib import crc32
+
+import msgpack
+
+from cvra_bootloader import commands
+from cvra_bootloader.can import *
+from cvra_bootloader.can.pcap import read_capture
+
+COMMAND_NAMES = {
+    commands.CommandType.JumpToMain: "jump",
+    commands.CommandType.CRCReginon: "crc",
+    commands.CommandType.Erase: "erase",
+    commands.CommandType.Write: "write",
+    commands.CommandType.Ping: "ping",
+    commands.CommandType.Read: "read",
+    commands.CommandType.UpdateConfig: "update_config",
+    commands.CommandType.SaveConfig: "save_config",
+    commands.CommandType.ReadConfig: "read_config",
+    commands.CommandType.WriteCompressed: "write_compressed",
+}
+
+# Frame overhead (arbitration, control, CRC, ack, EOF and interframe space)
+# and approximate bit stuffing ratio, used to estimate the bus load
+FRAME_OVERHEAD_BITS = 47
+BIT_STUFFING = 1.2
+
+
+def command_name(data):
+    """
+    Returns the name of the encoded command, or None if it cannot be decoded.
+    """
+    unpacker = msgpack.Unpacker(raw=False)
+    unpacker.feed(data)
+
+    try:
+        version, index = next(unpacker), next(unpacker)
+    except (StopIteration, ValueError):
+        return None
+
+    if version != commands.COMMAND_SET_VERSION:
+        return None
+
+    return COMMAND_NAMES.get(index, "unknown")
+
+
+class LatencyHistogram:
+    """
+    Histogram of latencies in seconds with logarithmic buckets, so that it
+    uses constant memory. Each bucket is about 9% wider than the previous one.
+    """
+
+    BUCKETS_PER_OCTAVE = 8
+
+    def __init__(self):
+        self.buckets = dict()
+        self.count = 0
+        self.total = 0.0
+        self.min = None
+        self.max = None
+
+    def add(self, latency):
+        bucket = math.ceil(self.BUCKETS_PER_OCTAVE * math.log2(max(latency * 1e6, 1)))
+        self.buckets[bucket] = self.buckets.get(bucket, 0) + 1
+
+        self.count += 1
+        self.total += latency
+        self.min = latency if self.min is None else min(self.min, latency)
+        self.max = latency if self.max is None else max(self.max, latency)
+
+    def upper_bound(self, bucket):
+        return 2 ** (bucket / self.BUCKETS_PER_OCTAVE) * 1e-6
+
+    def percentile(self, p):
+        """
+        Returns an upper bound of the given percentile.
+        """
+        seen = 0
+        for bucket in sorted(self.buckets):
+            seen += self.buckets[bucket]
+            if seen >= p / 100 * self.count:
+                return min(self.upper_bound(bucket), self.max)
+
+    def summary(self):
+        if not self.count:
+            return None
+
+        return {
+            "count": self.count,
+            "min": self.min,
+            "mean": self.total / self.count,
+            "p50": self.percentile(50),
+            "p90": self.percentile(90),
+            "p99": self.percentile(99),
+            "max": self.max,
+            # Upper bound of each bucket in seconds, and its count
+            "histogram": [
+                [self.upper_bound(b), self.buckets[b]] for b in sorted(self.buckets)
+            ],
+        }
+
+
+class Statistics:
+    """
+    Counters of a command or of a board.
+    """
+
+    def __init__(self):
+        self.requests = 0
+        self.retries = 0
+        self.unanswered = 0
+        self.errors = 0
+        self.latency = LatencyHistogram()
+
+    def summary(self):
+        return {
+            "requests": self.requests,
+            "retries": self.retries,
+            "unanswered": self.unanswered,
+            "errors": self.errors,
+            "latency": self.latency.summary(),
+        }
+
+
+class SessionAnalyzer:
+    """
+    Incrementally analyzes the frames of a capture.
+
+    A request sent to a board is pending until the board answers. Sending the
+    same request again before the answer counts as a retry, sending another
+    one means the previous one was left unanswered.
+
+    The session time is attributed to the last command sent while its
+    destinations are answering, up to timeout seconds, and to idle otherwise.
+    """
+
+    def __init__(self, host=0, bitrate=1000000, interval=1.0, timeout=5.0):
+        self.host = host
+        self.bitrate = bitrate
+        self.interval = interval
+        self.timeout = timeout
+
+        self.start = None
+        self.last = None
+        self.frames = 0
+        self.datagrams = 0
+        self.invalid_datagrams = 0
+        self.unmatched_answers = 0
+
+        # Reassembles the datagrams like the client does
+        self.demultiplexer = DatagramDemultiplexer()
+        # Board ID -> (command name, crc of the request, time)
+        self.pending = dict()
+        # (command name, deadline, boards which did not answer yet)
+        self.waiting = None
+
+        self.commands = dict()
+        self.nodes = dict()
+        self.time_spent = dict()
+        self.bus_busy = []
+
+    def input_frame(self, frame):
+        t = frame.timestamp / 1e9
+
+        if self.start is None:
+            self.start = self.last = t
+
+        self._account_time(t)
+        self._account_bus_load(t, frame)
+        self.frames += 1
+
+        try:
+            datagram = self.demultiplexer.input_frame(frame)
+        except (VersionMismatchError, CRCMismatchError):
+            self.invalid_datagrams += 1
+            return
+
+        if datagram is not None:
+            data, dst, src = datagram
+            self.datagrams += 1
+            self._input_datagram(t, data, dst, src)
+
+    def _account_time(self, t):
+        elapsed = max(t - self.last, 0)
+        self.last = max(t, self.last)
+
+        if self.waiting:
+            name, deadline, _ = self.waiting
+            busy = min(elapsed, max(deadline - (self.last - elapsed), 0))
+            self.time_spent[name] = self.time_spent.get(name, 0) + busy
+            elapsed -= busy
+
+            if self.last >= deadline:
+                self.waiting = None
+
+        self.time_spent["idle"] = self.time_spent.get("idle", 0) + elapsed
+
+    def _account_bus_load(self, t, frame):
+        index = max(int((t - self.start) / self.interval), 0)
+        if index >= len(self.bus_busy):
+            self.bus_busy += [0.0] * (index + 1 - len(self.bus_busy))
+
+        bits = FRAME_OVERHEAD_BITS + 8 * frame.data_length
+        self.bus_busy[index] += bits * BIT_STUFFING / self.bitrate
+
+    def _stats(self, table, key):
+        if key not in table:
+            table[key] = Statistics()
+        return table[key]
+
+    def _input_datagram(self, t, data, dst, src):
+        if src == self.host:
+            self._input_request(t, data, dst)
+        elif self.host in dst:
+            self._input_answer(t, data, src)
+
+    def _input_request(self, t, data, dst):
+        name = command_name(data)
+        if name is None:
+            self.invalid_datagrams += 1
+            return
+
+        stats = self._stats(self.commands, name)
+        request_crc = crc32(data)
+        retry = False
+
+        for node in dst:
+            node_stats = self._stats(self.nodes, node)
+            previous = self.pending.get(node)
+
+            if previous and previous[:2] == (name, request_crc):
+                retry = True
+                node_stats.retries += 1
+                continue
+
+            node_stats.requests += 1
+
+            if previous:
+                self._stats(self.commands, previous[0]).unanswered += 1
+                node_stats.unanswered += 1
+
+        # Retried requests are timed from their last transmission
+        for node in dst:
+            self.pending[node] = (name, request_crc, t)
+
+        if retry:
+            stats.retries += 1
+        else:
+            stats.requests += 1
+
+        self.waiting = (name, t + self.timeout, set(dst))
+
+    def _input_answer(self, t, data, src):
+        request = self.pending.pop(src, None)
+        if request is None:
+            self.unmatched_answers += 1
+            return
+
+        name, _, sent = request
+        stats = self._stats(self.commands, name)
+        node_stats = self._stats(self.nodes, src)
+
+        stats.latency.add(t - sent)
+        node_stats.latency.add(t - sent)
+
+        try:
+            answer = msgpack.unpackb(data, raw=False)
+        except ValueError:
+            answer = None
+
+        # Flash commands answer False on failure
+        if answer is False:
+            stats.errors += 1
+            node_stats.errors += 1
+
+        if self.waiting and src in self.waiting[2]:
+            self.waiting[2].discard(src)
+            if not self.waiting[2]:
+                self.waiting = None
+
+    def report(self):
+        """
+        Returns the results as a dictionary which can be dumped to JSON.
+        """
+        commands = {name: s.summary() for name, s in self.commands.items()}
+        nodes = {node: s.summary() for node, s in self.nodes.items()}
+
+        # Requests still pending at the end of the capture were not answered
+        for node, (name, _, _) in self.pending.items():
+            commands[name]["unanswered"] += 1
+            nodes[node]["unanswered"] += 1
+
+        return {
+            "duration": self.last - self.start if self.frames else 0,
+            "frames": self.frames,
+            "datagrams": self.datagrams,
+            "invalid_datagrams": self.invalid_datagrams,
+            "unmatched_answers": self.unmatched_answers,
+            "commands": commands,
+            "nodes": nodes,
+            "time_spent": self.time_spent,
+            "bus_load_interval": self.interval,
+            "bus_load": [busy / self.interval for busy in self.bus_busy],
+        }
+
+
+def format_latency(latency):
+    if latency is None:
+        return "-"
+
+    return "{:8.2f} {:8.2f} {:8.2f} {:8.2f}".format(
+        1e3 * latency["p50"],
+        1e3 * latency["p90"],
+        1e3 * latency["p99"],
+        1e3 * latency["max"],
+    )
+
+
+def format_report(report):
+    """
+    Formats the results for humans.
+    """
+    lines = [
+        "Duration: {:.3f} s, {} frames, {} datagrams".format(
+            report["duration"], report["frames"], report["datagrams"]
+        ),
+        "",
+        "{:15} {:>8} {:>8} {:>8} {:>8}   latency (ms) p50, p90, p99, max".format(
+            "command", "requests", "retries", "lost", "errors"
+        ),
+    ]
+
+    for title, table in [("", report["commands"]), ("node ", report["nodes"])]:
+        for key, s in sorted(table.items()):
+            lines.append(
+                "{:15} {:8} {:8} {:8} {:8}   {}".format(
+                    title + str(key),
+                    s["requests"],
+                    s["retries"],
+                    s["unanswered"],
+                    s["errors"],
+                    format_latency(s["latency"]),
+                )
+            )
+        lines.append("")
+
+    lines.append("Time spent:")
+    duration = report["duration"] or 1
+    for name, t in sorted(report["time_spent"].items(), key=lambda i: -i[1]):
+        lines.append("{:15} {:10.3f} s {:6.1f}%".format(name, t, 100 * t / duration))
+
+    lines.append("")
+    loads = report["bus_load"]
+    if loads:
+        lines.append(
+            "Bus load: mean {:.1f}%, peak {:.1f}% (per {} s)".format(
+                100 * sum(loads) / len(loads),
+                100 * max(loads),
+                report["bus_load_interval"],
+            )
+        )
+
+    return "\n".join(lines)
+
+
+def parse_commandline_args(args=None):
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument(
+        "captures",
+        metavar="FILE",
+        nargs="+",
+        help="pcap or pcapng captures, analyzed in the given order as a single "
+        "session (e.g. rotated files)",
+    )
+    parser.add_argument(
+        "--host-id",
+        type=int,
+        default=0,
+        help="Source ID used by the host (default 0)",
+    )
+    parser.add_argument(
+        "--bitrate",
+        type=int,
+        default=1000000,
+        help="Bus bitrate in bits/s, used to compute the bus load (default 1000000)",
+    )
+    parser.add_argument(
+        "--interval",
+        type=float,
+        default=1.0,
+        help="Duration over which the bus load is averaged, in seconds (default 1)",
+    )
+    parser.add_argument(
+        "--timeout",
+        type=float,
+        default=5.0,
+        help="Time after which a command is considered unanswered (default 5)",
+    )
+    parser.add_argument("--json", action="store_true", help="Print the results as JSON")
+
+    return parser.parse_args(args)
+
+
+def main():
+    args = parse_commandline_args()
+    analyzer = SessionAnalyzer(
+        host=args.host_id,
+        bitrate=args.bitrate,
+        interval=args.interval,
+        timeout=args.timeout,
+    )
+
+    for path in args.captures:
+        with open(path, "rb") as f:
+            for frame in read_capture(f):
+                analyzer.input_frame(frame)
+
+    report = analyzer.report()
+
+    if args.json:
+        print(json.dumps(report, indent=4, sort_keys=True))
+    else:
+        print(format_report(report))
+
+
+if __name__ == "__main__":
+    main()
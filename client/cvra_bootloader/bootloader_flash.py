@@ -3,13 +3,17 @@
 Update firmware using CVRA bootloading protocol.
 """
 import logging
-from cvra_bootloader import page, commands, utils
+from cvra_bootloader import page, commands, utils, scheduler, manifest, firmware
+from cvra_bootloader import journal as flash_journal
 import msgpack
 from zlib import crc32
 from sys import exit
 
+import os
 import progressbar
 import sys
+import threading
+import time
 
 
 def parse_commandline_args(args=None):
@@ -22,8 +26,8 @@ def parse_commandline_args(args=None):
         "-b",
         "--binary",
         dest="binary_file",
-        help="Path to the binary file to upload",
-        required=True,
+        help="Path to the firmware to upload: a raw binary, an ELF file or an "
+        "Intel HEX file (.hex)",
         metavar="FILE",
     )
 
@@ -31,9 +35,8 @@ def parse_commandline_args(args=None):
         "-a",
         "--base-address",
         dest="base_address",
-        help="Base address of the firmware",
+        help="Base address of the firmware, required for raw binaries only",
         metavar="ADDRESS",
-        required=True,
         # automatically convert value to hex
         type=lambda s: int(s, 16),
     )
@@ -43,7 +46,13 @@ def parse_commandline_args(args=None):
         "--device-class",
         dest="device_class",
         help="Device class to flash",
-        required=True,
+    )
+    parser.add_argument(
+        "-m",
+        "--manifest",
+        help="JSON manifest giving the image of each board, instead of "
+        "--binary, --base-address and --device-class",
+        metavar="FILE",
     )
     parser.add_argument(
         "-r", "--run", help="Run application after flashing", action="store_true"
@@ -52,31 +61,296 @@ def parse_commandline_args(args=None):
         "--page-size", type=int, default=2048, help="Page size in bytes (default 2048)"
     )
     parser.add_argument(
-        "ids", metavar="DEVICEID", nargs="+", type=int, help="Device IDs to flash"
+        "--differential",
+        help="Only erase and write the pages which differ from the boards' flash",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--pipeline",
+        help="Track each board separately, so that boards which fail or lag "
+        "behind are retried or quarantined without holding back the others. "
+        "This is not faster when all boards keep up",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--window",
+        type=int,
+        default=1,
+        help="Maximum number of commands in flight per board when pipelining, "
+        "more than 1 requires a bootloader able to queue commands (default 1)",
+    )
+    parser.add_argument(
+        "--compress",
+        help="Send the firmware compressed, requires a bootloader supporting "
+        "compressed writes",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--repair",
+        help="If verification fails, find the pages which differ and only "
+        "reflash those",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--journal",
+        help="File recording the progress of the flash, so that it can be "
+        "resumed with --resume if interrupted. With --bus, each bus gets its own",
+        metavar="FILE",
+    )
+    parser.add_argument(
+        "--resume",
+        help="Continue an interrupted flash from the progress recorded in the "
+        "journal given with --journal, after checking it against the boards",
+        action="store_true",
+    )
+    parser.add_argument(
+        "ids",
+        metavar="DEVICEID",
+        nargs="*",
+        type=int,
+        help="Device IDs to flash (with --bus, they are given per bus instead). "
+        "With --manifest, restricts the flash to those boards",
     )
 
-    return parser.parse_args(args)
+    args = parser.parse_args(args)
 
+    image_args = (args.binary_file, args.base_address, args.device_class)
 
-def flash_binary(
-    fdesc, binary, base_address, device_class, destinations, page_size=2048
+    if args.manifest and any(a is not None for a in image_args):
+        parser.error("--manifest cannot be used with -b, -a or -c")
+
+    if not args.manifest and (args.binary_file is None or args.device_class is None):
+        parser.error("-b and -c are required unless using --manifest")
+
+    if args.resume and args.journal is None:
+        parser.error("--resume requires --journal")
+
+    if args.buses and args.ids:
+        parser.error("Device IDs must be given per bus when using --bus")
+
+    if not args.buses and not args.ids and not args.manifest:
+        parser.error("No device IDs given")
+
+    return args
+
+
+def read_page_crcs(fdesc, base_address, length, destinations, page_size=2048):
+    """
+    Asks every destination for the CRC of each page of the given flash region.
+
+    Returns a dictionary mapping each board ID to the list of its page CRCs.
+    """
+    crcs = {id: [] for id in destinations}
+
+    for offset in range(0, length, page_size):
+        size = min(page_size, length - offset)
+        command = commands.encode_crc_region(base_address + offset, size)
+        res = utils.write_command_retry(fdesc, command, destinations)
+
+        for id, crc in res.items():
+            crcs[id].append(msgpack.unpackb(crc))
+
+    return crcs
+
+
+def find_dirty_pages(fdesc, binary, base_address, destinations, page_size=2048):
+    """
+    Compares the CRC of each page of the binary with the one currently in the
+    flash of every destination.
+
+    Returns a dictionary mapping the offset of each page which differs on at
+    least one board to the list of boards needing it.
+    """
+    expected = page.page_crcs(binary, page_size)
+    actual = read_page_crcs(fdesc, base_address, len(binary), destinations, page_size)
+
+    dirty_pages = dict()
+    for index, crc in enumerate(expected):
+        boards = [id for id in destinations if actual[id][index : index + 1] != [crc]]
+        if boards:
+            dirty_pages[index * page_size] = boards
+
+    return dirty_pages
+
+
+def find_sparse_pages(fdesc, binary, base_address, destinations, page_size, spans):
+    """
+    Returns the pages to flash for a sparse firmware, in the same format as
+    find_dirty_pages.
+
+    The pages holding data (see firmware.data_pages) are flashed on every
+    board. The gaps between them are covered by the application CRC too, so
+    they must read as erased: each run of pages in a gap is only erased on the
+    boards where it is not blank already.
+    """
+    pages = firmware.data_pages(spans, len(binary), page_size)
+    dirty_pages = {offset: destinations for offset in pages}
+
+    gaps = []
+    for offset in range(0, len(binary), page_size):
+        if offset in pages:
+            continue
+
+        if gaps and gaps[-1][1] == offset:
+            gaps[-1][1] = offset + page_size
+        else:
+            gaps.append([offset, offset + page_size])
+
+    for start, end in gaps:
+        end = min(end, len(binary))
+        command = commands.encode_crc_region(base_address + start, end - start)
+        res = utils.write_command_retry(fdesc, command, destinations)
+
+        expected = crc32(binary[start:end])
+        boards = [id for id, crc in res.items() if msgpack.unpackb(crc) != expected]
+
+        if boards:
+            for offset in range(start, end, page_size):
+                dirty_pages[offset] = boards
+
+    return dirty_pages
+
+
+def resume_pages(fdesc, journal, key, binary, base_address, dirty_pages, page_size):
+    """
+    Reconciles the journal of an interrupted session with the flash of the
+    boards. dirty_pages is in the format of find_dirty_pages.
+
+    Only the pages which the journal lists as erased or written on a board
+    are checked, by reading their CRC back: the ones already written are
+    skipped and the ones still erased only need to be written. Any other page
+    is flashed again.
+
+    Returns (dirty_pages, erased_pages), erased_pages mapping the offset of
+    each page needing only a write to the list of boards needing it.
+    """
+    progress = journal.pages(key)
+    expected = page.page_crcs(binary, page_size)
+    remaining, erased = dict(), dict()
+
+    for offset, boards in sorted(dirty_pages.items()):
+        journaled = [
+            id
+            for id in boards
+            if id in progress
+            and (offset in progress[id].erased or offset in progress[id].written)
+        ]
+
+        size = min(page_size, len(binary) - offset)
+        crcs = dict()
+
+        if journaled:
+            command = commands.encode_crc_region(base_address + offset, size)
+            res = utils.write_command_retry(fdesc, command, journaled)
+            crcs = {id: msgpack.unpackb(crc) for id, crc in res.items()}
+
+        blank = crc32(bytes([page.ERASED_BYTE]) * size)
+
+        for id in boards:
+            crc = crcs.get(id)
+
+            if crc == expected[offset // page_size]:
+                continue
+            elif crc == blank:
+                erased.setdefault(offset, []).append(id)
+            else:
+                remaining.setdefault(offset, []).append(id)
+
+    return remaining, erased
+
+
+def start_journal(
+    fdesc, journal, resume, binary, base_address, device_class, ids, page_size, pages
 ):
     """
-    Writes a full binary to the flash using the given file descriptor.
+    Records the start of the flash of an image in the journal, resuming from
+    the progress it recorded if resume is true. pages is in the format of
+    find_dirty_pages.
 
-    It also takes the binary image, the base address and the device class as
-    parameters.
+    Returns the journal key of the image and the (dirty_pages, erased_pages)
+    to flash, see resume_pages.
+    """
+    key = flash_journal.image_key(binary, base_address, device_class, page_size)
+    erased_pages = dict()
+
+    if resume:
+        pages, erased_pages = resume_pages(
+            fdesc, journal, key, binary, base_address, pages, page_size
+        )
+
+    # Pages which do not need to be flashed are complete already
+    all_pages = set(range(0, len(binary), page_size))
+    boards = dict()
+
+    for id in ids:
+        dirty = set(o for o, b in pages.items() if id in b)
+        erased = set(o for o, b in erased_pages.items() if id in b)
+        written = all_pages - dirty - erased
+        boards[id] = flash_journal.BoardPages(written | erased, written)
+
+    journal.start(key, page_size, boards)
+
+    return key, pages, erased_pages
+
+
+class PhaseProgress:
+    """
+    Stand-in for a progress bar which reports to a callback instead.
+    """
+
+    def __init__(self, callback, phase, maxval):
+        self.callback = callback
+        self.phase = phase
+        self.maxval = maxval
+
+    def start(self):
+        self.update(0)
+        return self
+
+    def update(self, value):
+        self.callback(self.phase, value, self.maxval)
+
+    def finish(self):
+        self.update(self.maxval)
+
+
+def progress_bar(phase, maxval, progress=None):
     """
+    Announces the given phase and returns a started progress bar for it. If
+    progress is given, the phase is reported to it instead of the terminal.
+    """
+    if progress is not None:
+        return PhaseProgress(progress, phase, maxval).start()
+
+    print("{}...".format(phase))
+    return progressbar.ProgressBar(maxval=maxval).start()
+
 
-    print("Erasing pages...")
-    pbar = progressbar.ProgressBar(maxval=len(binary)).start()
+def _erase_and_write(
+    fdesc,
+    binary,
+    base_address,
+    device_class,
+    page_size,
+    dirty_pages,
+    erased_pages,
+    progress,
+    journal=None,
+    key=None,
+    compress=False,
+):
+    """
+    Erases all dirty pages, then writes them along with the erased pages,
+    recording the progress of the image with the given key in the journal.
+    """
+    pbar = progress_bar("Erasing pages", len(binary), progress)
 
     # First erase all pages
-    for offset in range(0, len(binary), page_size):
+    for offset, boards in sorted(dirty_pages.items()):
         erase_command = commands.encode_erase_flash_page(
             base_address + offset, device_class
         )
-        res = utils.write_command_retry(fdesc, erase_command, destinations)
+        res = utils.write_command_retry(fdesc, erase_command, boards)
 
         failed_boards = [
             str(id) for id, success in res.items() if not msgpack.unpackb(success)
@@ -88,40 +362,324 @@ def flash_binary(
             logging.critical(msg)
             sys.exit(2)
 
+        if journal is not None:
+            journal.erased(key, boards, offset)
+
         pbar.update(offset)
 
     pbar.finish()
 
-    print("Writing pages...")
-    pbar = progressbar.ProgressBar(maxval=len(binary)).start()
+    pbar = progress_bar("Writing pages", len(binary), progress)
 
-    # Then write all pages in chunks
+    # Then write all pages in chunks, skipping the erased spans
     for offset, chunk in enumerate(page.slice_into_pages(binary, page_size)):
         offset *= page_size
-        command = commands.encode_write_flash(
-            chunk, base_address + offset, device_class
-        )
+        boards = dirty_pages.get(offset, []) + erased_pages.get(offset, [])
 
-        res = utils.write_command_retry(fdesc, command, destinations)
-        failed_boards = [
-            str(id) for id, success in res.items() if not msgpack.unpackb(success)
+        if not boards:
+            continue
+
+        page_writes = [
+            command
+            for span_offset, span in page.written_spans(chunk)
+            for command in commands.encode_page_writes(
+                span, base_address + offset + span_offset, device_class, compress
+            )
         ]
 
-        if failed_boards:
-            msg = ", ".join(failed_boards)
-            msg = "Boards {} failed during page write, aborting...".format(msg)
-            logging.critical(msg)
-            sys.exit(2)
+        for command in page_writes:
+            res = utils.write_command_retry(fdesc, command, boards)
+            failed_boards = [
+                str(id) for id, success in res.items() if not msgpack.unpackb(success)
+            ]
+
+            if failed_boards:
+                msg = ", ".join(failed_boards)
+                msg = "Boards {} failed during page write, aborting...".format(msg)
+                logging.critical(msg)
+                sys.exit(2)
+
+        if journal is not None:
+            journal.written(key, boards, offset)
 
         pbar.update(offset)
     pbar.finish()
 
+
+def flash_binary(
+    fdesc,
+    binary,
+    base_address,
+    device_class,
+    destinations,
+    page_size=2048,
+    differential=False,
+    progress=None,
+    spans=None,
+    journal=None,
+    resume=False,
+    compress=False,
+):
+    """
+    Writes a full binary to the flash using the given file descriptor.
+
+    It also takes the binary image, the base address and the device class as
+    parameters.
+
+    In differential mode, the page CRCs are first read back from every board
+    and only the pages which differ are erased and written, each of them only
+    on the boards which need it.
+
+    spans lists the (offset, length) of the data of a sparse binary, loaded
+    from an ELF or HEX file (see find_sparse_pages).
+
+    If a journal (see cvra_bootloader.journal) is given, the progress of
+    every board is recorded in it. With resume, the session continues from
+    the progress recorded by an interrupted one (see resume_pages).
+
+    If compress is true, the data is sent compressed whenever it makes the
+    write commands shorter. This requires a bootloader which supports the
+    compressed write command.
+
+    progress is called as progress(phase, done, total) instead of printing
+    progress bars, see progress_bar.
+    """
+
+    if differential:
+        pbar = progress_bar("Comparing pages", 1, progress)
+        dirty_pages = find_dirty_pages(
+            fdesc, binary, base_address, destinations, page_size
+        )
+        pbar.finish()
+
+        if progress is None:
+            print(
+                "{} out of {} pages need to be flashed".format(
+                    len(dirty_pages), len(range(0, len(binary), page_size))
+                )
+            )
+    else:
+        dirty_pages = find_sparse_pages(
+            fdesc, binary, base_address, destinations, page_size, spans
+        )
+
+    key, erased_pages = None, dict()
+
+    if journal is not None:
+        key, dirty_pages, erased_pages = start_journal(
+            fdesc,
+            journal,
+            resume,
+            binary,
+            base_address,
+            device_class,
+            destinations,
+            page_size,
+            dirty_pages,
+        )
+
+    try:
+        _erase_and_write(
+            fdesc,
+            binary,
+            base_address,
+            device_class,
+            page_size,
+            dirty_pages,
+            erased_pages,
+            progress,
+            journal,
+            key,
+            compress,
+        )
+    finally:
+        if journal is not None:
+            journal.save()
+
     # Finally update application CRC and size in config
     config = dict()
     config["application_size"] = len(binary)
     config["application_crc"] = crc32(binary)
     utils.config_update_and_save(fdesc, config, destinations)
 
+    if journal is not None:
+        journal.forget(destinations)
+
+
+def flash_binary_pipelined(
+    fdesc,
+    binary,
+    base_address,
+    device_class,
+    destinations,
+    page_size=2048,
+    differential=False,
+    window=1,
+    timeout=0.5,
+    clock=time.monotonic,
+    progress=None,
+    spans=None,
+    journal=None,
+    resume=False,
+    compress=False,
+):
+    """
+    Writes a full binary to the flash of the given destinations, using the
+    pipelined scheduler.
+
+    Each board progresses through its own interleaved stream of erase and
+    write commands, with up to window commands in flight. Boards which fail
+    are quarantined while the others carry on. clock is the time source used
+    for the timeouts of the scheduler. progress and compress work like in
+    flash_binary.
+
+    Returns the list of boards which were flashed successfully.
+    """
+    image = manifest.Image(
+        binary, base_address, device_class, destinations, page_size, spans
+    )
+
+    return flash_images(
+        fdesc,
+        [image],
+        differential=differential,
+        window=window,
+        timeout=timeout,
+        clock=clock,
+        progress=progress,
+        journal=journal,
+        resume=resume,
+        compress=compress,
+    )
+
+
+def flash_images(
+    fdesc,
+    images,
+    differential=False,
+    window=1,
+    timeout=0.5,
+    clock=time.monotonic,
+    progress=None,
+    journal=None,
+    resume=False,
+    compress=False,
+):
+    """
+    Flashes several images in a single pass, each one to its own boards (see
+    manifest.Image), using the pipelined scheduler.
+
+    The scheduler multicasts each command to all the boards sharing an image
+    and interleaves the commands of the different images on the bus. journal,
+    resume and compress work like in flash_binary.
+
+    Returns the list of boards which were flashed successfully.
+    """
+    operations = dict()
+    keys = dict()
+
+    if differential:
+        pbar = progress_bar("Comparing pages", len(images), progress)
+
+    for index, image in enumerate(images):
+        binary, page_size = image.binary, image.page_size
+
+        if differential:
+            dirty_pages = find_dirty_pages(
+                fdesc, binary, image.base_address, image.ids, page_size
+            )
+            pbar.update(index + 1)
+        else:
+            dirty_pages = find_sparse_pages(
+                fdesc, binary, image.base_address, image.ids, page_size, image.spans
+            )
+
+        erased_pages = dict()
+
+        if journal is not None:
+            key, dirty_pages, erased_pages = start_journal(
+                fdesc,
+                journal,
+                resume,
+                binary,
+                image.base_address,
+                image.device_class,
+                image.ids,
+                page_size,
+                dirty_pages,
+            )
+            keys.update((id, key) for id in image.ids)
+
+        for id in image.ids:
+            offsets = set(o for o, boards in dirty_pages.items() if id in boards)
+            erased = set(o for o, boards in erased_pages.items() if id in boards)
+            operations[id] = scheduler.flash_operations(
+                binary,
+                image.base_address,
+                image.device_class,
+                page_size,
+                offsets | erased,
+                erased,
+                compress,
+            )
+
+    if differential:
+        pbar.finish()
+
+    on_done = None
+
+    if journal is not None:
+        # Index of the last operation of each page, after which it is written
+        last = {
+            id: {op.offset: index for index, op in enumerate(ops)}
+            for id, ops in operations.items()
+        }
+
+        def on_done(id, index):
+            operation = operations[id][index]
+
+            if operation.kind == "erase":
+                journal.erased(keys[id], [id], operation.offset)
+
+            if last[id][operation.offset] == index:
+                journal.written(keys[id], [id], operation.offset)
+
+    flash = scheduler.FlashScheduler(
+        fdesc, operations, window=window, timeout=timeout, clock=clock, on_done=on_done
+    )
+    pbar = progress_bar("Flashing pages", max(flash.total, 1), progress)
+
+    try:
+        failed = flash.run(progress=pbar.update)
+    finally:
+        if journal is not None:
+            journal.save()
+
+    pbar.finish()
+
+    if failed:
+        msg = ", ".join(str(id) for id in sorted(failed))
+        logging.error("Boards {} were quarantined".format(msg))
+
+    flashed = []
+
+    # Finally update application CRC and size in config
+    for image in images:
+        boards = [id for id in image.ids if id not in failed]
+
+        if boards:
+            config = dict()
+            config["application_size"] = len(image.binary)
+            config["application_crc"] = crc32(image.binary)
+            utils.config_update_and_save(fdesc, config, boards)
+
+        flashed += boards
+
+    if journal is not None:
+        journal.forget(flashed)
+
+    return flashed
+
 
 def check_binary(fdesc, binary, base_address, destinations):
     """
@@ -129,38 +687,150 @@ def check_binary(fdesc, binary, base_address, destinations):
 
     Returns a list of all nodes which are passing the test.
     """
+    image = manifest.Image(binary, base_address, None, destinations, None)
+    return check_images(fdesc, [image])
+
+
+def check_images(fdesc, images):
+    """
+    Checks that every image was correctly written to its boards, sending the
+    CRC requests of all images before waiting for the answers.
+
+    Returns a list of all nodes which are passing the test.
+    """
+    dispatcher = utils.get_dispatcher(fdesc)
+    requests = []
+
+    try:
+        for image in images:
+            command = commands.encode_crc_region(image.base_address, len(image.binary))
+            futures = dispatcher.send(command, image.ids)
+            requests.append((crc32(image.binary), futures))
+
+        pending = [f for _, futures in requests for f in futures.values()]
+
+        # Computing the CRC of a large binary can take longer than the read
+        # timeout (issue #53), so keep waiting
+        while not dispatcher.wait(pending):
+            pass
+    finally:
+        for _, futures in requests:
+            dispatcher.cancel(futures.values())
+
     valid_nodes = []
 
-    expected_crc = crc32(binary)
+    for expected_crc, futures in requests:
+        for id, future in futures.items():
+            crc = msgpack.unpackb(future.result())
 
-    command = commands.encode_crc_region(base_address, len(binary))
-    utils.write_command(fdesc, command, destinations)
+            if crc == expected_crc:
+                valid_nodes.append(id)
+
+    return valid_nodes
 
-    reader = utils.read_can_datagrams(fdesc)
 
-    boards_checked = 0
+def find_bad_pages(fdesc, binary, base_address, destinations, page_size=2048):
+    """
+    Finds the pages which differ on boards whose image CRC is known to be
+    wrong, by bisecting the image with CRC requests.
 
-    while boards_checked < len(destinations):
-        dt = next(reader)
+    Each range is split in two halves and only the halves whose CRC differs
+    are split further, so a few bad pages only take a few requests per board,
+    multicast to the boards sharing the same bad range. Returns a dictionary
+    in the same format as find_dirty_pages.
+    """
+    bad_pages = dict()
 
-        if dt is None:
-            continue
+    def mismatching_boards(start, end, boards):
+        command = commands.encode_crc_region(base_address + start, end - start)
+        res = utils.write_command_retry(fdesc, command, boards)
+        expected = crc32(binary[start:end])
+        return [id for id in boards if msgpack.unpackb(res[id]) != expected]
 
-        answer, _, src = dt
+    def bisect(start, end, boards):
+        if end - start <= page_size:
+            bad_pages[start] = boards
+            return
 
-        crc = msgpack.unpackb(answer)
+        pages = (end - start + page_size - 1) // page_size
+        middle = start + pages // 2 * page_size
 
-        if crc == expected_crc:
-            valid_nodes.append(src)
+        left = mismatching_boards(start, middle, boards)
 
-        boards_checked += 1
+        # The range is bad, so if its left half is fine its right half is not
+        right = [id for id in boards if id not in left]
+        if left:
+            right += mismatching_boards(middle, end, left)
 
-    return valid_nodes
+        if left:
+            bisect(start, middle, left)
+        if right:
+            bisect(middle, end, sorted(right))
+
+    if destinations:
+        bisect(0, len(binary), list(destinations))
+
+    return bad_pages
+
+
+def repair_images(
+    fdesc, images, valid_nodes, attempts=2, compress=False, progress=None
+):
+    """
+    Reflashes the boards of the given images (see manifest.Image) which are
+    not in valid_nodes, as recommended in PROTOCOL.markdown, but only erases
+    and writes the pages which differ (see find_bad_pages). The boards are
+    verified again after each of the given number of attempts. compress and
+    progress work like in flash_binary.
+
+    Returns a list of all nodes which are passing the test.
+    """
+    valid_nodes = set(valid_nodes)
+
+    for _ in range(attempts):
+        failed = [
+            image._replace(ids=[id for id in image.ids if id not in valid_nodes])
+            for image in images
+        ]
+        failed = [image for image in failed if image.ids]
+
+        if not failed:
+            break
+
+        for image in failed:
+            bad_pages = find_bad_pages(
+                fdesc, image.binary, image.base_address, image.ids, image.page_size
+            )
+
+            if progress is None:
+                print(
+                    "Reflashing {} pages on boards {}".format(
+                        len(bad_pages), ", ".join(map(str, image.ids))
+                    )
+                )
+
+            _erase_and_write(
+                fdesc,
+                image.binary,
+                image.base_address,
+                image.device_class,
+                image.page_size,
+                bad_pages,
+                dict(),
+                progress,
+                compress=compress,
+            )
+
+        valid_nodes.update(check_images(fdesc, failed))
+
+    return [id for image in images for id in image.ids if id in valid_nodes]
 
 
 def run_application(fdesc, destinations):
     """
     Asks the given node to run the application.
+
+    The boards do not answer this command, so it is sent without waiting.
     """
     command = commands.encode_jump_to_main()
     utils.write_command(fdesc, command, destinations)
@@ -181,60 +851,331 @@ def check_online_boards(fdesc, boards):
     """
     Returns a set containing the online boards.
     """
-    online_boards = set()
+    dispatcher = utils.get_dispatcher(fdesc)
+    futures = dispatcher.send(commands.encode_ping(), boards)
 
-    utils.write_command(fdesc, commands.encode_ping(), boards)
-    reader = utils.read_can_datagrams(fdesc)
+    try:
+        dispatcher.wait(futures.values())
+        return set(id for id, f in futures.items() if f.done())
+    finally:
+        dispatcher.cancel(futures.values())
 
-    for dt in reader:
-        if dt is None:
-            break
-        _, _, src = dt
-        online_boards.add(src)
 
-    return online_boards
+class CombinedProgress:
+    """
+    Single progress line for flash sessions running in parallel on several
+    buses.
+    """
 
+    def __init__(self, devices, output=sys.stderr):
+        self.lock = threading.Lock()
+        self.output = output
+        self.phases = {device: ("Waiting", 0, 1) for device in devices}
 
-def main():
+    def reporter(self, device):
+        """
+        Returns the progress callback of the given bus.
+        """
+
+        def report(phase, done, total):
+            with self.lock:
+                self.phases[device] = (phase, done, total)
+                self.render()
+
+        return report
+
+    def render(self):
+        line = "  ".join(
+            "{}: {} {:3.0f}%".format(device, phase, 100 * done / max(total, 1))
+            for device, (phase, done, total) in self.phases.items()
+        )
+        self.output.write("\r" + line)
+        self.output.flush()
+
+    def finish(self):
+        self.output.write("\n")
+
+
+def flash_bus(conn, images, args, progress=None, journal=None):
     """
-    Entry point of the application.
+    Flashes and verifies the boards of the given images (see manifest.Image)
+    on a single bus, reporting progress to the given callback instead of
+    printing. The progress of the boards is recorded in journal if given.
+
+    Returns a message describing why the session failed, or None on success.
     """
-    args = parse_commandline_args()
-    with open(args.binary_file, "rb") as input_file:
-        binary = input_file.read()
+    ids = [id for image in images for id in image.ids]
+    online_boards = check_online_boards(conn, ids)
+
+    if online_boards != set(ids):
+        offline_boards = sorted(set(ids) - online_boards)
+        return "boards {} are offline".format(", ".join(map(str, offline_boards)))
+
+    if args.pipeline or len(images) > 1:
+        flashed = flash_images(
+            conn,
+            images,
+            differential=args.differential,
+            window=args.window,
+            timeout=utils.read_timeout(args),
+            progress=progress,
+            journal=journal,
+            resume=args.resume,
+            compress=args.compress,
+        )
+    else:
+        image = images[0]
+        flash_binary(
+            conn,
+            image.binary,
+            image.base_address,
+            image.device_class,
+            image.ids,
+            page_size=image.page_size,
+            differential=args.differential,
+            progress=progress,
+            spans=image.spans,
+            journal=journal,
+            resume=args.resume,
+            compress=args.compress,
+        )
+        flashed = ids
 
-    serial_port = utils.open_connection(args)
+    if progress:
+        progress("Verifying", 0, 1)
 
-    online_boards = check_online_boards(serial_port, args.ids)
+    flashed = manifest.select_boards(images, flashed)
+    valid_nodes = set(check_images(conn, flashed))
 
-    if online_boards != set(args.ids):
-        offline_boards = [str(i) for i in set(args.ids) - online_boards]
-        print("Boards {} are offline, aborting...".format(", ".join(offline_boards)))
-        exit(2)
+    if args.repair and valid_nodes != set(ids):
+        if progress:
+            progress("Repairing", 0, 1)
 
-    print("Flashing firmware (size: {} bytes)".format(len(binary)))
-    flash_binary(
-        serial_port,
-        binary,
-        args.base_address,
-        args.device_class,
-        args.ids,
-        page_size=args.page_size,
-    )
+        valid_nodes = set(
+            repair_images(
+                conn, flashed, valid_nodes, compress=args.compress, progress=progress
+            )
+        )
 
-    print("Verifying firmware...")
-    valid_nodes_set = set(
-        check_binary(serial_port, binary, args.base_address, args.ids)
-    )
-    nodes_set = set(args.ids)
+    if valid_nodes != set(ids):
+        failed_nodes = sorted(set(ids) - valid_nodes)
+        return "verification failed for nodes {}".format(
+            ", ".join(map(str, failed_nodes))
+        )
 
-    if valid_nodes_set == nodes_set:
-        print("OK")
-    else:
-        verification_failed(nodes_set - valid_nodes_set)
+    if progress:
+        progress("Done", 1, 1)
 
     if args.run:
-        run_application(serial_port, args.ids)
+        run_application(conn, ids)
+
+
+def bus_images(images, bus, args):
+    """
+    Returns the images to flash on the given bus. The IDs of the bus restrict
+    a manifest to some of its boards and give the boards of a single binary.
+    """
+    if not args.manifest:
+        return [image._replace(ids=bus.ids) for image in images]
+
+    if bus.ids:
+        return manifest.select_boards(images, bus.ids)
+
+    return images
+
+
+def load_images(args):
+    """
+    Returns the images to flash, read from the manifest or from the binary
+    given on the command line.
+    """
+    if args.manifest:
+        images = manifest.load_manifest(args.manifest, args.page_size)
+
+        if args.ids:
+            images = manifest.select_boards(images, args.ids)
+
+        return images
+
+    image = firmware.load_firmware(args.binary_file, args.base_address)
+
+    return [
+        manifest.Image(
+            image.binary,
+            image.base_address,
+            args.device_class,
+            args.ids,
+            args.page_size,
+            image.spans,
+        )
+    ]
+
+
+def interface_name(args):
+    """
+    Returns the name of the interface given on the command line.
+    """
+    return args.can_interface or args.serial_device or args.replay
+
+
+def open_journal(path, resume, images, interface):
+    """
+    Opens the journal recording the flash of the given images (see
+    manifest.Image) on the given interface, or returns None if path is None.
+
+    The journal of an interrupted session is only loaded to resume it, a new
+    session starts from an empty journal.
+
+    Raises ValueError if the journal to resume was recorded on another
+    interface, or with another image for some of the boards.
+    """
+    if path is None:
+        return None
+
+    if not resume:
+        return flash_journal.FlashJournal(path, interface)
+
+    journal = flash_journal.FlashJournal.open(path, interface=interface)
+
+    if journal.images and journal.recorded_interface != interface:
+        raise ValueError("the journal was not recorded on {}".format(interface))
+
+    recorded = journal.boards()
+    mismatching = []
+
+    for image in images:
+        key = flash_journal.image_key(
+            image.binary, image.base_address, image.device_class, image.page_size
+        )
+        mismatching += [id for id in image.ids if recorded.get(id, key) != key]
+
+    if mismatching:
+        raise ValueError(
+            "the journal records another firmware for boards {}".format(
+                ", ".join(map(str, sorted(mismatching)))
+            )
+        )
+
+    return journal
+
+
+def flash_buses(args, images):
+    """
+    Flashes every bus given with --bus in parallel, then prints a summary.
+    images maps each device to the images to flash on its bus.
+
+    Exits with an error if any bus failed.
+    """
+    display = CombinedProgress([bus.device for bus in args.buses])
+
+    def session(conn, bus):
+        progress = display.reporter(bus.device)
+        path = args.journal and utils.bus_file_name(args.journal, bus)
+
+        try:
+            journal = open_journal(path, args.resume, images[bus.device], bus.device)
+        except ValueError as e:
+            return "cannot resume: {}".format(e)
+
+        return flash_bus(conn, images[bus.device], args, progress, journal)
+
+    print_images(args, [i for bus in images.values() for i in bus])
+    results = utils.run_on_buses(args, session)
+    display.finish()
+
+    ok = True
+    for bus in args.buses:
+        result = results[bus.device]
+        ids = [id for image in images[bus.device] for id in image.ids]
+
+        if isinstance(result, SystemExit):
+            result = "aborted"
+        elif isinstance(result, BaseException):
+            result = "error: {!r}".format(result)
+
+        if result is None:
+            print("{}: OK ({})".format(bus.device, ", ".join(map(str, ids))))
+        else:
+            print("{}: {}".format(bus.device, result))
+            ok = False
+
+    if not ok:
+        exit(2)
+
+
+def print_images(args, images):
+    """
+    Announces what is about to be flashed.
+    """
+    if not args.manifest:
+        print("Flashing firmware (size: {} bytes)".format(len(images[0].binary)))
+        return
+
+    for image in images:
+        print(
+            "Flashing {} firmware (size: {} bytes) to boards {}".format(
+                image.device_class,
+                len(image.binary),
+                ", ".join(map(str, image.ids)),
+            )
+        )
+
+
+def open_journal_or_exit(args, images):
+    """
+    Opens the journal of a session on the interface given on the command line,
+    see open_journal. Exits with an error if it cannot be resumed.
+    """
+    try:
+        return open_journal(args.journal, args.resume, images, interface_name(args))
+    except ValueError as e:
+        print("Cannot resume: {}".format(e))
+        exit(2)
+
+
+def flash_single_bus(args, images):
+    """
+    Flashes and verifies the images to flash (see load_images) on the
+    connection given on the command line, see flash_bus, then prints the
+    outcome.
+    """
+    if not images:
+        print("No board of the manifest was selected")
+        exit(2)
+
+    journal = open_journal_or_exit(args, images)
+    conn = utils.open_connection(args)
+
+    print_images(args, images)
+    error = flash_bus(conn, images, args, journal=journal)
+
+    if error is not None:
+        print("Flashing failed: {}".format(error))
+        exit(1)
+
+    print("OK")
+
+
+def main():
+    """
+    Entry point of the application.
+    """
+    args = parse_commandline_args()
+
+    try:
+        images = load_images(args)
+
+        if args.buses:
+            images = {bus.device: bus_images(images, bus, args) for bus in args.buses}
+    except (OSError, ValueError) as e:
+        print("Cannot load {}: {}".format(args.manifest or args.binary_file, e))
+        exit(2)
+
+    if args.buses:
+        flash_buses(args, images)
+        return
+
+    flash_single_bus(args, images)
 
 
 if __name__ == "__main__":
@@ -1,19 +1,37 @@
 import cvra_bootloader.can
+from cvra_bootloader.can import pcap, slcan
+from collections import deque
+import errno
+import logging
 import socket
 import struct
 import serial
 from queue import Queue
 import threading
+import time
 
 
 class SocketCANConnection:
     # See <linux/can.h> for format
     CAN_FRAME_FMT = "=IB3x8s"
-    CAN_FRAME_SIZE = struct.calcsize(CAN_FRAME_FMT)
+    CAN_FRAME = struct.Struct(CAN_FRAME_FMT)
+    CAN_FRAME_SIZE = CAN_FRAME.size
+    CAN_FILTER_FMT = "=II"
 
-    def __init__(self, interface, read_timeout=1):
+    # Bootloader frames use standard IDs with the 3 upper bits cleared (see
+    # PROTOCOL.markdown)
+    BOOTLOADER_ID_MASK = 0x700
+
+    # Not exposed by the socket module, see <asm-generic/socket.h>
+    SO_TIMESTAMPNS = 35
+    TIMESPEC = struct.Struct("@ll")
+
+    def __init__(self, interface, read_timeout=1, timestamps=False):
         """
         Initiates a CAN connection on the given interface (e.g. 'can0').
+
+        If timestamps is true, received frames are timestamped by the kernel
+        with nanosecond resolution.
         """
         # Creates a raw CAN connection and binds it to the given interface.
         self.socket = socket.socket(socket.AF_CAN, socket.SOCK_RAW, socket.CAN_RAW)
@@ -22,20 +40,106 @@ class SocketCANConnection:
         self.socket.settimeout(read_timeout)
         self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, 4096)
 
+        # Only wake up for bootloader frames, so that high level protocols
+        # (UAVCAN) sharing the bus are dropped by the kernel.
+        can_filter = struct.pack(
+            self.CAN_FILTER_FMT,
+            0,
+            socket.CAN_EFF_FLAG | socket.CAN_RTR_FLAG | self.BOOTLOADER_ID_MASK,
+        )
+        self.socket.setsockopt(socket.SOL_CAN_RAW, socket.CAN_RAW_FILTER, can_filter)
+
+        # Our own requests must not be read back as answers, but other
+        # sockets on this host (e.g. candump) should still see them.
+        self.socket.setsockopt(socket.SOL_CAN_RAW, socket.CAN_RAW_RECV_OWN_MSGS, 0)
+        self.socket.setsockopt(socket.SOL_CAN_RAW, socket.CAN_RAW_LOOPBACK, 1)
+
+        self.timestamps = timestamps
+        if timestamps:
+            self.socket.setsockopt(socket.SOL_SOCKET, self.SO_TIMESTAMPNS, 1)
+
+    # Backoff used when the interface transmit queue is full
+    ENOBUFS_BACKOFF = 0.001
+    ENOBUFS_MAX_BACKOFF = 0.1
+    ENOBUFS_RETRIES = 50
+
+    # Kernel receive timestamps, see __init__
+    timestamps = False
+
     def send_frame(self, frame):
-        data = frame.data.ljust(8, b"\x00")
-        data = struct.pack(self.CAN_FRAME_FMT, frame.id, len(frame.data), data)
+        self._send(self._pack_frame(frame))
 
-        self.socket.send(data)
+    def send_frames(self, frames):
+        """
+        Sends several frames, packing them all before the first write.
+
+        Python does not expose sendmmsg and CAN_RAW sockets only accept one
+        frame per write, so each frame still needs its own syscall.
+        """
+        for data in [self._pack_frame(f) for f in frames]:
+            self._send(data)
+
+    def _pack_frame(self, frame):
+        # The data field is zero padded by struct
+        data = bytes(frame.data)
+        return self.CAN_FRAME.pack(frame.id, len(data), data)
+
+    def _send(self, data):
+        """
+        Writes a packed frame to the socket, backing off while the interface
+        transmit queue is full (ENOBUFS).
+        """
+        backoff = self.ENOBUFS_BACKOFF
+        for _ in range(self.ENOBUFS_RETRIES):
+            try:
+                return self.socket.send(data)
+            except OSError as e:
+                if e.errno != errno.ENOBUFS:
+                    raise
+
+            time.sleep(backoff)
+            backoff = min(2 * backoff, self.ENOBUFS_MAX_BACKOFF)
+
+        return self.socket.send(data)
 
     def receive_frame(self):
         try:
-            frame, _ = self.socket.recvfrom(self.CAN_FRAME_SIZE)
+            frame, timestamp = self._receive()
         except socket.timeout:
             return None
-        can_id, can_dlc, data = struct.unpack(self.CAN_FRAME_FMT, frame)
+        can_id, can_dlc, data = self.CAN_FRAME.unpack(frame)
+
+        if can_id & socket.CAN_EFF_FLAG:
+            return cvra_bootloader.can.Frame(
+                id=can_id & socket.CAN_EFF_MASK,
+                data=data[:can_dlc],
+                extended=True,
+                timestamp=timestamp,
+            )
+
+        return cvra_bootloader.can.Frame(
+            id=can_id & socket.CAN_SFF_MASK, data=data[:can_dlc], timestamp=timestamp
+        )
+
+    def _receive(self):
+        """
+        Reads a packed frame from the socket and returns it along with its
+        kernel timestamp in nanoseconds, or None if timestamps are disabled.
+        """
+        if not self.timestamps:
+            frame, _ = self.socket.recvfrom(self.CAN_FRAME_SIZE)
+            return frame, None
 
-        return cvra_bootloader.can.Frame(id=can_id, data=data[:can_dlc])
+        frame, ancdata, _, _ = self.socket.recvmsg(
+            self.CAN_FRAME_SIZE, socket.CMSG_SPACE(self.TIMESPEC.size)
+        )
+
+        for level, kind, data in ancdata:
+            if level == socket.SOL_SOCKET and kind == self.SO_TIMESTAMPNS:
+                sec, nsec = self.TIMESPEC.unpack_from(data)
+                return frame, sec * 1000000000 + nsec
+
+        return frame, None
 
 
 class SerialCANConnection:
@@ -43,8 +147,6 @@ class SerialCANConnection:
     Implements the slcan API.
     """
 
-    MIN_MSG_LEN = len("t1230")
-
     def __init__(self, port, read_timeout=1):
         self.port = port
         self.timeout = read_timeout
@@ -61,25 +163,18 @@ class SerialCANConnection:
         port.reset_input_buffer()
 
     def spin(self):
-        part = ""
+        decoder = slcan.StreamDecoder()
         while True:
-            part += self.port.read(100).decode("ascii")
-
-            if part.startswith("\r"):
-                part.lstrip("\r")
-
-            if "\r" not in part:
-                continue
+            # Read everything available, or block until the port timeout for
+            # at least one byte
+            try:
+                data = self.port.read(self.port.in_waiting or 1)
+            except (serial.SerialException, OSError) as e:
+                logging.error("Cannot read from the CAN adapter: {}".format(e))
+                return
 
-            data = part.split("\r")
-            data, part = data[:-1], data[-1]
-
-            for frame in data:
-                if frame is None:
-                    continue
-                frame = self.decode_frame(frame)
-                if frame:
-                    self.rx_queue.put(frame)
+            for frame in decoder.feed(data):
+                self.rx_queue.put(frame)
 
     def send_command(self, cmd):
         cmd += "\r"
@@ -87,51 +182,19 @@ class SerialCANConnection:
         self.port.write(cmd)
 
     def decode_frame(self, msg):
-        if len(msg) < self.MIN_MSG_LEN:
-            return None
-
-        cmd, msg = msg[0], msg[1:]
-        if cmd == "T":
-            extended = True
-            id_len = 8
-        elif cmd == "t":
-            extended = False
-            id_len = 3
-        else:
-            return None
-
-        if len(msg) < id_len + 1:
-            return None
-        can_id = int(msg[0:id_len], 16)
-        msg = msg[id_len:]
-        data_len = int(msg[0])
-        msg = msg[1:]
-        if len(msg) < 2 * data_len:
-            return None
-        data = [int(msg[i : i + 2], 16) for i in range(0, 2 * data_len, 2)]
-
-        return can.Frame(
-            id=can_id, data=bytearray(data), data_length=data_len, extended=extended
-        )
+        return slcan.decode_frame(msg)
 
     def encode_frame(self, frame):
-        if frame.extended:
-            cmd = "T"
-            can_id = "{:08x}".format(frame.id)
-        else:
-            cmd = "t"
-            can_id = "{:03x}".format(frame.id)
-
-        length = "{:x}".format(frame.data_length)
-
-        data = ""
-        for b in frame.data:
-            data += "{:02x}".format(b)
-        return cmd + can_id + length + data
+        return slcan.encode_frame(frame)
 
     def send_frame(self, frame):
-        cmd = self.encode_frame(frame)
-        self.send_command(cmd)
+        self.port.write(slcan.encode_frame(frame) + b"\r")
+
+    def send_frames(self, frames):
+        """
+        Sends several frames using a single write to the port.
+        """
+        self.port.write(b"".join(slcan.encode_frame(f) + b"\r" for f in frames))
 
     def receive_frame(self):
         try:
@@ -140,3 +203,128 @@ class SerialCANConnection:
             return self.rx_queue.get(True, self.timeout)
         except:
             return None
+
+
+class ReplayMismatchError(RuntimeError):
+    """
+    Error raised when the frames sent to a replay connection differ from the
+    ones in the capture.
+    """
+
+    pass
+
+
+class PcapReplayConnection:
+    """
+    Connection replaying the board answers recorded in a capture (see
+    PcapConnectionWrapper).
+
+    The recorded frames are split between the ones sent by the host (source
+    host) and the answers. An answer is only returned once the client sent
+    as many datagrams as the host had sent before it in the capture, which
+    keeps the replay in step with the client. When no answer is available
+    yet, receive_frame times out like a real connection.
+
+    In realtime mode, each answer is delayed as it was in the capture, from
+    the moment the client sent the matching datagram. Otherwise the capture
+    is replayed as fast as possible and timeouts return immediately.
+
+    If verify is true, the frames sent by the client are compared with the
+    recorded ones and ReplayMismatchError is raised if they differ.
+    """
+
+    def __init__(self, capture, host=0, realtime=False, read_timeout=1, verify=False):
+        if isinstance(capture, str):
+            capture = open(capture, "rb")
+
+        self.frames = pcap.read_capture(capture)
+        self.host = host
+        self.realtime = realtime
+        self.timeout = read_timeout
+        self.verify = verify
+
+        # Next recorded frame, not replayed yet
+        self.next_frame = None
+        # Number of datagrams sent by the client and replayed from the capture
+        self.sent = 0
+        self.replayed = 0
+        # Time at which the client sent the datagrams not replayed yet, and
+        # the frames it sent which were not compared with the capture yet
+        self.send_times = deque()
+        self.sent_frames = deque()
+        # Recorded timestamp and replay time of the last datagram replayed
+        self.reference = None
+
+    def send_frame(self, frame):
+        self.send_frames([frame])
+
+    def send_frames(self, frames):
+        for frame in frames:
+            if cvra_bootloader.can.is_start_of_datagram(frame):
+                self.sent += 1
+                self.send_times.append(time.monotonic())
+
+            if self.verify:
+                self.sent_frames.append(frame)
+
+    def receive_frame(self):
+        while True:
+            frame = self._peek()
+
+            # End of the capture
+            if frame is None:
+                return self._timeout()
+
+            if not self._is_host(frame):
+                break
+
+            if cvra_bootloader.can.is_start_of_datagram(frame):
+                # Wait for the client to send this datagram
+                if self.replayed == self.sent:
+                    return self._timeout()
+
+                self.replayed += 1
+                self.reference = (frame.timestamp, self.send_times.popleft())
+
+            self._check_sent_frame(frame)
+            self.next_frame = None
+
+        if self.realtime and self.reference:
+            recorded, sent = self.reference
+            delay = sent + (frame.timestamp - recorded) / 1e9 - time.monotonic()
+
+            if delay > self.timeout:
+                return self._timeout()
+
+            if delay > 0:
+                time.sleep(delay)
+
+        self.next_frame = None
+        return frame
+
+    def _peek(self):
+        if self.next_frame is None:
+            self.next_frame = next(self.frames, None)
+        return self.next_frame
+
+    def _is_host(self, frame):
+        return not frame.extended and frame.id & 0x7F == self.host
+
+    def _check_sent_frame(self, recorded):
+        if not self.verify:
+            return
+
+        frame = self.sent_frames.popleft() if self.sent_frames else None
+
+        if frame is None or (frame.id, bytes(frame.data)) != (
+            recorded.id,
+            bytes(recorded.data),
+        ):
+            raise ReplayMismatchError(
+                "Sent {} instead of recorded {}".format(frame, recorded)
+            )
+
+    def _timeout(self):
+        if self.realtime:
+            time.sleep(self.timeout)
+        return None
@@ -0,0 +1,169 @@
+"""
+Asyncio transports for the CAN adapters.
+
+Asynchronous connections expose coroutines instead of blocking calls:
+send_frames(frames) writes frames to the bus and receive_frame() waits for
+the next frame, without timeout. Frames are read by the event loop as soon as
+they arrive, so a single thread can drive many buses.
+
+Connections must be created from a running event loop.
+"""
+import asyncio
+import errno
+
+import serial
+
+from . import slcan
+from .adapters import SocketCANConnection
+
+
+class AsyncSocketCANConnection:
+    """
+    Wraps a SocketCANConnection, switching its socket to non blocking mode.
+    Incoming frames are read by the event loop (loop.add_reader).
+    """
+
+    # Backoff used when the interface transmit queue is full
+    ENOBUFS_BACKOFF = 0.001
+    ENOBUFS_MAX_BACKOFF = 0.1
+    ENOBUFS_RETRIES = 50
+
+    def __init__(self, conn):
+        self.conn = conn
+        self.socket = conn.socket
+        self.socket.setblocking(False)
+
+        self.loop = asyncio.get_running_loop()
+        self.rx_queue = asyncio.Queue()
+        self.loop.add_reader(self.socket.fileno(), self._read_frames)
+
+    def _read_frames(self):
+        while True:
+            try:
+                frame = self.conn.receive_frame()
+            except BlockingIOError:
+                return
+
+            self.rx_queue.put_nowait(frame)
+
+    async def send_frame(self, frame):
+        await self.send_frames([frame])
+
+    async def send_frames(self, frames):
+        for data in [self.conn._pack_frame(f) for f in frames]:
+            await self._send(data)
+
+    async def _send(self, data):
+        """
+        Writes a packed frame to the socket, backing off while the interface
+        transmit queue is full (ENOBUFS).
+        """
+        backoff = self.ENOBUFS_BACKOFF
+        for _ in range(self.ENOBUFS_RETRIES):
+            try:
+                return await self.loop.sock_sendall(self.socket, data)
+            except OSError as e:
+                if e.errno != errno.ENOBUFS:
+                    raise
+
+            await asyncio.sleep(backoff)
+            backoff = min(2 * backoff, self.ENOBUFS_MAX_BACKOFF)
+
+        return await self.loop.sock_sendall(self.socket, data)
+
+    async def receive_frame(self):
+        return await self.rx_queue.get()
+
+    def close(self):
+        self.loop.remove_reader(self.socket.fileno())
+        self.socket.close()
+
+
+def open_socketcan_connection(interface, timestamps=False):
+    """
+    Opens an asynchronous connection on the given SocketCAN interface.
+    """
+    return AsyncSocketCANConnection(
+        SocketCANConnection(interface, timestamps=timestamps)
+    )
+
+
+class SlcanProtocol(asyncio.Protocol):
+    """
+    Asyncio protocol decoding the byte stream of a slcan adapter into frames.
+    """
+
+    def __init__(self):
+        self.decoder = slcan.StreamDecoder()
+        self.rx_queue = asyncio.Queue()
+
+    def data_received(self, data):
+        for frame in self.decoder.feed(data):
+            self.rx_queue.put_nowait(frame)
+
+    def connection_lost(self, exc):
+        # Wakes up the reader, which raises instead of waiting forever
+        self.rx_queue.put_nowait(None)
+
+
+class AsyncSerialCANConnection:
+    """
+    Asynchronous slcan connection, see open_serial_connection.
+    """
+
+    def __init__(self, protocol, read_transport, write_transport):
+        self.protocol = protocol
+        self.read_transport = read_transport
+        self.write_transport = write_transport
+
+    def send_command(self, cmd):
+        self.write_transport.write(cmd.encode("ascii") + b"\r")
+
+    async def send_frame(self, frame):
+        await self.send_frames([frame])
+
+    async def send_frames(self, frames):
+        """
+        Sends several frames using a single write to the port.
+        """
+        self.write_transport.write(
+            b"".join(slcan.encode_frame(f) + b"\r" for f in frames)
+        )
+
+    async def receive_frame(self):
+        frame = await self.protocol.rx_queue.get()
+
+        if frame is None:
+            self.protocol.rx_queue.put_nowait(None)
+            raise ConnectionError("The serial port was closed")
+
+        return frame
+
+    def close(self):
+        self.read_transport.close()
+        self.write_transport.close()
+
+
+async def open_serial_connection(port):
+    """
+    Opens an asynchronous slcan connection on the given serial port (a
+    device path or a pyserial port), and opens the CAN channel at 1 Mbit/s.
+
+    The port is driven by the event loop as a pipe, which requires a POSIX
+    system.
+    """
+    if isinstance(port, str):
+        port = serial.Serial(port=port, timeout=0)
+
+    loop = asyncio.get_running_loop()
+    read_transport, protocol = await loop.connect_read_pipe(SlcanProtocol, port)
+    write_transport, _ = await loop.connect_write_pipe(asyncio.Protocol, port)
+
+    conn = AsyncSerialCANConnection(protocol, read_transport, write_transport)
+
+    # bitrate 1Mbit
+    conn.send_command("S8")
+    # open device
+    conn.send_command("O")
+
+    return conn
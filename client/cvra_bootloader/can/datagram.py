@@ -5,6 +5,10 @@ from .frame import *
 DATAGRAM_VERSION = 1
 START_OF_DATAGRAM_MASK = 1 << 7
 
+# Precompiled codecs for the datagram fields
+_CRC_AND_DST_LEN = struct.Struct(">IB")
+_UINT32 = struct.Struct(">I")
+
 
 class VersionMismatchError(RuntimeError):
     """
@@ -33,14 +37,24 @@ def encode_datagram(data, destinations):
     """
     Encodes the given data and destination list to form a complete datagram.
     This datagram can then be cut into CAN messages by datagram_to_frames.
+
+    The datagram is built in a single buffer, the data being copied only once.
     """
+    addresses_len = 1 + len(destinations)
+    header_len = 1 + 4 + addresses_len + 4
+
+    dt = bytearray(header_len + len(data))
+    dt[0] = DATAGRAM_VERSION
+    dt[5] = len(destinations)
+    dt[6 : 5 + addresses_len] = bytes(destinations)
+    _UINT32.pack_into(dt, 5 + addresses_len, len(data))
+    dt[header_len:] = data
 
-    version = struct.pack("B", DATAGRAM_VERSION)
-    addresses = bytes([len(destinations)] + destinations)
-    dt = struct.pack(">I", len(data)) + data
-    crc = struct.pack(">I", crc32(addresses + dt))
+    # The CRC covers everything after itself
+    crc = crc32(memoryview(dt)[5:])
+    _UINT32.pack_into(dt, 1, crc)
 
-    return version + crc + addresses + dt
+    return dt
 
 
 def decode_datagram(data):
@@ -51,53 +65,177 @@ def decode_datagram(data):
 
     Raise an exception if the datagram is invalid (wrong version or wrong CRC).
     """
+    version = int(data[0])
+    if version != DATAGRAM_VERSION:
+        raise VersionMismatchError
 
-    try:
-        version, data = int(data[0]), data[1:]
-        if version != DATAGRAM_VERSION:
-            raise VersionMismatchError
+    # This means that we have not enough bytes to decode the header
+    if len(data) < 1 + _CRC_AND_DST_LEN.size:
+        return None
+
+    crc, dst_len = _CRC_AND_DST_LEN.unpack_from(data, 1)
+    data_start = 6 + dst_len + 4
+
+    if len(data) < data_start:
+        return None
+
+    destinations = list(data[6 : 6 + dst_len])
+    data_len = _UINT32.unpack_from(data, 6 + dst_len)[0]
+
+    # If we did not receive all data yet
+    if data_len != len(data) - data_start:
+        return None
+
+    # The CRC covers everything after itself
+    if crc32(memoryview(data)[5:]) != crc:
+        raise CRCMismatchError
 
-        header_format = ">IB"
-        header_len = struct.calcsize(header_format)
-        header, data = data[0:header_len], data[header_len:]
-        crc, dst_len = struct.unpack(header_format, header)
+    return data[data_start:], destinations
 
-        # Decodes the destination list
-        destination_format = "{}s".format(dst_len)
-        destinations, data = data[:dst_len], data[dst_len:]
-        destinations = list(struct.unpack(destination_format, destinations)[0])
 
-        data_len, data = data[:4], data[4:]
-        data_len = struct.unpack(">I", data_len)[0]
+class DatagramReader:
+    """
+    Incremental datagram decoder.
+
+    It works like can_datagram_input_byte in the firmware: the header is
+    parsed once, then the data are appended to a buffer while the CRC is
+    updated, making the reassembly linear in the datagram size.
+
+    The buffer grows as the data arrive rather than being allocated from the
+    length in the header, which comes from the bus and can be anything up to
+    4 GB for stray frames.
+    """
+
+    HEADER_FORMAT = ">BIB"
+    HEADER = struct.Struct(HEADER_FORMAT)
+    HEADER_LEN = HEADER.size
+
+    def __init__(self):
+        self._header = bytearray()
+        self._data = None
+        self._data_len = 0
+        self._crc = 0
+        self._expected_crc = 0
+        self._complete = False
+        self.destinations = None
+
+    def input_bytes(self, data):
+        """
+        Feeds the given bytes to the decoder.
+
+        Returns a tuple containing the data and the list of destinations once
+        the datagram is complete and valid, None otherwise. Bytes following a
+        complete datagram are ignored.
+
+        Raise an exception if the datagram is invalid (wrong version or wrong CRC).
+        """
+        if self._data is None:
+            self._header += data
+            data = self._parse_header()
+
+            if data is None:
+                return None
+        elif self._complete:
+            return None
 
-        # If we did not receive all data yet
-        if data_len != len(data):
+        chunk = data[: self._data_len - len(self._data)]
+        self._data += chunk
+        self._crc = crc32(chunk, self._crc)
+
+        if len(self._data) < self._data_len:
             return None
 
-        addresses = bytes([len(destinations)] + destinations)
-        dt = struct.pack(">I", len(data)) + data
+        self._complete = True
 
-        if crc32(addresses + dt) != crc:
+        if self._crc != self._expected_crc:
             raise CRCMismatchError
 
-    except struct.error:
-        # This means that we have not enough bytes to decode somewhere
-        return None
+        return bytes(self._data), self.destinations
+
+    def _parse_header(self):
+        """
+        Decodes the header once it was fully received and returns the bytes
+        following it, or None if the header is incomplete.
+        """
+        if self._header and self._header[0] != DATAGRAM_VERSION:
+            raise VersionMismatchError
 
-    return data, destinations
+        if len(self._header) < self.HEADER_LEN:
+            return None
+
+        _, crc, dst_len = self.HEADER.unpack_from(self._header)
+        data_start = self.HEADER_LEN + dst_len + 4
+
+        if len(self._header) < data_start:
+            return None
+
+        self._expected_crc = crc
+        self.destinations = list(self._header[self.HEADER_LEN : data_start - 4])
+        self._data_len = _UINT32.unpack_from(self._header, data_start - 4)[0]
+
+        self._crc = crc32(self._header[self.HEADER_LEN - 1 : data_start])
+        self._data = bytearray()
+
+        data = bytes(self._header[data_start:])
+        self._header = None
+
+        return data
+
+
+class DatagramDemultiplexer:
+    """
+    Reassembles the datagrams of every source from the frames of a bus.
+    """
+
+    def __init__(self):
+        self.readers = dict()
+
+    def input_frame(self, frame):
+        """
+        Feeds a frame received from the bus.
+
+        Returns a tuple (data, destinations, source) once a datagram is
+        complete, None otherwise. Raises the same exceptions as DatagramReader,
+        after which the frames of the invalid datagram are ignored.
+        """
+        if frame.extended:
+            return None
+
+        src = frame.id & ~START_OF_DATAGRAM_MASK
+
+        if is_start_of_datagram(frame):
+            self.readers[src] = DatagramReader()
+        elif src not in self.readers:
+            # We missed the start of this datagram
+            return None
+
+        try:
+            datagram = self.readers[src].input_bytes(frame.data)
+        except (VersionMismatchError, CRCMismatchError):
+            del self.readers[src]
+            raise
+
+        if datagram is None:
+            return None
+
+        del self.readers[src]
+        data, dst = datagram
+        return data, dst, src
 
 
 def datagram_to_frames(datagram, source):
     """
     Transforms a raw datagram into CAN frames.
+
+    The data of the frames are zero-copy slices of the datagram.
     """
     start_bit = START_OF_DATAGRAM_MASK
+    view = memoryview(datagram)
 
-    while len(datagram) > 8:
-        data, datagram = datagram[:8], datagram[8:]
-
-        yield Frame(id=start_bit + source, data=data)
+    for offset in range(0, max(len(view) - 8, 0), 8):
+        yield Frame(id=start_bit + source, data=view[offset : offset + 8])
 
         start_bit = 0
 
-    yield Frame(id=start_bit + source, data=datagram)
+    offset = max(len(view) - 1, 0) // 8 * 8
+    yield Frame(id=start_bit + source, data=view[offset:])
@@ -1,28 +1,42 @@
 class Frame:
     """
     A single CAN frame.
+
+    timestamp is the time at which the frame was received, in nanoseconds
+    since the epoch, if the adapter provides it.
     """
 
+    # Frames are created for every message on the bus, slots make them
+    # smaller and faster to build
+    __slots__ = (
+        "id",
+        "data",
+        "data_length",
+        "transmission_request",
+        "extended",
+        "timestamp",
+    )
+
     def __init__(
-        self, id=0, data=None, extended=False, transmission_request=False, data_length=0
+        self,
+        id=0,
+        data=None,
+        extended=False,
+        transmission_request=False,
+        data_length=0,
+        timestamp=None,
     ):
-
         if data is None:
             data = bytes()
-
-        if len(data) > 8:
+        elif len(data) > 8:
             raise ValueError
 
         self.id = id
-
         self.data = data
-        self.data_length = data_length
-
-        if len(self.data) > 0:
-            self.data_length = len(self.data)
-
+        self.data_length = len(data) or data_length
         self.transmission_request = transmission_request
         self.extended = extended
+        self.timestamp = timestamp
 
     def __eq__(self, other):
         return self.id == other.id and self.data == other.data
@@ -1,12 +1,29 @@
+import atexit
+import logging
+import os
+from queue import Queue, Empty
 import struct
+import threading
+import time
+
+from .frame import Frame
 
 # See https://wiki.wireshark.org/Development/LibpcapFileFormat
 PCAP_HDR_FORMAT = "=LHHlLLL"
 PCAP_PKT_HDR_FMT = "=4L"
 SOCKETCAN_HDR_FMT = "!LBxxx"
 
+PCAP_HDR_SIZE = struct.calcsize(PCAP_HDR_FORMAT)
 
-def write_header(outfile):
+# Nanoseconds per timestamp unit, for each magic number
+PCAP_MAGIC_RESOLUTION = {0xA1B2C3D4: 1000, 0xA1B23C4D: 1}
+
+# Packet headers are written for every frame, so their codecs are compiled once
+PCAP_PKT_HDR = struct.Struct(PCAP_PKT_HDR_FMT)
+SOCKETCAN_HDR = struct.Struct(SOCKETCAN_HDR_FMT)
+
+
+def encode_header():
     magic = 0xA1B2C3D4
     ver_maj, ver_min = 2, 4
     thiszone = 0
@@ -14,24 +31,30 @@ def write_header(outfile):
     snaplen = 65535
     network = 227  # SocketCAN
 
-    hdr = struct.pack(
+    return struct.pack(
         PCAP_HDR_FORMAT, magic, ver_maj, ver_min, thiszone, sigfigs, snaplen, network
     )
-    outfile.write(hdr)
 
 
-def _write_packet_header(outfile, timestamp, packet_length):
-    # ts_sec, ts_usec = int(timestamp), int(1000000 *
+def write_header(outfile):
+    outfile.write(encode_header())
+
+
+def _encode_packet_header(timestamp, packet_length):
     ts_sec = int(timestamp)
     ts_usec = int(1000000 * (timestamp - ts_sec))
 
-    hdr = struct.pack(PCAP_PKT_HDR_FMT, ts_sec, ts_usec, packet_length, packet_length)
-    outfile.write(hdr)
+    return PCAP_PKT_HDR.pack(ts_sec, ts_usec, packet_length, packet_length)
 
 
-def write_frame(outfile, timestamp, frame):
-    _write_packet_header(outfile, timestamp, frame.data_length + 8)
+def _write_packet_header(outfile, timestamp, packet_length):
+    outfile.write(_encode_packet_header(timestamp, packet_length))
+
 
+def encode_socketcan_packet(frame):
+    """
+    Encodes the given frame as a SocketCAN packet, as stored in captures.
+    """
     # Check http://www.tcpdump.org/linktypes/LINKTYPE_CAN_SOCKETCAN.html
     id_with_flags = frame.id
 
@@ -41,5 +64,274 @@ def write_frame(outfile, timestamp, frame):
     if frame.transmission_request:
         id_with_flags |= 0x40000000
 
-    data = struct.pack(SOCKETCAN_HDR_FMT, id_with_flags, frame.data_length) + frame.data
-    outfile.write(data)
+    return SOCKETCAN_HDR.pack(id_with_flags, frame.data_length) + frame.data
+
+
+def encode_frame(timestamp, frame):
+    """
+    Encodes the given frame as a pcap record, packet header included.
+    """
+    return _encode_packet_header(
+        timestamp, frame.data_length + 8
+    ) + encode_socketcan_packet(frame)
+
+
+def write_frame(outfile, timestamp, frame):
+    outfile.write(encode_frame(timestamp, frame))
+
+
+def decode_socketcan_packet(packet, timestamp=None):
+    """
+    Decodes a SocketCAN packet, as stored in captures, into a frame.
+    """
+    id_with_flags, data_length = SOCKETCAN_HDR.unpack_from(packet)
+
+    if id_with_flags & 0x80000000:
+        can_id, extended = id_with_flags & 0x1FFFFFFF, True
+    else:
+        can_id, extended = id_with_flags & 0x7FF, False
+
+    data = bytes(packet[SOCKETCAN_HDR.size : SOCKETCAN_HDR.size + data_length])
+
+    return Frame(
+        id=can_id,
+        data=data,
+        extended=extended,
+        transmission_request=bool(id_with_flags & 0x40000000),
+        data_length=data_length,
+        timestamp=timestamp,
+    )
+
+
+def read_frames(infile):
+    """
+    Reads the frames of a legacy pcap capture, yielding them one by one with
+    their timestamp in nanoseconds.
+
+    Captures in both byte orders and with micro or nanosecond timestamps are
+    supported. Raises ValueError if the file is not a SocketCAN pcap capture.
+    """
+    header = infile.read(PCAP_HDR_SIZE)
+    if len(header) < PCAP_HDR_SIZE:
+        raise ValueError("Truncated pcap header")
+
+    for byte_order in "<>":
+        magic = struct.unpack_from(byte_order + "L", header)[0]
+        if magic in PCAP_MAGIC_RESOLUTION:
+            break
+    else:
+        raise ValueError("Not a pcap file")
+
+    resolution = PCAP_MAGIC_RESOLUTION[magic]
+    network = struct.unpack_from(byte_order + "L", header, 20)[0]
+    if network != 227:
+        raise ValueError("Not a SocketCAN capture (link type {})".format(network))
+
+    packet_header = struct.Struct(byte_order + "4L")
+
+    while True:
+        record = infile.read(packet_header.size)
+        if len(record) < packet_header.size:
+            return
+
+        ts_sec, ts_frac, incl_len, _ = packet_header.unpack(record)
+        packet = infile.read(incl_len)
+        if len(packet) < incl_len or incl_len < SOCKETCAN_HDR.size:
+            return
+
+        yield decode_socketcan_packet(
+            packet, ts_sec * 1000000000 + ts_frac * resolution
+        )
+
+
+def read_capture(infile):
+    """
+    Reads the frames of a pcap or pcapng capture, detecting its format.
+
+    infile must be a binary file opened for reading.
+    """
+    from . import pcapng
+
+    magic = infile.peek(4)[:4] if hasattr(infile, "peek") else None
+    if magic is None:
+        position = infile.tell()
+        magic = infile.read(4)
+        infile.seek(position)
+
+    if magic == struct.pack("=L", pcapng.SECTION_HEADER_BLOCK):
+        return pcapng.read_frames(infile)
+
+    return read_frames(infile)
+
+
+class PcapWriter:
+    """
+    Writes frames to a pcap file from a background thread.
+
+    write_frame only queues the frame with its timestamp, so that capturing
+    does not slow down the bus traffic. The thread encodes the queued frames
+    into a buffer, which is written to the file once it reaches buffer_size
+    bytes or every flush_interval seconds. Pending frames are written when the
+    writer is closed, which happens at the latest when the interpreter exits.
+
+    outfile is either a file object or a path. When given a path, the capture
+    can be rotated: a new file is started once the current one grew past
+    max_size bytes or is older than max_age seconds. The files are then
+    numbered, e.g. capture_00000.pcap, capture_00001.pcap and so on.
+    """
+
+    _CLOSE = object()
+
+    def __init__(
+        self,
+        outfile,
+        flush_interval=1.0,
+        buffer_size=64 * 1024,
+        max_size=None,
+        max_age=None,
+    ):
+        self.flush_interval = flush_interval
+        self.buffer_size = buffer_size
+        self.max_size = max_size
+        self.max_age = max_age
+        self.closed = False
+
+        if isinstance(outfile, str):
+            self.path = outfile
+            self.index = 0
+            self.outfile = None
+            self._open()
+        elif max_size or max_age:
+            raise ValueError("Rotating a capture requires a path")
+        else:
+            self.path = None
+            self.outfile = outfile
+            self._start_file()
+
+        self.queue = Queue()
+        self.thread = threading.Thread(target=self.spin)
+        self.thread.daemon = True
+        self.thread.start()
+
+        atexit.register(self.close)
+
+    def file_header(self):
+        """
+        Returns the bytes starting each capture file.
+        """
+        return encode_header()
+
+    def encode(self, timestamp, frame):
+        """
+        Encodes a frame timestamped in nanoseconds.
+        """
+        ts_sec, ts_nsec = divmod(timestamp, 1000000000)
+        packet = encode_socketcan_packet(frame)
+        header = PCAP_PKT_HDR.pack(ts_sec, ts_nsec // 1000, len(packet), len(packet))
+        return header + packet
+
+    def write_frame(self, timestamp, frame):
+        """
+        Queues the given frame, timestamp being an integer number of
+        nanoseconds since the epoch (see time.time_ns).
+        """
+        self.queue.put((timestamp, frame))
+
+    def flush(self):
+        """
+        Blocks until every frame queued so far was written to the file.
+        """
+        done = threading.Event()
+        self.queue.put(done)
+        done.wait()
+
+    def close(self):
+        """
+        Writes the pending frames and stops the writer thread. The file is
+        only closed if it was opened by the writer.
+        """
+        if self.closed:
+            return
+
+        self.closed = True
+        self.queue.put(self._CLOSE)
+        self.thread.join()
+        atexit.unregister(self.close)
+
+        if self.path:
+            self.outfile.close()
+
+    def spin(self):
+        buf = bytearray()
+        deadline = time.monotonic() + self.flush_interval
+
+        while True:
+            try:
+                item = self.queue.get(timeout=max(deadline - time.monotonic(), 0))
+            except Empty:
+                item = None
+
+            if isinstance(item, tuple):
+                try:
+                    buf += self.encode(*item)
+                except (struct.error, TypeError) as e:
+                    logging.error("Could not encode frame for pcap: {}".format(e))
+
+                if len(buf) < self.buffer_size and time.monotonic() < deadline:
+                    continue
+
+            if buf:
+                self._write(buf)
+                buf.clear()
+
+            deadline = time.monotonic() + self.flush_interval
+
+            if item is self._CLOSE:
+                return
+
+            if isinstance(item, threading.Event):
+                item.set()
+
+    def _filename(self):
+        if not (self.max_size or self.max_age):
+            return self.path
+
+        root, ext = os.path.splitext(self.path)
+        return "{}_{:05d}{}".format(root, self.index, ext)
+
+    def _open(self):
+        self.outfile = open(self._filename(), "wb")
+        self._start_file()
+
+    def _start_file(self):
+        header = self.file_header()
+        self.outfile.write(header)
+        self.header_size = self.file_size = len(header)
+        self.file_start = time.monotonic()
+
+    def _should_rotate(self):
+        # Never leave a file without any frame
+        if self.path is None or self.file_size == self.header_size:
+            return False
+
+        if self.max_size and self.file_size >= self.max_size:
+            return True
+
+        if self.max_age and time.monotonic() - self.file_start >= self.max_age:
+            return True
+
+        return False
+
+    def _write(self, data):
+        try:
+            if self._should_rotate():
+                self.outfile.close()
+                self.index += 1
+                self._open()
+
+            self.outfile.write(data)
+            self.outfile.flush()
+            self.file_size += len(data)
+        except (OSError, ValueError) as e:
+            # Losing the capture must not abort the flashing session
+            logging.error("Could not write pcap file: {}".format(e))
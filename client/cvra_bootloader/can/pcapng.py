@@ -0,0 +1,217 @@
+"""
+Writer for the pcapng capture format.
+
+Unlike legacy pcap, pcapng stores nanosecond timestamps and describes the
+capture interface. Every capture file starts with a section header block
+followed by the interface description block of the session, then contains
+one enhanced packet block per frame.
+
+See https://www.ietf.org/archive/id/draft-tuexen-opsawg-pcapng-05.html
+"""
+import struct
+import time
+
+from .pcap import PcapWriter, encode_socketcan_packet, decode_socketcan_packet
+
+SECTION_HEADER_BLOCK = 0x0A0D0D0A
+INTERFACE_DESCRIPTION_BLOCK = 0x00000001
+ENHANCED_PACKET_BLOCK = 0x00000006
+
+BYTE_ORDER_MAGIC = 0x1A2B3C4D
+LINKTYPE_CAN_SOCKETCAN = 227
+
+OPT_ENDOFOPT = 0
+OPT_COMMENT = 1
+SHB_USERAPPL = 4
+IF_NAME = 2
+IF_DESCRIPTION = 3
+IF_TSRESOL = 9
+
+BLOCK_HEADER = struct.Struct("=II")
+BLOCK_TRAILER = struct.Struct("=I")
+SECTION_HEADER = struct.Struct("=IHHq")
+INTERFACE_DESCRIPTION = struct.Struct("=HHI")
+OPTION = struct.Struct("=HH")
+
+# Enhanced packet blocks are written for every frame, so their whole header
+# (block type and length, interface, timestamp, captured and original length)
+# is packed at once
+ENHANCED_PACKET_HEADER = struct.Struct("=7I")
+
+
+def _padding(length):
+    return bytes(-length % 4)
+
+
+def encode_options(options):
+    """
+    Encodes a list of (code, value) options, value being bytes.
+    """
+    if not options:
+        return b""
+
+    encoded = bytearray()
+    for code, value in options:
+        encoded += OPTION.pack(code, len(value)) + value + _padding(len(value))
+
+    encoded += OPTION.pack(OPT_ENDOFOPT, 0)
+    return bytes(encoded)
+
+
+def encode_block(block_type, body):
+    length = BLOCK_HEADER.size + len(body) + BLOCK_TRAILER.size
+    return BLOCK_HEADER.pack(block_type, length) + body + BLOCK_TRAILER.pack(length)
+
+
+def encode_section_header(application="cvra_bootloader"):
+    # A section length of -1 means that it is not specified
+    body = SECTION_HEADER.pack(BYTE_ORDER_MAGIC, 1, 0, -1)
+    body += encode_options([(SHB_USERAPPL, application.encode())])
+    return encode_block(SECTION_HEADER_BLOCK, body)
+
+
+def encode_interface_description(name=None, description=None, snaplen=65535):
+    """
+    Encodes the description of a SocketCAN interface with nanosecond
+    timestamps.
+    """
+    options = [(IF_TSRESOL, bytes([9]))]
+
+    if name:
+        options.append((IF_NAME, name.encode()))
+
+    if description:
+        options.append((IF_DESCRIPTION, description.encode()))
+
+    body = INTERFACE_DESCRIPTION.pack(LINKTYPE_CAN_SOCKETCAN, 0, snaplen)
+    body += encode_options(options)
+    return encode_block(INTERFACE_DESCRIPTION_BLOCK, body)
+
+
+def encode_enhanced_packet(timestamp, frame, interface_id=0):
+    """
+    Encodes the given frame, timestamp being in nanoseconds since the epoch.
+    """
+    packet = encode_socketcan_packet(frame)
+    padding = _padding(len(packet))
+    length = ENHANCED_PACKET_HEADER.size + len(packet) + len(padding) + 4
+
+    header = ENHANCED_PACKET_HEADER.pack(
+        ENHANCED_PACKET_BLOCK,
+        length,
+        interface_id,
+        timestamp >> 32,
+        timestamp & 0xFFFFFFFF,
+        len(packet),
+        len(packet),
+    )
+
+    return header + packet + padding + BLOCK_TRAILER.pack(length)
+
+
+def _timestamp_resolution(options):
+    """
+    Returns the number of timestamp units per second from the options of an
+    interface description, microseconds being the default.
+
+    It is kept as an integer, as epoch timestamps in nanoseconds do not fit
+    in the mantissa of a float.
+    """
+    resolution = options.get(IF_TSRESOL, bytes([6]))[0]
+
+    if resolution & 0x80:
+        return 1 << (resolution & 0x7F)
+
+    return 10**resolution
+
+
+def decode_options(data, byte_order):
+    options = dict()
+    option = struct.Struct(byte_order + "HH")
+
+    while len(data) >= option.size:
+        code, length = option.unpack_from(data)
+        if code == OPT_ENDOFOPT:
+            break
+
+        options[code] = bytes(data[option.size : option.size + length])
+        data = data[option.size + length + (-length % 4) :]
+
+    return options
+
+
+def read_frames(infile):
+    """
+    Reads the frames of a pcapng capture, yielding them one by one with their
+    timestamp in nanoseconds.
+
+    Blocks are read one at a time, so that captures of any size can be read
+    in constant memory. Packets of non SocketCAN interfaces are skipped.
+    """
+    byte_order = "="
+    interfaces = []
+
+    while True:
+        header = infile.read(BLOCK_HEADER.size)
+        if len(header) < BLOCK_HEADER.size:
+            return
+
+        block_type = struct.unpack_from("=I", header)[0]
+
+        if block_type == SECTION_HEADER_BLOCK:
+            # The byte order of a section is given by its first block
+            magic = infile.read(4)
+            byte_order = "<" if magic == struct.pack("<I", BYTE_ORDER_MAGIC) else ">"
+            length = struct.unpack_from(byte_order + "I", header, 4)[0]
+            body = magic + infile.read(length - BLOCK_HEADER.size - 4)
+            interfaces = []
+        else:
+            length = struct.unpack_from(byte_order + "I", header, 4)[0]
+            body = infile.read(length - BLOCK_HEADER.size)
+
+        if len(body) < length - BLOCK_HEADER.size:
+            return
+
+        if block_type == INTERFACE_DESCRIPTION_BLOCK:
+            linktype = struct.unpack_from(byte_order + "H", body)[0]
+            options = decode_options(body[8:-4], byte_order)
+            interfaces.append((linktype, _timestamp_resolution(options)))
+
+        elif block_type == ENHANCED_PACKET_BLOCK:
+            interface, high, low, caplen = struct.unpack_from(byte_order + "4I", body)
+            linktype, resolution = interfaces[interface]
+
+            if linktype != LINKTYPE_CAN_SOCKETCAN:
+                continue
+
+            timestamp = (high << 32) + low
+            if resolution != 10**9:
+                timestamp = timestamp * 10**9 // resolution
+
+            yield decode_socketcan_packet(body[20 : 20 + caplen], timestamp)
+
+
+class PcapngWriter(PcapWriter):
+    """
+    Writes frames to pcapng files from a background thread, see PcapWriter.
+
+    interface is the name of the captured interface (e.g. can0). Each file
+    of the session starts with the same interface description, which records
+    when the session started.
+    """
+
+    def __init__(self, outfile, interface=None, **kwargs):
+        self.interface = interface
+        self.description = "Bootloader session started at {}".format(
+            time.strftime("%Y-%m-%dT%H:%M:%S%z")
+        )
+
+        super(PcapngWriter, self).__init__(outfile, **kwargs)
+
+    def file_header(self):
+        return encode_section_header() + encode_interface_description(
+            self.interface, self.description
+        )
+
+    def encode(self, timestamp, frame):
+        return encode_enhanced_packet(timestamp, frame)
@@ -0,0 +1,446 @@
+"""
+Simulated CAN bus populated with bootloader nodes.
+
+The bus exposes the same send_frame/receive_frame interface as the real
+adapters, so the client can be tested and benchmarked without hardware. Each
+node reproduces the behaviour of the firmware (bootloader.c and command.c):
+datagram reassembly, command set, device class checks, config and flash.
+
+Time is simulated: the bus keeps its own clock, advanced by the frames sent
+on it, by the time the nodes take to execute commands and by read timeouts.
+In realtime mode the bus additionally sleeps to keep up with wall clock time.
+"""
+from collections import deque
+import heapq
+import random
+import time
+from zlib import crc32
+
+import msgpack
+
+from cvra_bootloader import compression
+from cvra_bootloader.commands import COMMAND_SET_VERSION, CommandType
+from .datagram import *
+
+# Depth of the receive FIFO of the bxCAN peripheral
+RX_FIFO_DEPTH = 3
+
+
+class SimulatedNode:
+    """
+    A single board running the bootloader.
+
+    The application flash region starts at app_address and is app_size bytes
+    long. It is only allocated page by page as it gets written to. Command
+    durations are given in seconds.
+    """
+
+    def __init__(
+        self,
+        id,
+        device_class="CVRA.dummy.v1",
+        name="foobar2000",
+        app_address=0x1000,
+        app_size=256 * 1024,
+        page_size=2048,
+        erase_time=0.02,
+        write_time_per_byte=25e-6,
+        crc_time_per_byte=50e-9,
+        command_time=100e-6,
+    ):
+        if not 1 <= id <= 127:
+            raise ValueError("Node IDs range from 1 to 127")
+
+        self.config = {
+            "ID": id,
+            "name": name,
+            "device_class": device_class,
+            "application_crc": 0xDEADC0DE,
+            "application_size": 0,
+            "update_count": 1,
+        }
+        self.saved_config = dict(self.config)
+
+        self.app_address = app_address
+        self.app_size = app_size
+        self.page_size = page_size
+        self.pages = dict()
+
+        self.erase_time = erase_time
+        self.write_time_per_byte = write_time_per_byte
+        self.crc_time_per_byte = crc_time_per_byte
+        self.command_time = command_time
+
+        self.running_application = False
+        self.busy_until = 0.0
+        self.rx_fifo = deque()
+        self.overruns = 0
+        self.reader = None
+
+        self.handlers = {
+            CommandType.JumpToMain: self.jump_to_application,
+            CommandType.CRCReginon: self.crc_region,
+            CommandType.Erase: self.erase_flash_page,
+            CommandType.Write: self.write_flash,
+            CommandType.Ping: self.ping,
+            CommandType.Read: self.read_flash,
+            CommandType.UpdateConfig: self.config_update,
+            CommandType.SaveConfig: self.config_write_to_flash,
+            CommandType.ReadConfig: self.config_read,
+            CommandType.WriteCompressed: self.write_flash_compressed,
+        }
+
+    @property
+    def id(self):
+        return self.config["ID"]
+
+    def read_memory(self, address, length):
+        """
+        Returns the content of the flash at the given address. Pages which were
+        never written read as erased (0xFF).
+        """
+        data = bytearray(b"\xff" * length)
+
+        for page_index in range(
+            (address - self.app_address) // self.page_size,
+            (address + length - self.app_address - 1) // self.page_size + 1,
+        ):
+            page = self.pages.get(page_index)
+            if page is None:
+                continue
+
+            page_address = self.app_address + page_index * self.page_size
+            start = max(address, page_address)
+            end = min(address + length, page_address + self.page_size)
+            data[start - address : end - address] = page[
+                start - page_address : end - page_address
+            ]
+
+        return bytes(data)
+
+    def receive(self, frame, t):
+        """
+        Receives a frame from the bus at the given time.
+
+        Returns a list of (time, frames) tuples, one for each answer.
+        """
+        answers = self.process_fifo(t)
+
+        if self.busy_until > t:
+            # The bootloader does not read the bus while executing a command
+            if len(self.rx_fifo) < RX_FIFO_DEPTH:
+                self.rx_fifo.append(frame)
+            else:
+                self.overruns += 1
+        else:
+            answers += self.input_frame(frame, t)
+
+        return answers
+
+    def process_fifo(self, t):
+        """
+        Processes the frames which were queued while the node was busy, up to
+        the given time.
+        """
+        answers = []
+        while self.rx_fifo and self.busy_until <= t:
+            answers += self.input_frame(self.rx_fifo.popleft(), self.busy_until)
+        return answers
+
+    def input_frame(self, frame, t):
+        if self.running_application or frame.extended:
+            return []
+
+        if is_start_of_datagram(frame):
+            self.reader = DatagramReader()
+        elif self.reader is None:
+            return []
+
+        try:
+            datagram = self.reader.input_bytes(frame.data)
+        except (VersionMismatchError, CRCMismatchError):
+            self.reader = None
+            return []
+
+        if datagram is None:
+            return []
+
+        self.reader = None
+        data, destinations = datagram
+
+        if self.id not in destinations:
+            return []
+
+        answer, duration = self.execute_command(data)
+        self.busy_until = t + duration
+
+        if answer is None:
+            return []
+
+        return_id = frame.id & ~START_OF_DATAGRAM_MASK
+        answer = encode_datagram(answer, [return_id])
+        return [(self.busy_until, list(datagram_to_frames(answer, self.id)))]
+
+    def execute_command(self, data):
+        """
+        Executes the given command and returns a tuple containing the encoded
+        answer (None if there is none) and the time it took.
+        """
+        unpacker = msgpack.Unpacker(raw=False)
+        unpacker.feed(data)
+
+        try:
+            version = next(unpacker)
+            index = next(unpacker)
+            args = next(unpacker, [])
+        except (StopIteration, ValueError):
+            return None, self.command_time
+
+        if version != COMMAND_SET_VERSION or index not in self.handlers:
+            return None, self.command_time
+
+        try:
+            answer, duration = self.handlers[index](*args)
+        except (TypeError, ValueError):
+            return None, self.command_time
+        if answer is not None:
+            answer = msgpack.packb(answer, use_bin_type=True)
+
+        return answer, self.command_time + duration
+
+    def in_app_region(self, address):
+        return self.app_address <= address < self.app_address + self.app_size
+
+    def jump_to_application(self, *args):
+        size = self.config["application_size"]
+        if (
+            crc32(self.read_memory(self.app_address, size))
+            == self.config["application_crc"]
+        ):
+            self.running_application = True
+        return None, 0
+
+    def crc_region(self, address, length):
+        crc = crc32(self.read_memory(address, length))
+        return crc, length * self.crc_time_per_byte
+
+    def erase_flash_page(self, address, device_class):
+        if not self.in_app_region(address):
+            return False, 0
+
+        if device_class != self.config["device_class"]:
+            return False, 0
+
+        page_index = (address - self.app_address) // self.page_size
+        self.pages[page_index] = bytearray(b"\xff" * self.page_size)
+        return True, self.erase_time
+
+    def write_flash(self, address, device_class, data):
+        if not self.in_app_region(address):
+            return False, 0
+
+        if device_class != self.config["device_class"]:
+            return False, 0
+
+        offset = 0
+        while offset < len(data):
+            page_index, page_offset = divmod(
+                address + offset - self.app_address, self.page_size
+            )
+            page = self.pages.setdefault(
+                page_index, bytearray(b"\xff" * self.page_size)
+            )
+            chunk = data[offset : offset + self.page_size - page_offset]
+            end = page_offset + len(chunk)
+
+            # Programming flash can only clear bits
+            old = int.from_bytes(page[page_offset:end], "big")
+            new = old & int.from_bytes(chunk, "big")
+            page[page_offset:end] = new.to_bytes(len(chunk), "big")
+
+            offset += len(chunk)
+
+        return True, len(data) * self.write_time_per_byte
+
+    def write_flash_compressed(self, address, device_class, size, data):
+        # The bootloader decompresses the data in a buffer of one page
+        try:
+            data = compression.decompress(data, min(size, self.page_size))
+        except ValueError:
+            return False, 0
+
+        if len(data) != size:
+            return False, 0
+
+        return self.write_flash(address, device_class, data)
+
+    def ping(self, *args):
+        return True, 0
+
+    def read_flash(self, address, length):
+        return self.read_memory(address, length), 0
+
+    def config_update(self, config):
+        for key, value in config.items():
+            if key in self.config:
+                self.config[key] = value
+        return True, 0
+
+    def config_write_to_flash(self, *args):
+        self.config["update_count"] += 1
+        self.saved_config = dict(self.config)
+        return True, 2 * self.erase_time
+
+    def config_read(self, *args):
+        return dict(self.config), 0
+
+
+class SimulatedBus:
+    """
+    Simulated CAN bus, used as a connection by the client.
+
+    Each frame sent by the client or by a node occupies the bus for a time
+    computed from the bitrate. Every node independently loses each frame it
+    should receive with the given probability.
+
+    The answers of the nodes wait in a queue until the time they are sent at,
+    and only then take the bus, so that a board answering late does not hold
+    the bus meanwhile.
+    """
+
+    # Frame overhead (arbitration, control, CRC, ack, EOF and interframe
+    # space) and approximate bit stuffing ratio
+    FRAME_OVERHEAD_BITS = 47
+    BIT_STUFFING = 1.2
+
+    def __init__(
+        self,
+        nodes=(),
+        bitrate=1000000,
+        loss=0.0,
+        read_timeout=0.5,
+        realtime=False,
+        seed=None,
+    ):
+        self.nodes = list(nodes)
+        self.bitrate = bitrate
+        self.loss = loss
+        self.read_timeout = read_timeout
+        self.realtime = realtime
+        self.random = random.Random(seed)
+
+        self.time = 0.0
+        self.bus_free = 0.0
+        # Frames waiting for the bus, and frames transmitted but not read by
+        # the client yet, ordered by time
+        self.queued = []
+        self.pending = []
+        self.sequence = 0
+        self.start = time.monotonic()
+
+        self.stats = {
+            "frames_sent": 0,
+            "frames_received": 0,
+            "frames_lost": 0,
+            "bus_busy_time": 0.0,
+        }
+
+    def add_node(self, node):
+        self.nodes.append(node)
+
+    def frame_time(self, frame):
+        bits = self.FRAME_OVERHEAD_BITS + 8 * len(frame.data)
+        return bits * self.BIT_STUFFING / self.bitrate
+
+    def _transmit(self, frame, t):
+        """
+        Puts the frame on the bus as soon as possible after the given time and
+        returns the time at which its transmission ends.
+        """
+        duration = self.frame_time(frame)
+        start = max(t, self.bus_free)
+        self.bus_free = start + duration
+        self.stats["bus_busy_time"] += duration
+        return self.bus_free
+
+    def _schedule(self, answers):
+        for t, frames in answers:
+            for frame in frames:
+                heapq.heappush(self.queued, (t, self.sequence, frame))
+                self.sequence += 1
+
+    def _transmit_queued(self, t):
+        """
+        Transmits the queued answers which are ready to be sent at the given
+        time.
+        """
+        while self.queued and self.queued[0][0] <= t:
+            ready, sequence, frame = heapq.heappop(self.queued)
+            end = self._transmit(frame, ready)
+
+            if self.loss and self.random.random() < self.loss:
+                self.stats["frames_lost"] += 1
+                continue
+
+            heapq.heappush(self.pending, (end, sequence, frame))
+
+    def send_frame(self, frame):
+        # Answers waiting for the bus go first
+        self._transmit_queued(max(self.time, self.bus_free))
+        end = self._transmit(frame, self.time)
+        self.stats["frames_sent"] += 1
+
+        for node in self.nodes:
+            if self.loss and self.random.random() < self.loss:
+                self.stats["frames_lost"] += 1
+                continue
+
+            self._schedule(node.receive(frame, end))
+
+    def send_frames(self, frames):
+        for frame in frames:
+            self.send_frame(frame)
+
+    def receive_frame(self):
+        deadline = self.time + self.read_timeout
+
+        for node in self.nodes:
+            self._schedule(node.process_fifo(deadline))
+
+        # Only the answers sent before the next frame is read can take the
+        # bus, the client may send commands in between
+        while self.queued:
+            limit = min(deadline, self.pending[0][0]) if self.pending else deadline
+            if self.queued[0][0] > limit:
+                break
+            self._transmit_queued(self.queued[0][0])
+
+        if not self.pending or self.pending[0][0] > deadline:
+            self._advance(deadline)
+            return None
+
+        t, _, frame = heapq.heappop(self.pending)
+        self._advance(max(self.time, t))
+        self.stats["frames_received"] += 1
+        return frame
+
+    def _advance(self, t):
+        self.time = t
+
+        if self.realtime:
+            delay = self.start + t - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+
+
+def simulated_fleet(
+    ids, bitrate=1000000, loss=0.0, read_timeout=0.5, seed=None, **kwargs
+):
+    """
+    Returns a simulated bus populated with one node per given ID. Extra
+    keyword arguments are passed to each SimulatedNode.
+    """
+    nodes = [SimulatedNode(id, **kwargs) for id in ids]
+    return SimulatedBus(
+        nodes, bitrate=bitrate, loss=loss, read_timeout=read_timeout, seed=seed
+    )
@@ -0,0 +1,92 @@
+"""
+Codec for the slcan (Lawicel) serial protocol, working directly on bytes.
+"""
+from .frame import Frame
+
+MIN_MSG_LEN = len(b"t1230")
+
+
+def encode_frame(frame):
+    """
+    Encodes the given frame into a slcan transmit command, without the
+    trailing carriage return.
+    """
+    if frame.extended:
+        header = b"T%08x%x" % (frame.id, frame.data_length)
+    else:
+        header = b"t%03x%x" % (frame.id, frame.data_length)
+
+    return header + bytes(frame.data).hex().encode("ascii")
+
+
+def decode_frame(msg):
+    """
+    Decodes a single slcan message (without the trailing carriage return).
+
+    Returns None if the message is not a valid received frame.
+    """
+    if len(msg) < MIN_MSG_LEN:
+        return None
+
+    cmd = msg[0]
+    if cmd == ord("T"):
+        extended = True
+        id_len = 8
+    elif cmd == ord("t"):
+        extended = False
+        id_len = 3
+    else:
+        return None
+
+    try:
+        can_id = int(msg[1 : 1 + id_len], 16)
+        data_len = int(msg[1 + id_len : 2 + id_len], 16)
+        data = bytes.fromhex(msg[2 + id_len : 2 + id_len + 2 * data_len].decode())
+    except ValueError:
+        return None
+
+    if len(data) != data_len or data_len > 8:
+        return None
+
+    return Frame(id=can_id, data=data, data_length=data_len, extended=extended)
+
+
+class StreamDecoder:
+    """
+    Splits the byte stream coming from a slcan adapter into frames.
+
+    Incoming bytes are accumulated in a buffer which is only scanned once for
+    message separators.
+    """
+
+    def __init__(self):
+        self.buf = bytearray()
+        self.scan_pos = 0
+
+    def feed(self, data):
+        """
+        Adds the given bytes to the stream and returns the list of frames
+        which were completed.
+        """
+        self.buf += data
+        frames = []
+        start = 0
+
+        while True:
+            end = self.buf.find(b"\r", self.scan_pos)
+            if end < 0:
+                break
+
+            # Error bells are not terminated by a carriage return
+            frame = decode_frame(self.buf[start:end].lstrip(b"\a"))
+            if frame:
+                frames.append(frame)
+
+            start = self.scan_pos = end + 1
+
+        if start:
+            del self.buf[:start]
+
+        self.scan_pos = len(self.buf)
+
+        return frames
@@ -3,7 +3,9 @@ from cvra_bootloader import commands, utils
 
 
 def parse_commandline_args():
-    parser = utils.ConnectionArgumentParser(description="Change a single node ID.")
+    parser = utils.ConnectionArgumentParser(
+        description="Change a single node ID.", buses=False
+    )
     parser.add_argument("old", type=int, help="Old device ID")
     parser.add_argument("new", type=int, help="New device ID")
 
@@ -14,9 +16,13 @@ def main():
     args = parse_commandline_args()
     connection = utils.open_connection(args)
 
+    # The board answers with its new ID
     config = {"ID": args.new}
     utils.write_command_retry(
-        connection, commands.encode_update_config(config), [args.old]
+        connection,
+        commands.encode_update_config(config),
+        [args.old],
+        answer_ids=[args.new],
     )
     utils.write_command_retry(connection, commands.encode_save_config(), [args.new])
 
@@ -1,5 +1,7 @@
 from msgpack import Packer
 
+from cvra_bootloader import compression
+
 COMMAND_SET_VERSION = 2
 
 
@@ -13,6 +15,7 @@ class CommandType:
     UpdateConfig = 7
     SaveConfig = 8
     ReadConfig = 9
+    WriteCompressed = 10
 
 
 def encode_command(command_code, *arguments):
@@ -46,7 +49,50 @@ def encode_write_flash(data, address, device_class):
     return encode_command(CommandType.Write, address, device_class, data)
 
 
-def encode_read_flash(aderess, length):
+def encode_write_flash_compressed(data, address, device_class):
+    """
+    Encodes the command to write the given data at the given address,
+    compressed. The bootloader decompresses it in its output buffer, so the
+    data is at most compression.MAX_BLOCK_SIZE bytes long.
+    """
+    if len(data) > compression.MAX_BLOCK_SIZE:
+        raise ValueError(
+            "Compressed writes are limited to {} bytes".format(
+                compression.MAX_BLOCK_SIZE
+            )
+        )
+
+    compressed = compression.compress(data)
+    return encode_command(
+        CommandType.WriteCompressed, address, device_class, len(data), compressed
+    )
+
+
+def encode_page_writes(data, address, device_class, compress=False):
+    """
+    Returns the list of commands writing the given data at the given address.
+
+    If compress is true, the data is split in blocks which are sent
+    compressed, unless a single plain write command is shorter.
+    """
+    command = encode_write_flash(data, address, device_class)
+
+    if compress:
+        block = compression.MAX_BLOCK_SIZE
+        compressed = [
+            encode_write_flash_compressed(
+                data[offset : offset + block], address + offset, device_class
+            )
+            for offset in range(0, len(data), block)
+        ]
+
+        if sum(len(c) for c in compressed) < len(command):
+            return compressed
+
+    return [command]
+
+
+def encode_read_flash(address, length):
     """
     Encodes the command to read the flash at given address.
     """
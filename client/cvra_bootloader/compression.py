@@ -0,0 +1,159 @@
+"""
+LZ4 block compression of the data written to flash.
+
+CAN frames only carry 8 bytes of payload, so the bus bandwidth limits the
+flash speed. Firmware images compress well, and the bootloader can decompress
+data written with the compressed write command (see lz4_block.c) in RAM before
+writing it to flash.
+
+Data is compressed in the LZ4 block format, without the frame format around
+it. The compressor is a simple greedy one, which keeps the end of block rules
+of the format so that any LZ4 decoder can read its output.
+"""
+
+# Largest block decompressed by the bootloader. It decompresses in its output
+# buffer, which holds a flash page, and the smallest page is 1 kB (STM32F1).
+MAX_BLOCK_SIZE = 1024
+
+MIN_MATCH = 4
+MAX_OFFSET = 0xFFFF
+
+# The last match must start 12 bytes before the end of the block, and the
+# block must end with at least 5 literals.
+MF_LIMIT = 12
+LAST_LITERALS = 5
+
+
+def _write_length(out, length):
+    """
+    Appends the extra bytes of a length which did not fit in its token.
+    """
+    while length >= 255:
+        out.append(255)
+        length -= 255
+    out.append(length)
+
+
+def _write_sequence(out, literals, offset=0, match_length=0):
+    literal_length = len(literals)
+    match_length = match_length - MIN_MATCH if offset else 0
+
+    out.append((min(literal_length, 15) << 4) | min(match_length, 15))
+
+    if literal_length >= 15:
+        _write_length(out, literal_length - 15)
+
+    out += literals
+
+    if offset:
+        out += offset.to_bytes(2, "little")
+
+        if match_length >= 15:
+            _write_length(out, match_length - 15)
+
+
+def compress(data):
+    """
+    Returns the given data compressed as a single LZ4 block.
+    """
+    data = bytes(data)
+    out = bytearray()
+
+    # Last position of every 4 bytes sequence
+    positions = dict()
+    anchor, i = 0, 0
+    match_limit = len(data) - LAST_LITERALS
+
+    while i <= len(data) - MF_LIMIT:
+        sequence = data[i : i + MIN_MATCH]
+        candidate = positions.get(sequence)
+        positions[sequence] = i
+
+        if candidate is None or i - candidate > MAX_OFFSET:
+            i += 1
+            continue
+
+        length = MIN_MATCH
+        while i + length < match_limit and data[candidate + length] == data[i + length]:
+            length += 1
+
+        _write_sequence(out, data[anchor:i], i - candidate, length)
+        i += length
+        anchor = i
+
+    _write_sequence(out, data[anchor:])
+
+    return bytes(out)
+
+
+def _read_length(data, position):
+    """
+    Returns the extra length starting at position and the position after it.
+    """
+    length = 0
+
+    while True:
+        if position >= len(data):
+            raise ValueError("Truncated length")
+
+        byte = data[position]
+        position += 1
+        length += byte
+
+        if byte != 255:
+            return length, position
+
+
+def decompress(data, max_size):
+    """
+    Returns the decompressed content of the given LZ4 block, like the
+    bootloader does.
+
+    Raises ValueError if the block is invalid or decompresses to more than
+    max_size bytes.
+    """
+    out = bytearray()
+    position = 0
+
+    while position < len(data):
+        token = data[position]
+        position += 1
+
+        length = token >> 4
+        if length == 15:
+            extra, position = _read_length(data, position)
+            length += extra
+
+        if position + length > len(data) or len(out) + length > max_size:
+            raise ValueError("Literals do not fit")
+
+        out += data[position : position + length]
+        position += length
+
+        # The last sequence only has literals
+        if position == len(data):
+            break
+
+        if position + 2 > len(data):
+            raise ValueError("Truncated match offset")
+
+        offset = int.from_bytes(data[position : position + 2], "little")
+        position += 2
+
+        if offset == 0 or offset > len(out):
+            raise ValueError("Invalid match offset {}".format(offset))
+
+        length = token & 0x0F
+        if length == 15:
+            extra, position = _read_length(data, position)
+            length += extra
+        length += MIN_MATCH
+
+        if len(out) + length > max_size:
+            raise ValueError("Match does not fit")
+
+        # Matches can overlap their output, e.g. to repeat a single byte
+        for _ in range(length):
+            out.append(out[-offset])
+
+    return bytes(out)
@@ -0,0 +1,239 @@
+"""
+Firmware file loaders.
+
+Besides raw binaries, ELF files and Intel HEX files are supported. Those give
+the address of their data, so they do not need a base address, and may
+contain large gaps between their segments (e.g. a table at the end of the
+flash). They are loaded as a sparse list of spans holding data, so that the
+flash tool only writes real data and only erases the pages of the gaps which
+are not blank already.
+
+The application CRC checked by the bootloader before jumping to the
+application covers the whole region from the application start, so the
+firmware is still flattened into a contiguous binary, gaps reading as erased
+flash.
+"""
+from collections import namedtuple
+import os
+import struct
+
+from cvra_bootloader import page
+
+# Segments of data to write at a given address
+Segment = namedtuple("Segment", ["address", "data"])
+
+# base_address and contiguous binary of a firmware. spans lists the (offset,
+# length) of the data it really contains, or is None for raw binaries.
+Firmware = namedtuple("Firmware", ["base_address", "binary", "spans"])
+
+ELF_MAGIC = b"\x7fELF"
+HEX_EXTENSIONS = (".hex", ".ihex")
+PT_LOAD = 1
+
+# Larger firmwares most likely have a segment loaded at its RAM address
+MAX_FIRMWARE_SIZE = 16 * 1024 * 1024
+
+
+def parse_intel_hex(text):
+    """
+    Returns the list of segments contained in the given Intel HEX file.
+
+    Raises ValueError if a record is invalid.
+    """
+    segments = []
+    base = 0
+
+    for number, line in enumerate(text.splitlines(), 1):
+        line = line.strip()
+        if not line:
+            continue
+
+        try:
+            if not line.startswith(":"):
+                raise ValueError("missing start code")
+
+            record = bytes.fromhex(line[1:])
+
+            if len(record) < 5 or len(record) != record[0] + 5:
+                raise ValueError("invalid length")
+
+            if sum(record) & 0xFF:
+                raise ValueError("invalid checksum")
+        except ValueError as e:
+            raise ValueError("Line {}: {}".format(number, e))
+
+        length, address, kind = record[0], (record[1] << 8) | record[2], record[3]
+        data = record[4 : 4 + length]
+
+        if kind == 0x00:
+            segments.append(Segment(base + address, data))
+        elif kind == 0x01:
+            break
+        elif kind == 0x02:
+            base = int.from_bytes(data, "big") << 4
+        elif kind == 0x04:
+            base = int.from_bytes(data, "big") << 16
+
+        # Start address records (0x03 and 0x05) are not needed to flash
+
+    return merge_segments(segments)
+
+
+def parse_elf(data):
+    """
+    Returns the list of segments loaded from the given ELF file, at their
+    physical (load) address.
+
+    Raises ValueError if the file is not a valid ELF file.
+    """
+    if data[:4] != ELF_MAGIC or len(data) < 16:
+        raise ValueError("Not an ELF file")
+
+    elf_class, encoding = data[4], data[5]
+
+    if elf_class not in (1, 2) or encoding not in (1, 2):
+        raise ValueError("Unsupported ELF class or encoding")
+
+    endian = "<" if encoding == 1 else ">"
+
+    if elf_class == 1:
+        file_header = struct.Struct(endian + "28xI10xHH")
+        program_header = struct.Struct(endian + "IIIIIIII")
+    else:
+        file_header = struct.Struct(endian + "32xQ14xHH")
+        program_header = struct.Struct(endian + "IIQQQQQQ")
+
+    try:
+        phoff, phentsize, phnum = file_header.unpack_from(data)
+    except struct.error:
+        raise ValueError("Truncated ELF header")
+
+    segments = []
+
+    for index in range(phnum):
+        try:
+            header = program_header.unpack_from(data, phoff + index * phentsize)
+        except struct.error:
+            raise ValueError("Truncated program header")
+
+        if elf_class == 1:
+            kind, offset, _, paddr, filesz = header[:5]
+        else:
+            kind, _, offset, _, paddr, filesz = header[:6]
+
+        if kind != PT_LOAD or filesz == 0:
+            continue
+
+        if offset + filesz > len(data):
+            raise ValueError("Truncated segment")
+
+        segments.append(Segment(paddr, data[offset : offset + filesz]))
+
+    return merge_segments(segments)
+
+
+def merge_segments(segments):
+    """
+    Sorts the segments by address and merges the contiguous ones.
+
+    Raises ValueError if segments overlap.
+    """
+    merged = []
+
+    for segment in sorted(segments, key=lambda s: s.address):
+        if merged:
+            last = merged[-1]
+            end = last.address + len(last.data)
+
+            if segment.address < end:
+                raise ValueError("Segments overlap at {:#x}".format(segment.address))
+
+            if segment.address == end:
+                merged[-1] = Segment(last.address, last.data + segment.data)
+                continue
+
+        merged.append(Segment(segment.address, bytes(segment.data)))
+
+    return merged
+
+
+def flatten(segments, base_address=None):
+    """
+    Returns the Firmware made of the given segments, starting at base_address
+    (default: the first segment) with the gaps filled with erased bytes.
+    """
+    if not segments:
+        raise ValueError("The firmware is empty")
+
+    if base_address is None:
+        base_address = segments[0].address
+
+    if segments[0].address < base_address:
+        raise ValueError(
+            "The firmware starts at {:#x}, below the base address {:#x}".format(
+                segments[0].address, base_address
+            )
+        )
+
+    end = segments[-1].address + len(segments[-1].data)
+
+    if end - base_address > MAX_FIRMWARE_SIZE:
+        raise ValueError(
+            "The firmware spans {:#x} to {:#x}, is a segment linked in RAM?".format(
+                base_address, end
+            )
+        )
+
+    binary = bytearray([page.ERASED_BYTE]) * (end - base_address)
+    spans = []
+
+    for segment in segments:
+        offset = segment.address - base_address
+        binary[offset : offset + len(segment.data)] = segment.data
+        spans.append((offset, len(segment.data)))
+
+    return Firmware(base_address, bytes(binary), tuple(spans))
+
+
+def load_firmware(path, base_address=None):
+    """
+    Loads the firmware at the given path, which is either an ELF file, an
+    Intel HEX file (.hex or .ihex) or a raw binary, for which base_address is
+    required.
+
+    Raises ValueError if the file is invalid.
+    """
+    with open(path, "rb") as f:
+        data = f.read()
+
+    if data.startswith(ELF_MAGIC):
+        return flatten(parse_elf(data), base_address)
+
+    if os.path.splitext(path)[1].lower() in HEX_EXTENSIONS:
+        try:
+            text = data.decode("ascii")
+        except UnicodeDecodeError:
+            raise ValueError("Invalid Intel HEX file")
+
+        return flatten(parse_intel_hex(text), base_address)
+
+    if base_address is None:
+        raise ValueError("A base address is required for raw binaries")
+
+    return Firmware(base_address, data, None)
+
+
+def data_pages(spans, length, page_size):
+    """
+    Returns the set of the offsets of the pages holding data, all of them if
+    spans is None.
+    """
+    if spans is None:
+        return set(range(0, length, page_size))
+
+    pages = set()
+    for offset, size in spans:
+        first = offset // page_size * page_size
+        pages.update(range(first, offset + size, page_size))
+
+    return pages
@@ -0,0 +1,255 @@
+"""
+On-disk journal of flash sessions, used to resume an interrupted session.
+
+For every image being flashed (identified by a hash of its content and
+flash parameters), the journal records which pages each board already
+erased and which pages it completely wrote. It is saved as JSON along with
+the interface of the session, pages being stored as ranges of page indexes,
+e.g. "0-41,50":
+
+    {
+        "interface": "can0",
+        "images": {
+            "<sha256>": {
+                "page_size": 2048,
+                "boards": {
+                    "1": {"erased": "0-42", "written": "0-41"}
+                }
+            }
+        }
+    }
+
+The journal is only a hint: a resumed session checks the CRC of the pages it
+lists before skipping them (see bootloader_flash.resume_pages), and refuses
+to resume one recorded on another interface or with another image (see
+bootloader_flash.open_journal).
+"""
+from collections import namedtuple
+import hashlib
+import json
+import logging
+import os
+import time
+
+from cvra_bootloader import utils
+
+# Sets of the offsets of the pages erased and written on a board
+BoardPages = namedtuple("BoardPages", ["erased", "written"])
+
+
+def image_key(binary, base_address, device_class, page_size):
+    """
+    Returns the key identifying an image in the journal.
+    """
+    h = hashlib.sha256(binary)
+    h.update("{:x}:{}:{}".format(base_address, device_class, page_size).encode())
+    return h.hexdigest()
+
+
+def format_ids(ids):
+    """
+    Formats a list of integers as ranges, the inverse of utils.parse_ids.
+    """
+    ranges = []
+
+    for i in sorted(ids):
+        if ranges and ranges[-1][1] == i - 1:
+            ranges[-1][1] = i
+        else:
+            ranges.append([i, i])
+
+    return ",".join(
+        str(first) if first == last else "{}-{}".format(first, last)
+        for first, last in ranges
+    )
+
+
+class ImageJournal:
+    """
+    Progress of the boards flashing a single image, as sets of page indexes.
+    """
+
+    def __init__(self, page_size):
+        self.page_size = page_size
+        self.boards = dict()
+
+
+class FlashJournal:
+    """
+    Progress of the boards being flashed on the given interface, saved to
+    path at most every interval seconds. Pages are given by their offset in
+    the image.
+
+    recorded_interface is the interface of the session loaded by open.
+    """
+
+    def __init__(self, path, interface=None, interval=1.0, clock=time.monotonic):
+        self.path = path
+        self.interface = interface
+        self.recorded_interface = None
+        self.interval = interval
+        self.clock = clock
+        self.last_save = None
+        self.images = dict()
+
+    @classmethod
+    def open(cls, path, **kwargs):
+        """
+        Opens the journal at the given path, starting an empty one if the file
+        does not exist or is invalid.
+        """
+        journal = cls(path, **kwargs)
+
+        try:
+            with open(path) as f:
+                content = json.load(f)
+
+            for key, entry in content["images"].items():
+                image = ImageJournal(int(entry["page_size"]))
+
+                for id, pages in entry["boards"].items():
+                    image.boards[int(id)] = BoardPages(
+                        set(utils.parse_ids(pages["erased"])),
+                        set(utils.parse_ids(pages["written"])),
+                    )
+
+                journal.images[key] = image
+
+            journal.recorded_interface = content.get("interface")
+        except FileNotFoundError:
+            pass
+        except (OSError, ValueError, KeyError, TypeError, AttributeError) as e:
+            logging.warning("Ignoring invalid journal {}: {}".format(path, e))
+            journal.images = dict()
+            journal.recorded_interface = None
+
+        return journal
+
+    def boards(self):
+        """
+        Returns a dictionary mapping each board to the key of its image.
+        """
+        return {id: key for key, image in self.images.items() for id in image.boards}
+
+    def pages(self, key):
+        """
+        Returns a dictionary mapping each board of the given image to the
+        BoardPages it completed.
+        """
+        image = self.images.get(key)
+
+        if image is None:
+            return dict()
+
+        return {
+            id: BoardPages(
+                {i * image.page_size for i in pages.erased},
+                {i * image.page_size for i in pages.written},
+            )
+            for id, pages in image.boards.items()
+        }
+
+    def start(self, key, page_size, boards):
+        """
+        Starts flashing an image, boards mapping each board to the BoardPages
+        it already completed. Any progress of the boards with another image
+        is forgotten.
+        """
+        self.forget(boards, save=False)
+        image = self.images.setdefault(key, ImageJournal(page_size))
+
+        for id, pages in boards.items():
+            image.boards[id] = BoardPages(
+                {o // page_size for o in pages.erased},
+                {o // page_size for o in pages.written},
+            )
+
+        self.save()
+
+    def forget(self, ids, save=True):
+        """
+        Removes the given boards from the journal, for example once their flash
+        is complete.
+        """
+        for key, image in list(self.images.items()):
+            for id in ids:
+                image.boards.pop(id, None)
+
+            if not image.boards:
+                del self.images[key]
+
+        if save:
+            self.save()
+
+    def erased(self, key, ids, offset):
+        """
+        Records that the page at the given offset was erased on the boards.
+        """
+        image = self.images[key]
+
+        for id in ids:
+            image.boards[id].erased.add(offset // image.page_size)
+
+        self.save(force=False)
+
+    def written(self, key, ids, offset):
+        """
+        Records that the page at the given offset was completely written on
+        the boards.
+        """
+        image = self.images[key]
+
+        for id in ids:
+            image.boards[id].written.add(offset // image.page_size)
+
+        self.save(force=False)
+
+    def save(self, force=True):
+        """
+        Writes the journal to disk, unless it was saved less than interval
+        seconds ago and force is false. An empty journal removes the file.
+        """
+        now = self.clock()
+
+        if not force and self.last_save is not None:
+            if now - self.last_save < self.interval:
+                return
+
+        self.last_save = now
+
+        try:
+            self._write()
+        except OSError as e:
+            # The journal only saves time, it must never abort a flash
+            logging.warning("Cannot save journal {}: {}".format(self.path, e))
+
+    def _write(self):
+        if not self.images:
+            try:
+                os.remove(self.path)
+            except FileNotFoundError:
+                pass
+            return
+
+        content = {
+            "interface": self.interface,
+            "images": {
+                key: {
+                    "page_size": image.page_size,
+                    "boards": {
+                        str(id): {
+                            "erased": format_ids(pages.erased),
+                            "written": format_ids(pages.written),
+                        }
+                        for id, pages in image.boards.items()
+                    },
+                }
+                for key, image in self.images.items()
+            },
+        }
+
+        # Write then rename, so that a crash never leaves a truncated journal
+        tmp = self.path + ".tmp"
+        with open(tmp, "w") as f:
+            json.dump(content, f)
+        os.replace(tmp, self.path)
@@ -0,0 +1,139 @@
+"""
+Flash manifests, describing the image of every board of a robot.
+
+A manifest is a JSON file listing the images to flash and the boards
+receiving each of them:
+
+    {
+        "images": [
+            {
+                "binary": "motor.bin",
+                "base_address": "0x8003800",
+                "device_class": "CVRA.motor.v1",
+                "ids": [1, 2, 3, 4]
+            },
+            {
+                "binary": "uwb.bin",
+                "base_address": "0x8004000",
+                "device_class": "CVRA.uwb.v1",
+                "ids": "20-23",
+                "page_size": 16384
+            }
+        ]
+    }
+
+Binary paths are relative to the manifest, and can also point to ELF or
+Intel HEX files (see cvra_bootloader.firmware). The base address is either an
+integer or a hexadecimal string, and can be omitted for ELF and HEX files.
+The IDs are a list or a string of IDs and ranges. The page size is optional.
+"""
+from collections import namedtuple
+import json
+import os
+
+from cvra_bootloader import firmware, utils
+
+# spans lists the (offset, length) of the data in a sparse image, see
+# firmware.Firmware
+Image = namedtuple(
+    "Image",
+    ["binary", "base_address", "device_class", "ids", "page_size", "spans"],
+    defaults=(None,),
+)
+
+
+def parse_image(entry, directory, page_size):
+    """
+    Returns the Image described by the given manifest entry, reading its
+    binary relative to directory.
+    """
+    try:
+        path = os.path.join(directory, entry["binary"])
+        device_class = entry["device_class"]
+        ids = entry["ids"]
+    except KeyError as e:
+        raise ValueError("Image without {}".format(e))
+
+    base_address = entry.get("base_address")
+    if isinstance(base_address, str):
+        base_address = int(base_address, 16)
+
+    if isinstance(ids, str):
+        ids = utils.parse_ids(ids)
+
+    image = firmware.load_firmware(path, base_address)
+
+    return Image(
+        image.binary,
+        image.base_address,
+        device_class,
+        list(ids),
+        entry.get("page_size", page_size),
+        image.spans,
+    )
+
+
+def group_images(images):
+    """
+    Merges the images which are identical, so that their boards are flashed
+    together with multicast commands.
+
+    Raises ValueError if a board appears in several images.
+    """
+    groups = dict()
+    seen = set()
+
+    for image in images:
+        duplicates = seen.intersection(image.ids)
+        if duplicates:
+            raise ValueError(
+                "Boards {} appear several times".format(sorted(duplicates))
+            )
+        seen.update(image.ids)
+
+        key = image._replace(ids=None)
+        if key in groups:
+            groups[key] = groups[key]._replace(ids=groups[key].ids + image.ids)
+        else:
+            groups[key] = image
+
+    return list(groups.values())
+
+
+def load_manifest(path, page_size=2048):
+    """
+    Loads the manifest at the given path and returns the list of images to
+    flash, identical images being grouped. page_size is used for images
+    which do not give theirs.
+
+    Raises ValueError if the manifest is invalid.
+    """
+    with open(path) as f:
+        manifest = json.load(f)
+
+    try:
+        entries = manifest["images"]
+    except (KeyError, TypeError):
+        raise ValueError("The manifest has no images")
+
+    directory = os.path.dirname(path)
+    images = [parse_image(e, directory, page_size) for e in entries]
+
+    return group_images(images)
+
+
+def select_boards(images, ids):
+    """
+    Restricts the images to the given boards, dropping the ones left empty.
+
+    Raises ValueError if some of the boards are not in any image.
+    """
+    ids = set(ids)
+    missing = ids.difference(id for image in images for id in image.ids)
+
+    if missing:
+        raise ValueError("Boards {} are not in the manifest".format(sorted(missing)))
+
+    images = [i._replace(ids=[id for id in i.ids if id in ids]) for i in images]
+
+    return [i for i in images if i.ids]
@@ -1,8 +1,74 @@
+import re
+from zlib import crc32
+
+# Value of erased flash bytes
+ERASED_BYTE = 0xFF
+
+# Erased runs shorter than this are written anyway, as they cost less bus time
+# than the header of an extra write command.
+MIN_ERASED_RUN = 64
+
+# Writes start on this boundary, so that flash controllers programming
+# several bytes at once (e.g. half words on STM32F3) never straddle a span.
+WRITE_ALIGNMENT = 8
+
+
 def slice_into_pages(data, page_size):
     """
     Slices data into chunks that are at max page_size big.
+
+    The chunks are zero-copy slices of data.
     """
-    while len(data) > page_size:
-        yield data[:page_size]
-        data = data[page_size:]
-    yield data
+    view = memoryview(data)
+
+    for offset in range(0, max(len(view) - page_size, 0), page_size):
+        yield view[offset : offset + page_size]
+
+    offset = max(len(view) - 1, 0) // page_size * page_size
+    yield view[offset:]
+
+
+def page_crcs(data, page_size):
+    """
+    Returns the CRC32 of each page of data, as cut by slice_into_pages.
+    """
+    return [crc32(p) for p in slice_into_pages(data, page_size)]
+
+
+def written_spans(chunk, min_run=MIN_ERASED_RUN, alignment=WRITE_ALIGNMENT):
+    """
+    Splits a chunk of a freshly erased page into the spans which actually
+    need to be written, leaving out the runs of erased bytes.
+
+    Returns a list of (offset, data) tuples, offset being relative to the
+    chunk and data a zero-copy slice of it. A chunk which is entirely erased
+    yields no span at all.
+    """
+    view = memoryview(chunk)
+    data = view.tobytes()
+    erased = bytes([ERASED_BYTE])
+
+    # Only erased runs longer than min_run split a span in two. Runs at its
+    # ends are trimmed below, as they cost no extra command.
+    bounds = []
+    start = 0
+    for run in re.finditer(re.escape(erased) + b"{%d,}" % min_run, data):
+        run_start = -(-run.start() // alignment) * alignment
+        run_end = run.end() // alignment * alignment
+
+        if run_end - run_start >= min_run:
+            bounds.append((start, run_start))
+            start = run_end
+
+    bounds.append((start, len(data)))
+
+    spans = []
+    for start, end in bounds:
+        end = start + len(data[start:end].rstrip(erased))
+        leading = end - start - len(data[start:end].lstrip(erased))
+        start += leading // alignment * alignment
+
+        if start < end:
+            spans.append((start, view[start:end]))
+
+    return spans
@@ -2,6 +2,7 @@
 from cvra_bootloader import commands, utils
 import msgpack
 import json
+import sys
 
 
 def parse_commandline_args():
@@ -11,7 +12,11 @@ def parse_commandline_args():
     DESCRIPTION = "Read board configs and dumps to JSON"
     parser = utils.ConnectionArgumentParser(description=DESCRIPTION)
     parser.add_argument(
-        "ids", metavar="DEVICEID", nargs="*", type=int, help="Device IDs to query"
+        "ids",
+        metavar="DEVICEID",
+        nargs="*",
+        type=int,
+        help="Device IDs to query (with --bus, they are given per bus instead)",
     )
 
     parser.add_argument(
@@ -21,27 +26,24 @@ def parse_commandline_args():
     return parser.parse_args()
 
 
-def main():
-    args = parse_commandline_args()
-    connection = utils.open_connection(args)
-
-    if args.all:
-        scan_queue = list()
-
+def read_configs(connection, ids, scan=False):
+    """
+    Reads the configs of the given boards, or of every board answering a
+    broadcast ping if scan is true.
+    """
+    if scan:
         # Broadcast ping
-        utils.write_command(connection, commands.encode_ping(), list(range(1, 128)))
-        reader = utils.read_can_datagrams(connection)
-        while True:
-            dt = next(reader)
-
-            if dt is None:  # Timeout
-                break
+        dispatcher = utils.get_dispatcher(connection)
+        futures = dispatcher.send(commands.encode_ping(), list(range(1, 128)))
 
-            _, _, src = dt
-            scan_queue.append(src)
+        try:
+            dispatcher.wait(futures.values())
+            scan_queue = [id for id, f in futures.items() if f.done()]
+        finally:
+            dispatcher.cancel(futures.values())
 
     else:
-        scan_queue = args.ids
+        scan_queue = ids
 
     # Broadcast ask for config
     configs = utils.write_command_retry(
@@ -51,6 +53,32 @@ def main():
     for id, raw_config in configs.items():
         configs[id] = msgpack.unpackb(raw_config, encoding="ascii")
 
+    return configs
+
+
+def main():
+    args = parse_commandline_args()
+
+    if args.buses:
+        results = utils.run_on_buses(
+            args, lambda conn, bus: read_configs(conn, bus.ids, args.all)
+        )
+
+        for device, result in results.items():
+            if isinstance(result, BaseException):
+                print("{}: error: {!r}".format(device, result), file=sys.stderr)
+
+        configs = {d: r for d, r in results.items() if isinstance(r, dict)}
+        print(json.dumps(configs, indent=4, sort_keys=True))
+
+        if len(configs) < len(results):
+            sys.exit(1)
+
+        return
+
+    connection = utils.open_connection(args)
+    configs = read_configs(connection, args.ids, args.all)
+
     print(json.dumps(configs, indent=4, sort_keys=True))
 
 
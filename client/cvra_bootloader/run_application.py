@@ -1,4 +1,6 @@
 #!/usr/bin/env python3
+import sys
+
 from cvra_bootloader import commands, utils
 
 
@@ -11,7 +13,8 @@ def parse_commandline_args():
         metavar="DEVICEID",
         nargs="*",
         type=int,
-        help="Device IDs to send jump command",
+        help="Device IDs to send jump command (with --bus, they are given per "
+        "bus instead)",
     )
     parser.add_argument(
         "-a", "--all", help="Try to scan all network.", action="store_true"
@@ -22,9 +25,30 @@ def parse_commandline_args():
 
 def main():
     args = parse_commandline_args()
+    all_ids = list(range(1, 128))
+
+    if args.buses:
+        results = utils.run_on_buses(
+            args,
+            lambda conn, bus: utils.write_command(
+                conn, commands.encode_jump_to_main(), all_ids if args.all else bus.ids
+            ),
+        )
+
+        failed = False
+        for device, result in results.items():
+            if isinstance(result, BaseException):
+                print("{}: error: {!r}".format(device, result))
+                failed = True
+
+        if failed:
+            sys.exit(1)
+
+        return
+
     connection = utils.open_connection(args)
     if args.all is True:
-        ids = list(range(1, 128))
+        ids = all_ids
     else:
         ids = args.ids
 
@@ -0,0 +1,376 @@
+"""
+Pipelined flash scheduler.
+
+Instead of erasing every page and then writing every page, each board gets a
+single stream of operations in which the erase of page N+1 is interleaved with
+the write of page N. The scheduler keeps track of the progress of each board
+separately and keeps up to a bounded number of commands in flight per board,
+grouping boards which are at the same step into a single multicast command.
+
+Every board runs its own state machine with its own retries and deadline.
+A board which answers much later than the others of its group, or which
+stops answering, continues with unicast commands so that it does not stall
+the others. A board is quarantined once it exhausted its retries or answered
+with an error, without aborting the session for the healthy boards.
+
+Note that the bootloader only has a single datagram buffer and does not read
+the bus while erasing or writing flash, so a window larger than one command
+per board requires a firmware able to queue datagrams. With a window of one,
+flashing a single image to boards which all keep up takes as long as with
+flash_binary: the gain comes from interleaving the commands of different
+images (about twice as fast for two images in simulation), and from not
+waiting for failing or slow boards.
+"""
+from collections import deque, namedtuple
+import logging
+import statistics
+import time
+
+import msgpack
+
+from cvra_bootloader import commands, page, utils
+
+Operation = namedtuple("Operation", ["kind", "offset", "command"])
+
+
+def flash_operations(
+    binary,
+    base_address,
+    device_class,
+    page_size=2048,
+    offsets=None,
+    erased=(),
+    compress=False,
+):
+    """
+    Returns the list of operations needed to flash the binary.
+
+    The erase of page N+1 comes right before the writes of page N. Erased
+    spans of a page are not written (see page.written_spans), so a page can
+    take zero or several writes. If offsets is given, only the pages starting
+    at those offsets are erased and written. The pages at the offsets listed
+    in erased are known to be erased already and are only written. compress
+    works like in commands.encode_page_writes.
+    """
+    erases, writes = [], []
+
+    for offset, chunk in enumerate(page.slice_into_pages(binary, page_size)):
+        offset *= page_size
+
+        if offsets is not None and offset not in offsets:
+            continue
+
+        if offset not in erased:
+            erases.append(
+                Operation(
+                    "erase",
+                    offset,
+                    commands.encode_erase_flash_page(
+                        base_address + offset, device_class
+                    ),
+                )
+            )
+        writes.append(
+            [
+                Operation("write", offset, command)
+                for span_offset, span in page.written_spans(chunk)
+                for command in commands.encode_page_writes(
+                    span, base_address + offset + span_offset, device_class, compress
+                )
+            ]
+        )
+
+    operations = erases[:1]
+    for i, page_writes in enumerate(writes):
+        operations += erases[i + 1 : i + 2]
+        operations += page_writes
+
+    return operations
+
+
+class Multicast:
+    """
+    A command sent to several boards at once, at the given time, and the
+    time each board took to answer it.
+    """
+
+    def __init__(self, ids, sent):
+        self.ids = ids
+        self.sent = sent
+        self.latencies = dict()
+
+    @property
+    def complete(self):
+        return len(self.latencies) == len(self.ids)
+
+
+class BoardProgress:
+    """
+    Flashing state machine of a single board.
+    """
+
+    def __init__(self, operations):
+        self.operations = operations
+        # Index of the next operation to send
+        self.next = 0
+        # (index, future of the answer, multicast) of the operations sent but
+        # not acknowledged yet, oldest first
+        self.outstanding = deque()
+        # Time of the last answer, and whether the last group the board was
+        # part of had to wait for it (see FlashScheduler._find_slow_boards)
+        self.last_answer = None
+        self.slow = False
+        # Number of retries since the last answer and time at which the oldest
+        # outstanding operation is considered lost
+        self.retries = 0
+        self.deadline = None
+        # Operation which caused the board to be quarantined
+        self.failed = None
+
+    @property
+    def done(self):
+        return self.next - len(self.outstanding)
+
+    @property
+    def finished(self):
+        return self.failed is not None or self.done == len(self.operations)
+
+    @property
+    def lagging(self):
+        return self.retries > 0
+
+    def answered(self, now):
+        """
+        Acknowledges the oldest outstanding operation, answered at now.
+
+        Returns its index, its multicast and the time the board took to
+        answer it.
+        """
+        index, _, multicast = self.outstanding.popleft()
+
+        # With a window, the board only starts an operation once it answered
+        # the previous one
+        start = multicast.sent
+        if self.last_answer is not None:
+            start = max(start, self.last_answer)
+
+        latency = now - start
+        self.last_answer = now
+
+        return index, multicast, latency
+
+    def next_operation(self):
+        if self.failed is not None or self.next == len(self.operations):
+            return None
+        return self.operations[self.next]
+
+    def quarantine(self):
+        """
+        Stops the board, returning the futures it was still waiting for.
+        """
+        index, _, _ = self.outstanding[0]
+        self.failed = self.operations[index]
+        futures = [future for _, future, _ in self.outstanding]
+        self.outstanding.clear()
+        self.deadline = None
+        return futures
+
+
+class FlashScheduler:
+    """
+    Sends the flash operations of several boards over a single connection.
+
+    operations maps each board ID to the list of operations to run on it.
+    Boards whose next operation is the same receive it as one multicast
+    command, and wait for each other to stay grouped. A board which took
+    more than split_factor times longer than its peers to answer the last
+    command of its group, and at least split_delay seconds longer, is not
+    waited for anymore. A board which did not answer within timeout seconds
+    leaves its group and is retried alone, up to retry_limit times in a row
+    before being quarantined.
+
+    clock returns the current time in seconds, which allows running the
+    scheduler against a simulated bus. If given, on_done is called as
+    on_done(id, index) each time a board completes the operation at the given
+    index of its list.
+    """
+
+    def __init__(
+        self,
+        fdesc,
+        operations,
+        window=1,
+        source=0,
+        retry_limit=3,
+        timeout=0.5,
+        clock=time.monotonic,
+        on_done=None,
+        split_factor=2.0,
+        split_delay=0.01,
+    ):
+        if window < 1:
+            raise ValueError("The window must allow at least one command")
+
+        self.dispatcher = utils.get_dispatcher(fdesc, source)
+        self.window = window
+        self.retry_limit = retry_limit
+        self.timeout = timeout
+        self.clock = clock
+        self.on_done = on_done
+        self.split_factor = split_factor
+        self.split_delay = split_delay
+        self.boards = {id: BoardProgress(ops) for id, ops in operations.items()}
+
+    @property
+    def total(self):
+        return sum(len(b.operations) for b in self.boards.values())
+
+    @property
+    def done(self):
+        return sum(b.done for b in self.boards.values())
+
+    def failed_boards(self):
+        """
+        Returns a dictionary mapping each quarantined board to the operation
+        which failed.
+        """
+        return {id: b.failed for id, b in self.boards.items() if b.failed}
+
+    def run(self, progress=None):
+        """
+        Runs all operations to completion, or until the remaining boards are
+        quarantined.
+
+        progress is called with the count of completed operations each time a
+        board answers. Returns the same dictionary as failed_boards.
+        """
+        while not all(b.finished for b in self.boards.values()):
+            self._dispatch()
+
+            if self.dispatcher.receive():
+                self._handle_answers()
+
+                if progress:
+                    progress(self.done)
+
+            self._check_deadlines()
+
+        return self.failed_boards()
+
+    def _handle_answers(self):
+        for id, board in self.boards.items():
+            while board.outstanding and board.outstanding[0][1].done():
+                index, future, _ = board.outstanding[0]
+                operation = board.operations[index]
+
+                if not msgpack.unpackb(future.result()):
+                    logging.error(
+                        "Board {} failed during page {}, quarantining it".format(
+                            id, operation.kind
+                        )
+                    )
+                    self.dispatcher.cancel(board.quarantine())
+                    break
+
+                index, multicast, latency = board.answered(self.clock())
+                board.retries = 0
+                board.deadline = self._deadline() if board.outstanding else None
+
+                multicast.latencies[id] = latency
+                if multicast.complete:
+                    self._find_slow_boards(multicast)
+
+                if self.on_done:
+                    self.on_done(id, index)
+
+    def _check_deadlines(self):
+        """
+        Retries the boards whose oldest operation was not answered in time,
+        quarantining the ones which exhausted their retries.
+        """
+        now = self.clock()
+        retried = []
+
+        for id, board in self.boards.items():
+            if board.deadline is None or board.deadline > now:
+                continue
+
+            if board.retries == self.retry_limit:
+                logging.error("Board {} does not answer, quarantining it".format(id))
+                self.dispatcher.cancel(board.quarantine())
+                continue
+
+            board.retries += 1
+            board.deadline = self._deadline()
+            retried.append(id)
+
+            for index, _, _ in board.outstanding:
+                command = board.operations[index].command
+                self.dispatcher.write(command, [id])
+
+        if retried:
+            msg = "The following boards did not answer: {}, retrying..".format(
+                " ".join(str(id) for id in retried)
+            )
+            logging.warning(msg)
+
+    def _find_slow_boards(self, multicast):
+        """
+        Marks the boards of a fully answered multicast which its other boards
+        had to wait for, comparing each board with the median of its peers.
+        The boards which kept up are cleared, so that a slow board which
+        caught up with a group is waited for again.
+        """
+        if len(multicast.ids) < 2:
+            return
+
+        for id, latency in multicast.latencies.items():
+            peers = [l for other, l in multicast.latencies.items() if other != id]
+            peers = statistics.median(peers)
+            threshold = max(self.split_factor * peers, peers + self.split_delay)
+            self.boards[id].slow = latency > threshold
+
+    def _dispatch(self):
+        """
+        Sends the next operation to every board having room in its window.
+
+        A group of boards sharing the same next operation is only sent once
+        all of them have room, so that it goes out as a single multicast.
+        Slow boards are not waited for, they get the operation by unicast
+        once they have room, unless they caught up with the group. Lagging
+        boards are kept out of the groups and served by unicast.
+        """
+        sent = True
+        while sent:
+            sent = False
+            groups = dict()
+            for id, board in self.boards.items():
+                operation = board.next_operation()
+                if operation is None:
+                    continue
+
+                key = (operation.command, id if board.lagging else None)
+                groups.setdefault(key, []).append(id)
+
+            for (command, _), ids in groups.items():
+                full = [
+                    id for id in ids if len(self.boards[id].outstanding) >= self.window
+                ]
+                ids = [id for id in ids if id not in full]
+
+                if not ids or not all(self.boards[id].slow for id in full):
+                    continue
+
+                futures = self.dispatcher.send(command, ids)
+                multicast = Multicast(ids, self.clock())
+                sent = True
+
+                for id in ids:
+                    board = self.boards[id]
+                    if not board.outstanding:
+                        board.deadline = self._deadline()
+                    board.outstanding.append((board.next, futures[id], multicast))
+                    board.next += 1
+
+    def _deadline(self):
+        return self.clock() + self.timeout
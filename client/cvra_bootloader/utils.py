@@ -1,14 +1,58 @@
 import serial
+import select
 import socket
 import argparse
+import copy
+import os
 import time
 
 from cvra_bootloader import commands
 import cvra_bootloader.can
 import cvra_bootloader.can.pcap
+import cvra_bootloader.can.pcapng
 import logging
 
-from collections import defaultdict
+from collections import defaultdict, deque, namedtuple
+from concurrent.futures import Future, ThreadPoolExecutor
+
+Bus = namedtuple("Bus", ["device", "ids"])
+
+
+def parse_ids(text):
+    """
+    Parses a comma separated list of device IDs and ranges, e.g. 1,2,10-12.
+
+    Raises ValueError if the list is invalid.
+    """
+    ids = []
+
+    for item in filter(None, text.split(",")):
+        first, dash, last = item.partition("-")
+        ids += range(int(first), int(last if dash else first) + 1)
+
+    return ids
+
+
+def parse_bus(spec):
+    """
+    Parses a bus given as DEVICE=IDS, IDS being a list of device IDs and
+    ranges (see parse_ids). The IDs can be omitted.
+
+    DEVICE is a serial port if it is a path, a SocketCAN interface otherwise.
+    """
+    device, _, ids = spec.partition("=")
+
+    if not device:
+        raise argparse.ArgumentTypeError("Missing device in {}".format(spec))
+
+    try:
+        return Bus(device, parse_ids(ids))
+    except ValueError:
+        raise argparse.ArgumentTypeError("Invalid device IDs in {}".format(spec))
+
+
+def is_serial_device(device):
+    return os.sep in device or device.upper().startswith("COM")
 
 
 class ConnectionArgumentParser(argparse.ArgumentParser):
@@ -16,9 +60,12 @@ class ConnectionArgumentParser(argparse.ArgumentParser):
     Subclass of ArgumentParser with default arguments for connection handling (TCP and serial).
 
     It also checks that the user provides at least one connection method (--tcp or --port).
+
+    Tools which cannot work on several buses pass buses=False, so that --bus
+    is not offered.
     """
 
-    def __init__(self, *args, **kwargs):
+    def __init__(self, *args, buses=True, **kwargs):
         super(ConnectionArgumentParser, self).__init__(*args, **kwargs)
 
         self.add_argument(
@@ -37,10 +84,51 @@ class ConnectionArgumentParser(argparse.ArgumentParser):
             metavar="INTERFACE",
         )
 
+        if buses:
+            self.add_argument(
+                "--bus",
+                dest="buses",
+                help="Serial port or SocketCAN interface and the device IDs on it, "
+                "e.g. can0=1,2,10-12. Can be given several times to work on "
+                "several buses in parallel.",
+                action="append",
+                type=parse_bus,
+                metavar="DEVICE=IDS",
+            )
+        else:
+            self.set_defaults(buses=None)
+
+        self.add_argument(
+            "--replay",
+            help="Replay the board answers recorded in the given capture instead of using a CAN adapter.",
+            metavar="FILE",
+        )
+
+        self.add_argument(
+            "--replay-realtime",
+            help="Keep the timing of the recorded answers when replaying.",
+            action="store_true",
+        )
+
         self.add_argument(
             "--pcap",
-            help="Log CAN frames to the given file in Wireshark compatible Pcap format.",
-            type=argparse.FileType("wb"),
+            help="Log CAN frames to the given file in Wireshark compatible Pcap format. "
+            "Files ending in .pcapng are written in pcapng format, with nanosecond timestamps.",
+            metavar="FILE",
+        )
+
+        self.add_argument(
+            "--pcap-max-size",
+            help="Start a new capture file once the current one reaches this size in MB.",
+            type=float,
+            metavar="MB",
+        )
+
+        self.add_argument(
+            "--pcap-max-age",
+            help="Start a new capture file once the current one is this old.",
+            type=float,
+            metavar="SECONDS",
         )
 
         self.add_argument(
@@ -52,14 +140,28 @@ class ConnectionArgumentParser(argparse.ArgumentParser):
     def parse_args(self, *args, **kwargs):
         args = super(ConnectionArgumentParser, self).parse_args(*args, **kwargs)
 
-        if args.serial_device is None and args.can_interface is None:
-            self.error("You must specify one of --tcp, --port or --interface")
+        connections = [args.serial_device, args.can_interface, args.replay, args.buses]
+        connections = [c for c in connections if c is not None]
 
-        if args.can_interface and args.serial_device:
-            self.error("Can only use one of --interface and --port")
+        if not connections:
+            self.error(
+                "You must specify one of {}".format(self._connection_options(" or "))
+            )
+
+        if len(connections) > 1:
+            self.error(
+                "Can only use one of {}".format(self._connection_options(" and "))
+            )
 
         return args
 
+    def _connection_options(self, conjunction):
+        options = ["--interface", "--port", "--replay"]
+        if "--bus" in self._option_string_actions:
+            options.insert(2, "--bus")
+
+        return ", ".join(options[:-1]) + conjunction + options[-1]
+
 
 class SocketSerialAdapter:
     """
@@ -69,40 +171,96 @@ class SocketSerialAdapter:
     def __init__(self, socket):
         self.socket = socket
 
+    @property
+    def in_waiting(self):
+        """
+        Number of bytes which can be read without blocking.
+        """
+        readable, _, _ = select.select([self.socket], [], [], 0)
+        if not readable:
+            return 0
+
+        return len(self.socket.recv(4096, socket.MSG_PEEK))
+
     def read(self, n):
         try:
-            return self.socket.recv(n)
+            data = self.socket.recv(n)
         except socket.timeout:
             return bytes()
 
+        # Like a serial port which was unplugged
+        if not data:
+            raise serial.SerialException("Connection closed")
+
+        return data
+
     def write(self, data):
         return self.socket.send(data)
 
     def flush(self):
         pass
 
+    def reset_input_buffer(self):
+        waiting = self.in_waiting
+        while waiting:
+            self.socket.recv(waiting)
+            waiting = self.in_waiting
+
 
 class PcapConnectionWrapper:
     """
     Connection wrapper which logs all frames sent and received into a wireshark
     compatible pcap file.
+
+    Frames are only timestamped when they go through the connection, and are
+    written to the file by a background thread. pcap_file is either a file,
+    which receives a legacy pcap capture, or a PcapWriter.
     """
 
     def __init__(self, conn, pcap_file):
         self.conn = conn
-        self.pcap_file = pcap_file
-        cvra_bootloader.can.pcap.write_header(self.pcap_file)
+
+        if hasattr(pcap_file, "write_frame"):
+            self.writer = pcap_file
+        else:
+            self.writer = cvra_bootloader.can.pcap.PcapWriter(pcap_file)
 
     def send_frame(self, frame):
-        cvra_bootloader.can.pcap.write_frame(self.pcap_file, time.time(), frame)
+        self.writer.write_frame(time.time_ns(), frame)
         self.conn.send_frame(frame)
 
+    def send_frames(self, frames):
+        frames = list(frames)
+        timestamp = time.time_ns()
+        for frame in frames:
+            self.writer.write_frame(timestamp, frame)
+        self.conn.send_frames(frames)
+
     def receive_frame(self):
         frame = self.conn.receive_frame()
         if frame:
-            cvra_bootloader.can.pcap.write_frame(self.pcap_file, time.time(), frame)
+            # Prefer the time at which the adapter received the frame
+            self.writer.write_frame(frame.timestamp or time.time_ns(), frame)
         return frame
 
+    def close(self):
+        """
+        Writes the frames still queued to the pcap file.
+        """
+        self.writer.close()
+
+
+def read_timeout(args):
+    """
+    Returns the time to wait for an answer based on commandline arguments.
+
+    Erasing a large page (e.g. a 128K sector on STM32F4) can take seconds.
+    """
+    if args.large_pages:
+        return 5
+    else:
+        return 0.5
+
 
 def open_connection(args):
     """
@@ -111,52 +269,130 @@ def open_connection(args):
     Returns a file like object which will be the connection handle.
     """
     conn = None
-
-    if args.large_pages:
-        timeout = 5
-    else:
-        timeout = 0.5
+    timeout = read_timeout(args)
 
     if args.can_interface:
         conn = cvra_bootloader.can.adapters.SocketCANConnection(
-            args.can_interface, read_timeout=timeout
+            args.can_interface, read_timeout=timeout, timestamps=bool(args.pcap)
         )
     elif args.serial_device:
         port = serial.Serial(port=args.serial_device, timeout=0.1)
         conn = cvra_bootloader.can.adapters.SerialCANConnection(
             port, read_timeout=timeout
         )
+    elif args.replay:
+        conn = cvra_bootloader.can.adapters.PcapReplayConnection(
+            args.replay, realtime=args.replay_realtime, read_timeout=timeout
+        )
 
     if args.pcap:
-        conn = PcapConnectionWrapper(conn, args.pcap)
+        conn = PcapConnectionWrapper(conn, open_pcap_writer(args))
 
     return conn
 
 
-def read_can_datagrams(fdesc):
-    buf = defaultdict(lambda: bytes())
-    while True:
-        datagram = None
-        while datagram is None:
-            frame = fdesc.receive_frame()
+def open_bus_connection(args, bus):
+    """
+    Opens a connection to one of the buses given with --bus.
 
-            if frame is None:
-                yield None
-                continue
+    Each bus gets its own capture file, named after the bus device.
+    """
+    args = copy.copy(args)
+    args.buses = None
+    args.can_interface = args.serial_device = None
 
-            if frame.extended:
-                continue
+    if is_serial_device(bus.device):
+        args.serial_device = bus.device
+    else:
+        args.can_interface = bus.device
 
-            src = frame.id & (0x7F)
-            buf[src] += frame.data
+    if args.pcap:
+        args.pcap = bus_file_name(args.pcap, bus)
 
-            datagram = cvra_bootloader.can.decode_datagram(buf[src])
+    return open_connection(args)
 
-            if datagram is not None:
-                del buf[src]
-                data, dst = datagram
 
-        yield data, dst, src
+def bus_file_name(path, bus):
+    """
+    Returns the name of the file of the given bus, when each bus given with
+    --bus gets its own, e.g. capture_can0.pcapng for capture.pcapng.
+    """
+    root, ext = os.path.splitext(path)
+    name = os.path.basename(bus.device)
+    return "{}_{}{}".format(root, name, ext)
+
+
+def run_on_buses(args, session):
+    """
+    Runs session(connection, bus) on every bus given with --bus, in parallel
+    with one thread per bus, so that the total time is the one of the slowest
+    bus.
+
+    Returns a dictionary mapping each bus device to the result of its session,
+    or to the exception it raised.
+    """
+
+    def run(bus):
+        conn = open_bus_connection(args, bus)
+        try:
+            return session(conn, bus)
+        finally:
+            if hasattr(conn, "close"):
+                conn.close()
+
+    with ThreadPoolExecutor(max_workers=len(args.buses)) as executor:
+        futures = [(bus.device, executor.submit(run, bus)) for bus in args.buses]
+
+    results = dict()
+    for device, future in futures:
+        try:
+            results[device] = future.result()
+        except BaseException as e:
+            results[device] = e
+
+    return results
+
+
+def open_pcap_writer(args):
+    """
+    Creates the capture writer matching the commandline arguments.
+    """
+    kwargs = dict()
+
+    if args.pcap_max_size:
+        kwargs["max_size"] = int(args.pcap_max_size * 1e6)
+
+    if args.pcap_max_age:
+        kwargs["max_age"] = args.pcap_max_age
+
+    if args.pcap.endswith(".pcapng"):
+        interface = args.can_interface or args.serial_device
+        return cvra_bootloader.can.pcapng.PcapngWriter(
+            args.pcap, interface=interface, **kwargs
+        )
+
+    return cvra_bootloader.can.pcap.PcapWriter(args.pcap, **kwargs)
+
+
+def read_can_datagrams(fdesc):
+    """
+    Reads datagrams from the bus, yielding a tuple (data, destinations, source)
+    for each complete datagram and None on read timeout.
+
+    Datagrams are reassembled incrementally for each source.
+    """
+    demultiplexer = cvra_bootloader.can.DatagramDemultiplexer()
+    while True:
+        frame = fdesc.receive_frame()
+
+        if frame is None:
+            yield None
+            continue
+
+        datagram = demultiplexer.input_frame(frame)
+
+        if datagram is not None:
+            yield datagram
 
 
 def ping_board(fdesc, destination):
@@ -165,66 +401,238 @@ def ping_board(fdesc, destination):
 
     Returns True if it is online, false otherwise.
     """
-    write_command(fdesc, commands.encode_ping(), [destination])
-
-    reader = read_can_datagrams(fdesc)
-    answer = next(reader)
+    dispatcher = get_dispatcher(fdesc)
+    futures = dispatcher.send(commands.encode_ping(), [destination])
 
-    # Timeout
-    if answer is None:
-        return False
-
-    return True
+    try:
+        return dispatcher.wait(futures.values())
+    finally:
+        dispatcher.cancel(futures.values())
 
 
 def write_command(fdesc, command, destinations, source=0):
     """
     Writes the given encoded command to the CAN bridge.
+
+    This does not wait for the boards to answer: it can be used as is for
+    commands which do not expect a reply (fire and forget), otherwise the
+    answers must be read back, for example using write_command_retry.
     """
     datagram = cvra_bootloader.can.encode_datagram(command, destinations)
     frames = cvra_bootloader.can.datagram_to_frames(datagram, source)
 
-    for frame in frames:
-        fdesc.send_frame(frame)
+    fdesc.send_frames(frames)
 
-    time.sleep(0.1)
+
+class AnswerRouter:
+    """
+    Routes the answers of the boards to the requests waiting for them.
+
+    Each request sent to a board gets a future, keyed by (board, request
+    number). Boards answer their requests in order, so an answer resolves the
+    oldest outstanding request of its source. Datagrams which are not
+    addressed to our source ID or which no request is waiting for are
+    dropped.
+    """
+
+    def __init__(self, source=0):
+        self.source = source
+        self.futures = dict()
+        # Board ID -> keys of its outstanding requests, oldest first
+        self.outstanding = defaultdict(deque)
+        self.requests = 0
+        self.unexpected_answers = 0
+
+    def create_future(self):
+        return Future()
+
+    def register(self, ids):
+        """
+        Creates the futures of a new request answered by the given boards,
+        returned as a dictionary mapping each board to its future.
+        """
+        self.requests += 1
+        futures = dict()
+
+        for id in ids:
+            key = (id, self.requests)
+            futures[id] = self.futures[key] = self.create_future()
+            self.outstanding[id].append(key)
+
+        return futures
+
+    def route(self, data, dst, src):
+        """
+        Resolves the request answered by the given datagram, if any.
+        """
+        if self.source not in dst:
+            return
+
+        future = self._pop(src)
+
+        if future is None:
+            self.unexpected_answers += 1
+            logging.debug("Unexpected answer from board {}".format(src))
+        else:
+            future.set_result(data)
+
+    def _pop(self, id):
+        queue = self.outstanding.get(id)
+
+        while queue:
+            future = self.futures.pop(queue.popleft())
+            if not future.cancelled():
+                return future
+
+    def cancel(self, futures):
+        """
+        Stops waiting for the given answers, for example for boards which
+        did not answer in time.
+        """
+        for future in futures:
+            future.cancel()
+
+        for key, future in list(self.futures.items()):
+            if future.cancelled():
+                del self.futures[key]
+                self.outstanding[key[0]].remove(key)
+
+
+class Dispatcher(AnswerRouter):
+    """
+    Single receive loop of a connection, see AnswerRouter.
+
+    Datagrams are reassembled by one reader per connection, so that answers
+    received while nobody is reading are not lost or mixed between calls.
+    Many requests can be in flight at once, to the same or to different
+    boards.
+    """
+
+    def __init__(self, fdesc, source=0):
+        super(Dispatcher, self).__init__(source)
+        self.fdesc = fdesc
+        self.reader = read_can_datagrams(fdesc)
+
+    def send(self, command, destinations, answer_ids=None):
+        """
+        Sends a command and returns a dictionary mapping each destination to
+        the future of its answer.
+
+        answer_ids gives the ID each destination answers from, when it
+        differs from the destination (e.g. when changing the ID of a board).
+        """
+        futures = self.register(answer_ids or destinations)
+        self.write(command, destinations)
+        return futures
+
+    def write(self, command, destinations):
+        """
+        Sends a command without waiting for an answer, e.g. to retry a
+        request which is already outstanding.
+        """
+        write_command(self.fdesc, command, destinations, self.source)
+
+    def receive(self):
+        """
+        Reads a single datagram and routes it.
+
+        Returns False if the connection timed out.
+        """
+        try:
+            dt = next(self.reader)
+        except BaseException:
+            # The reader does not survive errors of the connection
+            self.reader = read_can_datagrams(self.fdesc)
+            raise
+
+        if dt is None:
+            return False
+
+        self.route(*dt)
+        return True
+
+    def wait(self, futures):
+        """
+        Routes incoming datagrams until all the given futures are done.
+
+        Returns False if the connection timed out first.
+        """
+        futures = list(futures)
+
+        while not all(f.done() for f in futures):
+            if not self.receive():
+                return False
+
+        return True
 
 
-def write_command_retry(fdesc, command, destinations, source=0, retry_limit=3):
+def get_dispatcher(fdesc, source=0, dispatcher_class=Dispatcher):
+    """
+    Returns the dispatcher of the given connection, creating it on first use.
+    """
+    if isinstance(fdesc, dispatcher_class):
+        return fdesc
+
+    try:
+        attributes = vars(fdesc)
+    except TypeError:
+        # Objects without attributes cannot keep their dispatcher
+        return dispatcher_class(fdesc, source)
+
+    if "dispatcher" not in attributes:
+        attributes["dispatcher"] = dispatcher_class(fdesc, source)
+
+    dispatcher = attributes["dispatcher"]
+
+    if dispatcher.source != source:
+        raise ValueError(
+            "Connection already used with source ID {}".format(dispatcher.source)
+        )
+
+    return dispatcher
+
+
+def write_command_retry(
+    fdesc, command, destinations, source=0, retry_limit=3, answer_ids=None
+):
     """
     Writes a command, retries as long as there is no answer and returns a dictionnary containing
     a map of each board ID and its answer.
+
+    The function returns as soon as every board answered. A board is
+    considered as not answering once the connection read timeout expires.
+    answer_ids is the list of IDs the destinations answer from, if they
+    differ, for example when changing board IDs.
     """
-    write_command(fdesc, command, destinations, source)
-    reader = read_can_datagrams(fdesc)
-    answers = dict()
+    answer_ids = answer_ids or destinations
+    dispatcher = get_dispatcher(fdesc, source)
+    futures = dispatcher.send(command, destinations, answer_ids)
 
     retry_count = 0
 
-    while len(answers) < len(destinations):
-        dt = next(reader)
-
+    try:
         # If we have a timeout, retry on some boards
-        if dt is None:
+        while not dispatcher.wait(futures.values()):
             if retry_count == retry_limit:
                 logging.critical("No answer, aborting...")
                 raise IOError
 
-            timedout_boards = list(set(destinations) - set(answers))
-            write_command(fdesc, command, timedout_boards, source)
+            timedout_boards = [
+                dst
+                for dst, id in zip(destinations, answer_ids)
+                if not futures[id].done()
+            ]
+            dispatcher.write(command, timedout_boards)
             msg = "The following boards did not answer: {}, retrying..".format(
                 " ".join(str(t) for t in timedout_boards)
             )
 
             logging.warning(msg)
             retry_count += 1
+    finally:
+        dispatcher.cancel(futures.values())
 
-            continue
-
-        data, _, src = dt
-        answers[src] = data
-
-    return answers
+    return {id: f.result() for id, f in futures.items()}
 
 
 def config_update_and_save(fdesc, config, destinations):
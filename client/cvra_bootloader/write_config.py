@@ -28,10 +28,19 @@ def parse_commandline_args():
         dest="file",
     )
     parser.add_argument(
-        "ids", metavar="DEVICEID", nargs="+", type=int, help="Device IDs to flash"
+        "ids",
+        metavar="DEVICEID",
+        nargs="*",
+        type=int,
+        help="Device IDs to flash (with --bus, they are given per bus instead)",
     )
 
-    return parser.parse_args()
+    args = parser.parse_args()
+
+    if not args.buses and not args.ids:
+        parser.error("No device IDs given")
+
+    return args
 
 
 def main():
@@ -43,6 +52,25 @@ def main():
         print("Use bootloader_change_id.py instead.")
         sys.exit(1)
 
+    if args.buses:
+        results = utils.run_on_buses(
+            args,
+            lambda conn, bus: utils.config_update_and_save(conn, config, bus.ids),
+        )
+
+        failed = False
+        for device, result in results.items():
+            if isinstance(result, BaseException):
+                print("{}: error: {!r}".format(device, result))
+                failed = True
+            else:
+                print("{}: OK".format(device))
+
+        if failed:
+            sys.exit(1)
+
+        return
+
     connection = utils.open_connection(args)
     utils.config_update_and_save(connection, config, args.ids)
 
@@ -25,6 +25,7 @@ setup(
     ],
     entry_points={
         "console_scripts": [
+            "bootloader_analyze=cvra_bootloader.analyze:main",
             "bootloader_flash=cvra_bootloader.bootloader_flash:main",
             "bootloader_change_id=cvra_bootloader.change_id:main",
             "bootloader_read_config=cvra_bootloader.read_config:main",
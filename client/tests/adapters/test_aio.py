@@ -0,0 +1,136 @@
+import unittest
+
+try:
+    from unittest.mock import *
+except ImportError:
+    from mock import *
+
+import asyncio
+import errno
+import os
+import socket
+import struct
+
+import serial
+
+from cvra_bootloader.can.adapters import SocketCANConnection
+from cvra_bootloader.can.aio import *
+from cvra_bootloader.can import Frame
+from tests.aio_support import AsyncTestCase, CoroutineMock
+
+CAN_FRAME = struct.Struct("=IB3x8s")
+
+
+class AsyncSocketCANTestCase(AsyncTestCase):
+    def setUp(self):
+        # A datagram socket pair behaves like a raw CAN socket: each read and
+        # write transfers a single frame
+        self.bus, sock = socket.socketpair(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self.addCleanup(self.bus.close)
+
+        conn = SocketCANConnection.__new__(SocketCANConnection)
+        conn.socket = sock
+        conn.timestamps = False
+        self.conn = conn
+
+    async def test_receive_frames(self):
+        conn = AsyncSocketCANConnection(self.conn)
+        self.addCleanup(conn.close)
+
+        self.bus.send(CAN_FRAME.pack(0x42, 2, bytes((1, 2))))
+        self.bus.send(CAN_FRAME.pack(0x43, 0, bytes()))
+
+        frame = await asyncio.wait_for(conn.receive_frame(), 1)
+        self.assertEqual(Frame(id=0x42, data=bytes((1, 2))), frame)
+
+        frame = await asyncio.wait_for(conn.receive_frame(), 1)
+        self.assertEqual(Frame(id=0x43), frame)
+
+    async def test_send_frames(self):
+        conn = AsyncSocketCANConnection(self.conn)
+        self.addCleanup(conn.close)
+
+        await conn.send_frames([Frame(id=1, data=bytes(8)), Frame(id=2)])
+
+        self.assertEqual(CAN_FRAME.pack(1, 8, bytes(8)), self.bus.recv(16))
+        self.assertEqual(CAN_FRAME.pack(2, 0, bytes()), self.bus.recv(16))
+
+    async def test_send_backs_off_when_queue_is_full(self):
+        conn = AsyncSocketCANConnection(self.conn)
+        self.addCleanup(conn.close)
+
+        full = OSError(errno.ENOBUFS, "No buffer space available")
+        conn.loop = Mock()
+        conn.loop.sock_sendall = CoroutineMock(side_effect=[full, full, None])
+
+        with patch("asyncio.sleep", new_callable=CoroutineMock) as sleep:
+            await conn.send_frame(Frame(id=42))
+
+        self.assertEqual(3, conn.loop.sock_sendall.call_count)
+        self.assertEqual(2, sleep.call_count)
+
+    async def test_socket_is_not_blocking(self):
+        conn = AsyncSocketCANConnection(self.conn)
+        self.addCleanup(conn.close)
+
+        self.assertFalse(self.conn.socket.getblocking())
+
+
+class AsyncSerialCANTestCase(AsyncTestCase):
+    def setUp(self):
+        self.adapter, device = os.openpty()
+        self.addCleanup(os.close, self.adapter)
+        os.set_blocking(self.adapter, False)
+        self.port = serial.Serial(os.ttyname(device), timeout=0)
+        os.close(device)
+
+    async def connect(self):
+        conn = await open_serial_connection(self.port)
+        self.addCleanup(conn.close)
+        return conn
+
+    async def read_adapter(self, size):
+        data = b""
+        for _ in range(100):
+            await asyncio.sleep(0.01)
+
+            try:
+                data += os.read(self.adapter, size - len(data))
+            except BlockingIOError:
+                pass
+
+            if len(data) == size:
+                break
+
+        return data
+
+    async def test_channel_is_opened(self):
+        await self.connect()
+
+        self.assertEqual(b"S8\rO\r", await self.read_adapter(5))
+
+    async def test_receive_frames(self):
+        conn = await self.connect()
+
+        os.write(self.adapter, b"t0422abcd\rT0000cafe0\r")
+
+        frame = await asyncio.wait_for(conn.receive_frame(), 1)
+        self.assertEqual(Frame(id=0x42, data=bytes((0xAB, 0xCD))), frame)
+
+        frame = await asyncio.wait_for(conn.receive_frame(), 1)
+        self.assertEqual(Frame(id=0xCAFE, extended=True), frame)
+
+    async def test_send_frames(self):
+        conn = await self.connect()
+        await self.read_adapter(5)
+
+        await conn.send_frames([Frame(id=1, data=bytes((0xFF,))), Frame(id=2)])
+
+        self.assertEqual(b"t0011ff\rt0020\r", await self.read_adapter(14))
+
+    async def test_closed_port(self):
+        conn = await self.connect()
+        conn.protocol.connection_lost(None)
+
+        with self.assertRaises(ConnectionError):
+            await conn.receive_frame()
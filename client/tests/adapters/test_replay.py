@@ -0,0 +1,130 @@
+from unittest import TestCase
+
+try:
+    from unittest.mock import *
+except ImportError:
+    from mock import *
+
+import contextlib
+import io
+
+import msgpack
+
+from cvra_bootloader import bootloader_flash, commands, utils
+from cvra_bootloader.can import *
+from cvra_bootloader.can.adapters import PcapReplayConnection, ReplayMismatchError
+from cvra_bootloader.can.pcapng import PcapngWriter
+from cvra_bootloader.can.simulation import simulated_fleet
+
+
+def record(*datagrams):
+    """
+    Returns a capture of the given (data, destinations, source, time) datagrams.
+    """
+    capture = io.BytesIO()
+    writer = PcapngWriter(capture)
+    for data, destinations, source, t in datagrams:
+        for frame in datagram_to_frames(encode_datagram(data, destinations), source):
+            writer.write_frame(int(t * 1e9), frame)
+    writer.close()
+    capture.seek(0)
+    return capture
+
+
+class PcapReplayConnectionTestCase(TestCase):
+    def setUp(self):
+        self.ping = commands.encode_ping()
+        self.ok = msgpack.packb(True)
+        self.capture = record(
+            (self.ping, [1, 2], 0, 1.0),
+            (self.ok, [0], 1, 1.01),
+            (self.ok, [0], 2, 1.02),
+        )
+
+    def test_answers_wait_for_the_request(self):
+        conn = PcapReplayConnection(self.capture)
+
+        self.assertIsNone(conn.receive_frame())
+
+        utils.write_command(conn, self.ping, [1, 2])
+        answers = utils.write_command_retry(conn, self.ping, [1, 2])
+
+        self.assertEqual({1: self.ok, 2: self.ok}, answers)
+
+    def test_end_of_capture_times_out(self):
+        conn = PcapReplayConnection(self.capture)
+        utils.write_command(conn, self.ping, [1, 2])
+
+        reader = utils.read_can_datagrams(conn)
+        next(reader), next(reader)
+
+        self.assertIsNone(next(reader))
+
+    def test_verify(self):
+        conn = PcapReplayConnection(self.capture, verify=True)
+        utils.write_command(conn, self.ping, [1, 2])
+
+        self.assertIsNotNone(conn.receive_frame())
+
+    def test_verify_mismatch(self):
+        conn = PcapReplayConnection(self.capture, verify=True)
+        utils.write_command(conn, commands.encode_read_config(), [1, 2])
+
+        with self.assertRaises(ReplayMismatchError):
+            conn.receive_frame()
+
+    @patch("time.sleep")
+    @patch("time.monotonic")
+    def test_realtime(self, monotonic, sleep):
+        monotonic.return_value = 100.0
+        conn = PcapReplayConnection(self.capture, realtime=True)
+        utils.write_command(conn, self.ping, [1, 2])
+
+        conn.receive_frame()
+
+        # The first answer came 10 ms after the request
+        sleep.assert_called_once_with(ANY)
+        self.assertAlmostEqual(0.01, sleep.call_args[0][0])
+
+    @patch("time.sleep")
+    def test_realtime_timeout(self, sleep):
+        conn = PcapReplayConnection(self.capture, realtime=True, read_timeout=0.5)
+
+        self.assertIsNone(conn.receive_frame())
+        sleep.assert_called_once_with(0.5)
+
+    def test_fast_replay_does_not_sleep(self):
+        conn = PcapReplayConnection(self.capture)
+        utils.write_command(conn, self.ping, [1, 2])
+
+        with patch("time.sleep") as sleep:
+            while conn.receive_frame() is not None:
+                pass
+
+        sleep.assert_not_called()
+
+    def test_replay_flash_session(self):
+        """
+        Checks that a flash session recorded on the simulated bus can be
+        replayed, the client sending exactly the same frames.
+        """
+        binary = bytes(range(256)) * 20
+        bus = simulated_fleet([1, 2])
+        capture = io.BytesIO()
+        conn = utils.PcapConnectionWrapper(bus, PcapngWriter(capture))
+
+        with contextlib.redirect_stdout(io.StringIO()):
+            with contextlib.redirect_stderr(io.StringIO()):
+                with patch("time.time_ns", lambda: int(bus.time * 1e9)):
+                    bootloader_flash.flash_binary(
+                        conn, binary, 0x1000, "CVRA.dummy.v1", [1, 2]
+                    )
+                conn.close()
+
+                capture.seek(0)
+                replay = PcapReplayConnection(capture, verify=True)
+                bootloader_flash.flash_binary(
+                    replay, binary, 0x1000, "CVRA.dummy.v1", [1, 2]
+                )
+
+        self.assertEqual(replay.sent, replay.replayed)
@@ -0,0 +1,171 @@
+from unittest import TestCase
+
+try:
+    from unittest.mock import *
+except ImportError:
+    from mock import *
+
+import socket
+import time
+
+from cvra_bootloader.can.adapters import SerialCANConnection
+from cvra_bootloader.utils import SocketSerialAdapter
+from cvra_bootloader.can.slcan import *
+from cvra_bootloader.can import Frame
+
+
+class SlcanCodecTestCase(TestCase):
+    def test_encode_standard_frame(self):
+        frame = Frame(id=0x123, data=bytes((0xDE, 0xAD)))
+        self.assertEqual(b"t1232dead", encode_frame(frame))
+
+    def test_encode_extended_frame(self):
+        frame = Frame(id=0xCAFE, data=bytes((0x01,)), extended=True)
+        self.assertEqual(b"T0000cafe101", encode_frame(frame))
+
+    def test_encode_empty_frame(self):
+        self.assertEqual(b"t0420", encode_frame(Frame(id=0x42)))
+
+    def test_round_trip(self):
+        """
+        Checks that decoding an encoded frame gives back the same frame.
+        """
+        frames = [
+            Frame(id=0x7FF, data=bytes(range(8))),
+            Frame(id=0x80, data=memoryview(bytes(range(3)))),
+            Frame(id=0x1FFFFFFF, data=bytes((0xFF,)), extended=True),
+            Frame(id=0x1),
+        ]
+
+        for frame in frames:
+            decoded = decode_frame(encode_frame(frame))
+            self.assertEqual(frame, decoded)
+            self.assertEqual(frame.extended, decoded.extended)
+            self.assertEqual(frame.data_length, decoded.data_length)
+
+    def test_decode_invalid_messages(self):
+        """
+        Checks that adapter answers and malformed messages are not frames.
+        """
+        for msg in [b"", b"z", b"Z", b"t12", b"x1230", b"t1232de", b"t12g1ff"]:
+            self.assertIsNone(decode_frame(msg), msg)
+
+
+class SlcanStreamDecoderTestCase(TestCase):
+    def test_split_messages(self):
+        """
+        Checks that several messages in one read are all decoded.
+        """
+        decoder = StreamDecoder()
+        frames = decoder.feed(b"t1231aa\rt4560\r")
+
+        self.assertEqual([Frame(0x123, bytes([0xAA])), Frame(0x456)], frames)
+
+    def test_partial_message(self):
+        """
+        Checks that a message split between reads is decoded once complete.
+        """
+        decoder = StreamDecoder()
+
+        self.assertEqual([], decoder.feed(b"t12"))
+        self.assertEqual([], decoder.feed(b"31a"))
+        self.assertEqual([Frame(0x123, bytes([0xAB]))], decoder.feed(b"b\rt4"))
+        self.assertEqual(b"t4", decoder.buf)
+
+    def test_skip_adapter_answers(self):
+        """
+        Checks that acknowledgements and error bells are skipped.
+        """
+        decoder = StreamDecoder()
+        frames = decoder.feed(b"\r\az\r\at1230\r")
+
+        self.assertEqual([Frame(0x123)], frames)
+
+
+class FakeSerialPort:
+    """
+    Serial port returning the given data, then timing out.
+    """
+
+    def __init__(self, data):
+        self.data = bytearray(data)
+        self.written = bytearray()
+
+    @property
+    def in_waiting(self):
+        return len(self.data)
+
+    def read(self, n):
+        if not self.data:
+            time.sleep(0.1)
+            return bytes()
+
+        data = bytes(self.data[:n])
+        del self.data[:n]
+        return data
+
+    def write(self, data):
+        self.written += data
+
+    def reset_input_buffer(self):
+        pass
+
+
+class SerialCANConnectionTestCase(TestCase):
+    def test_open_channel(self):
+        port = FakeSerialPort(b"")
+        SerialCANConnection(port)
+        self.assertEqual(b"S8\rO\r", port.written)
+
+    def test_send_frame(self):
+        port = FakeSerialPort(b"")
+        conn = SerialCANConnection(port)
+        port.written.clear()
+
+        conn.send_frame(Frame(id=0x12, data=bytes((1, 2))))
+
+        self.assertEqual(b"t01220102\r", port.written)
+
+    def test_send_frames(self):
+        """
+        Checks that a batch of frames is sent with a single write.
+        """
+        port = FakeSerialPort(b"")
+        conn = SerialCANConnection(port)
+        port.write = Mock()
+
+        conn.send_frames(iter([Frame(id=0x12), Frame(id=0x13, data=bytes(1))]))
+
+        port.write.assert_called_once_with(b"t0120\rt013100\r")
+
+    def test_receive_frame(self):
+        port = FakeSerialPort(b"z\rt0122abcd\rt0130\r")
+        conn = SerialCANConnection(port, read_timeout=1)
+
+        self.assertEqual(Frame(0x12, bytes((0xAB, 0xCD))), conn.receive_frame())
+        self.assertEqual(Frame(0x13), conn.receive_frame())
+
+    def test_receive_frame_timeout(self):
+        port = FakeSerialPort(b"")
+        conn = SerialCANConnection(port, read_timeout=0.01)
+        self.assertIsNone(conn.receive_frame())
+
+    def test_socket_adapter(self):
+        """
+        Checks that the connection works over a socket, e.g. to a TCP to
+        serial bridge.
+        """
+        host, bridge = socket.socketpair()
+        host.settimeout(0.1)
+
+        conn = SerialCANConnection(SocketSerialAdapter(host), read_timeout=0.5)
+        bridge.sendall(b"t0122abcd\r")
+        self.assertEqual(Frame(0x12, bytes((0xAB, 0xCD))), conn.receive_frame())
+        self.assertEqual(b"S8\rO\r", bridge.recv(100))
+
+        # The reader stops once the bridge closes the connection
+        with patch("logging.error") as error:
+            bridge.close()
+            conn.receive_frame()
+
+        error.assert_any_call("Cannot read from the CAN adapter: Connection closed")
@@ -6,6 +6,7 @@ except ImportError:
     from mock import *
 
 
+import errno
 import socket
 import struct
 from cvra_bootloader.can.adapters import SocketCANConnection
@@ -17,6 +18,14 @@ try:
 except ImportError:
     socket.AF_CAN = "AF_CAN"
     socket.CAN_RAW = "CAN_RAW"
+    socket.SOL_CAN_RAW = 101
+    socket.CAN_RAW_FILTER = 1
+    socket.CAN_RAW_LOOPBACK = 3
+    socket.CAN_RAW_RECV_OWN_MSGS = 4
+    socket.CAN_EFF_FLAG = 0x80000000
+    socket.CAN_RTR_FLAG = 0x40000000
+    socket.CAN_SFF_MASK = 0x000007FF
+    socket.CAN_EFF_MASK = 0x1FFFFFFF
 
 
 @patch("socket.socket")
@@ -35,6 +44,29 @@ class SocketCANTestCase(TestCase):
             socket.SOL_SOCKET, socket.SO_SNDBUF, 4096
         )
 
+    def test_bootloader_frames_filter(self, socket_create):
+        """
+        Checks that the kernel only gives us standard frames with the 3
+        reserved bits cleared.
+        """
+        SocketCANConnection("vcan0")
+
+        can_filter = struct.pack("=II", 0, 0x80000000 | 0x40000000 | 0x700)
+        socket_create.return_value.setsockopt.assert_any_call(
+            socket.SOL_CAN_RAW, socket.CAN_RAW_FILTER, can_filter
+        )
+
+    def test_own_messages_are_not_received(self, socket_create):
+        """
+        Checks that we do not read our own frames back, while keeping them
+        visible to other sockets on the host.
+        """
+        SocketCANConnection("vcan0")
+
+        setsockopt = socket_create.return_value.setsockopt
+        setsockopt.assert_any_call(socket.SOL_CAN_RAW, socket.CAN_RAW_RECV_OWN_MSGS, 0)
+        setsockopt.assert_any_call(socket.SOL_CAN_RAW, socket.CAN_RAW_LOOPBACK, 1)
+
     def test_can_send_frame(self, socket_create):
         s = SocketCANConnection("vcan0")
         s.socket = Mock()
@@ -51,6 +83,43 @@ class SocketCANTestCase(TestCase):
 
         s.socket.send.assert_any_call(can_frame)
 
+    def test_can_send_frames(self, socket_create):
+        s = SocketCANConnection("vcan0")
+        s.socket = Mock()
+
+        frames = [Frame(id=42, data=bytes((1,))), Frame(id=43, data=bytes(8))]
+        s.send_frames(iter(frames))
+
+        expected = [
+            call(struct.pack("=IB3x8s", 42, 1, bytes((1,)))),
+            call(struct.pack("=IB3x8s", 43, 8, bytes(8))),
+        ]
+        self.assertEqual(expected, s.socket.send.call_args_list)
+
+    @patch("time.sleep")
+    def test_send_backs_off_when_queue_is_full(self, sleep, socket_create):
+        """
+        Checks that a full transmit queue (ENOBUFS) makes us wait and retry.
+        """
+        s = SocketCANConnection("vcan0")
+        s.socket = Mock()
+        full = OSError(errno.ENOBUFS, "No buffer space available")
+        s.socket.send.side_effect = [full, full, 16]
+
+        s.send_frame(Frame(id=42))
+
+        self.assertEqual(3, s.socket.send.call_count)
+        self.assertEqual(2, sleep.call_count)
+        self.assertLess(sleep.call_args_list[0], sleep.call_args_list[1])
+
+    def test_send_raises_other_errors(self, socket_create):
+        s = SocketCANConnection("vcan0")
+        s.socket = Mock()
+        s.socket.send.side_effect = OSError(errno.ENETDOWN, "Network is down")
+
+        with self.assertRaises(OSError):
+            s.send_frame(Frame(id=42))
+
     def test_receive_frame(self, socket_create):
         s = SocketCANConnection("vcan0")
         s.socket = Mock()
@@ -67,6 +136,48 @@ class SocketCANTestCase(TestCase):
 
         self.assertEqual(expected_frame, actual_frame)
 
+    def test_receive_extended_frame(self, socket_create):
+        s = SocketCANConnection("vcan0")
+        s.socket = Mock()
+
+        can_frame = struct.pack("=IB3x8s", 0x80000000 | 0x1234, 1, bytes(8))
+        s.socket.recvfrom.return_value = (can_frame, ("vcan0"))
+
+        frame = s.receive_frame()
+
+        self.assertTrue(frame.extended)
+        self.assertEqual(0x1234, frame.id)
+
+    def test_kernel_timestamps(self, socket_create):
+        """
+        Checks that frames are timestamped by the kernel when requested.
+        """
+        s = SocketCANConnection("vcan0", timestamps=True)
+        s.socket.setsockopt.assert_any_call(socket.SOL_SOCKET, 35, 1)
+
+        can_frame = struct.pack("=IB3x8s", 42, 1, bytes(8))
+        timespec = struct.pack("@ll", 1600000000, 123456789)
+        s.socket.recvmsg.return_value = (
+            can_frame,
+            [(socket.SOL_SOCKET, 35, timespec)],
+            0,
+            None,
+        )
+
+        frame = s.receive_frame()
+
+        self.assertEqual(42, frame.id)
+        self.assertEqual(1600000000123456789, frame.timestamp)
+
+    def test_no_timestamps_by_default(self, socket_create):
+        s = SocketCANConnection("vcan0")
+        s.socket = Mock()
+
+        can_frame = struct.pack("=IB3x8s", 42, 1, bytes(8))
+        s.socket.recvfrom.return_value = (can_frame, ("vcan0"))
+
+        self.assertIsNone(s.receive_frame().timestamp)
+
     def test_receive_frame_timeout(self, socket_create):
         s = SocketCANConnection("vcan0")
         s.socket = Mock()
@@ -0,0 +1,62 @@
+"""
+Support for testing coroutines on Python 3.7, which has neither
+unittest.IsolatedAsyncioTestCase nor unittest.mock.AsyncMock.
+"""
+import asyncio
+import functools
+import unittest
+
+try:
+    from unittest.mock import Mock
+except ImportError:
+    from mock import Mock
+
+
+def close_loop(loop):
+    """
+    Cancels the tasks left in the given event loop, then closes it.
+    """
+    tasks = asyncio.all_tasks(loop)
+    for task in tasks:
+        task.cancel()
+
+    loop.run_until_complete(asyncio.gather(*tasks, return_exceptions=True))
+    loop.run_until_complete(loop.shutdown_asyncgens())
+    loop.close()
+
+
+class AsyncTestCase(unittest.TestCase):
+    """
+    Test case whose coroutine test methods run in their own event loop. The
+    loop is closed after the cleanups registered by the test, so they can
+    still use it.
+
+    Patch decorators do not support coroutines before Python 3.8, use patch
+    as a context manager in the tests instead.
+    """
+
+    def __init__(self, methodName="runTest"):
+        super().__init__(methodName)
+        method = getattr(self, methodName, None)
+
+        if asyncio.iscoroutinefunction(method):
+
+            @functools.wraps(method)
+            def run():
+                loop = asyncio.new_event_loop()
+                asyncio.set_event_loop(loop)
+                self.addCleanup(asyncio.set_event_loop, None)
+                self.addCleanup(close_loop, loop)
+
+                return loop.run_until_complete(method())
+
+            setattr(self, methodName, run)
+
+
+class CoroutineMock(Mock):
+    """
+    Mock which is called like a coroutine function, like AsyncMock.
+    """
+
+    async def __call__(self, *args, **kwargs):
+        return super().__call__(*args, **kwargs)
@@ -0,0 +1,153 @@
+import asyncio
+import unittest
+
+try:
+    from unittest.mock import *
+except ImportError:
+    from mock import *
+
+from zlib import crc32
+
+import msgpack
+
+from cvra_bootloader import aio, commands
+from cvra_bootloader.can.simulation import simulated_fleet
+from tests.aio_support import AsyncTestCase, CoroutineMock
+
+
+class SimulatedConnection:
+    """
+    Asynchronous connection to a simulated bus, which delivers the answers of
+    the boards as soon as a command was sent.
+    """
+
+    def __init__(self, bus):
+        self.bus = bus
+        self.rx_queue = asyncio.Queue()
+
+    async def send_frames(self, frames):
+        self.bus.send_frames(frames)
+
+        frame = self.bus.receive_frame()
+        while frame is not None:
+            self.rx_queue.put_nowait(frame)
+            frame = self.bus.receive_frame()
+
+    async def receive_frame(self):
+        frame = await self.rx_queue.get()
+
+        if isinstance(frame, Exception):
+            raise frame
+
+        return frame
+
+
+class AsyncClientTestCase(AsyncTestCase):
+    def connect(self, ids=(1, 2)):
+        bus = simulated_fleet(ids, device_class="dummy", page_size=16)
+        conn = SimulatedConnection(bus)
+        self.addCleanup(aio.get_dispatcher(conn).close)
+        return conn
+
+    async def test_ping(self):
+        conn = self.connect()
+
+        self.assertTrue(await aio.ping_board(conn, 1))
+        self.assertFalse(await aio.ping_board(conn, 3, timeout=0.01))
+
+    async def test_check_online_boards(self):
+        conn = self.connect()
+
+        online = await aio.check_online_boards(conn, [1, 2, 3], timeout=0.01)
+
+        self.assertEqual({1, 2}, online)
+
+    async def test_write_command_retry(self):
+        conn = self.connect()
+
+        answers = await aio.write_command_retry(conn, commands.encode_ping(), [1, 2])
+
+        self.assertEqual({1: msgpack.packb(True), 2: msgpack.packb(True)}, answers)
+
+    async def test_retry_limit(self):
+        conn = self.connect()
+        conn.send_frames = CoroutineMock()
+
+        with patch("logging.warning"), patch("logging.critical"):
+            with self.assertRaises(IOError):
+                await aio.write_command_retry(
+                    conn, commands.encode_ping(), [1], retry_limit=2, timeout=0.01
+                )
+
+        self.assertEqual(2 + 1, conn.send_frames.call_count)
+        self.assertEqual({}, aio.get_dispatcher(conn).futures)
+
+    async def test_config(self):
+        conn = self.connect()
+
+        await aio.config_update_and_save(conn, {"name": "arm"}, [1, 2])
+        configs = await aio.read_config(conn, [1, 2])
+
+        self.assertEqual("arm", configs[1]["name"])
+        self.assertEqual("arm", conn.bus.nodes[1].saved_config["name"])
+
+    async def test_flash_and_check(self):
+        conn = self.connect()
+        binary = bytes(range(40))
+
+        await aio.flash_binary(conn, binary, 0x1000, "dummy", [1, 2], page_size=16)
+        valid = await aio.check_binary(conn, binary, 0x1000, [1, 2])
+
+        self.assertEqual([1, 2], valid)
+        self.assertEqual(crc32(binary), conn.bus.nodes[0].config["application_crc"])
+
+    async def test_flash_failure(self):
+        conn = self.connect()
+
+        with self.assertRaises(IOError):
+            await aio.flash_binary(conn, bytes(4), 0x1000, "other", [1])
+
+    async def test_concurrent_buses(self):
+        """
+        Checks that several buses can be flashed concurrently.
+        """
+        conns = [self.connect(), self.connect([3])]
+        binary = bytes(32)
+
+        await asyncio.gather(
+            aio.flash_binary(conns[0], binary, 0x1000, "dummy", [1, 2], page_size=16),
+            aio.flash_binary(conns[1], binary, 0x1000, "dummy", [3], page_size=16),
+        )
+
+        valid = await asyncio.gather(
+            aio.check_binary(conns[0], binary, 0x1000, [1, 2]),
+            aio.check_binary(conns[1], binary, 0x1000, [3]),
+        )
+        self.assertEqual([[1, 2], [3]], valid)
+
+    async def test_concurrent_commands(self):
+        """
+        Checks that several commands can be in flight on the same bus.
+        """
+        conn = self.connect()
+
+        results = await asyncio.gather(aio.ping_board(conn, 1), aio.ping_board(conn, 2))
+
+        self.assertEqual([True, True], results)
+
+    async def test_connection_error(self):
+        """
+        Checks that an error of the connection reaches the waiting requests.
+        """
+        conn = self.connect()
+        conn.send_frames = CoroutineMock()
+        dispatcher = aio.get_dispatcher(conn)
+
+        futures = await dispatcher.send(commands.encode_ping(), [1])
+        conn.rx_queue.put_nowait(ConnectionError())
+
+        with patch("logging.error"):
+            await dispatcher.wait(futures.values(), timeout=1)
+
+        with self.assertRaises(ConnectionError):
+            futures[1].result()
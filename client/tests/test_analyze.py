@@ -0,0 +1,208 @@
+import unittest
+
+import msgpack
+
+from cvra_bootloader.analyze import *
+from cvra_bootloader.can import *
+from cvra_bootloader.commands import *
+
+
+def frames(command, destinations, source, timestamp):
+    """
+    Returns the frames of the given datagram, all timestamped in seconds.
+    """
+    datagram = encode_datagram(command, destinations)
+    result = list(datagram_to_frames(datagram, source))
+    for frame in result:
+        frame.timestamp = int(timestamp * 1e9)
+    return result
+
+
+class CommandNameTestCase(unittest.TestCase):
+    def test_command_name(self):
+        self.assertEqual("erase", command_name(encode_erase_flash_page(0, "")))
+        self.assertEqual("ping", command_name(encode_ping()))
+        self.assertEqual(
+            "write_compressed",
+            command_name(encode_write_flash_compressed(bytes(16), 0x1000, "")),
+        )
+
+    def test_invalid_command(self):
+        self.assertIsNone(command_name(msgpack.packb(1)))
+
+
+class LatencyHistogramTestCase(unittest.TestCase):
+    def test_statistics(self):
+        h = LatencyHistogram()
+        for latency in [0.001] * 9 + [0.1]:
+            h.add(latency)
+
+        summary = h.summary()
+        self.assertEqual(10, summary["count"])
+        self.assertEqual(0.001, summary["min"])
+        self.assertEqual(0.1, summary["max"])
+        self.assertAlmostEqual(0.0109, summary["mean"])
+
+    def test_percentiles_are_close_upper_bounds(self):
+        h = LatencyHistogram()
+        for latency in [0.001] * 9 + [0.1]:
+            h.add(latency)
+
+        self.assertGreaterEqual(h.percentile(50), 0.001)
+        self.assertLess(h.percentile(50), 0.0011)
+        self.assertEqual(0.1, h.percentile(99))
+
+    def test_empty(self):
+        self.assertIsNone(LatencyHistogram().summary())
+
+
+class SessionAnalyzerTestCase(unittest.TestCase):
+    def setUp(self):
+        self.analyzer = SessionAnalyzer()
+        self.ok = msgpack.packb(True)
+
+    def feed(self, *datagrams):
+        for datagram in datagrams:
+            for frame in frames(*datagram):
+                self.analyzer.input_frame(frame)
+
+    def test_latency(self):
+        erase = encode_erase_flash_page(0x1000, "dummy")
+        self.feed(
+            (erase, [1, 2], 0, 1.0),
+            (self.ok, [0], 1, 1.02),
+            (self.ok, [0], 2, 1.03),
+        )
+
+        report = self.analyzer.report()
+
+        latency = report["commands"]["erase"]["latency"]
+        self.assertEqual(2, latency["count"])
+        self.assertAlmostEqual(0.02, latency["min"])
+        self.assertAlmostEqual(0.03, latency["max"])
+        self.assertAlmostEqual(0.03, report["nodes"][2]["latency"]["max"])
+        self.assertEqual(1, report["commands"]["erase"]["requests"])
+        self.assertEqual(1, report["nodes"][1]["requests"])
+
+    def test_retries(self):
+        write = encode_write_flash(bytes(16), 0x1000, "dummy")
+        self.feed(
+            (write, [1, 2], 0, 1.0),
+            (self.ok, [0], 1, 1.1),
+            (write, [2], 0, 1.5),
+            (self.ok, [0], 2, 1.6),
+        )
+
+        report = self.analyzer.report()
+
+        self.assertEqual(1, report["commands"]["write"]["requests"])
+        self.assertEqual(1, report["commands"]["write"]["retries"])
+        self.assertEqual(0, report["nodes"][1]["retries"])
+        self.assertEqual(1, report["nodes"][2]["retries"])
+
+        # The latency is measured from the last retry
+        self.assertAlmostEqual(0.1, report["nodes"][2]["latency"]["max"])
+
+    def test_unanswered(self):
+        self.feed((encode_ping(), [1], 0, 1.0), (encode_read_config(), [1], 0, 2.0))
+
+        report = self.analyzer.report()
+
+        self.assertEqual(1, report["commands"]["ping"]["unanswered"])
+        self.assertEqual(1, report["commands"]["read_config"]["unanswered"])
+        self.assertEqual(2, report["nodes"][1]["unanswered"])
+
+    def test_errors(self):
+        erase = encode_erase_flash_page(0x1000, "dummy")
+        self.feed((erase, [1], 0, 1.0), (msgpack.packb(False), [0], 1, 1.02))
+
+        self.assertEqual(1, self.analyzer.report()["commands"]["erase"]["errors"])
+
+    def test_answers_to_other_hosts_are_ignored(self):
+        self.feed((encode_ping(), [1], 0, 1.0), (self.ok, [5], 1, 1.02))
+
+        report = self.analyzer.report()
+
+        self.assertIsNone(report["commands"]["ping"]["latency"])
+
+    def test_sources_are_decoded_like_the_client(self):
+        """
+        Checks that frames are reassembled by the same code as in the client,
+        which keeps all the bits of the ID except the start of datagram one.
+        """
+        self.feed((encode_ping(), [1], 0, 1.0))
+
+        for frame in frames(self.ok, [0], 1, 1.02):
+            frame.id |= 0x100
+            self.analyzer.input_frame(frame)
+
+        self.assertIsNone(self.analyzer.report()["commands"]["ping"]["latency"])
+
+    def test_invalid_datagrams(self):
+        datagram = encode_datagram(encode_ping(), [1])
+        datagram[-1] ^= 0xFF
+
+        for frame in datagram_to_frames(datagram, 0):
+            frame.timestamp = 0
+            self.analyzer.input_frame(frame)
+
+        self.feed((encode_ping(), [1], 0, 1.0), (self.ok, [0], 1, 1.02))
+
+        self.assertEqual(1, self.analyzer.invalid_datagrams)
+        self.assertEqual(2, self.analyzer.datagrams)
+
+    def test_compressed_writes(self):
+        write = encode_write_flash_compressed(bytes(64), 0x1000, "dummy")
+        self.feed(
+            (write, [1], 0, 1.0),
+            (self.ok, [0], 1, 1.01),
+        )
+
+        report = self.analyzer.report()
+
+        self.assertEqual(1, report["commands"]["write_compressed"]["requests"])
+        self.assertNotIn("unknown", report["commands"])
+
+    def test_time_spent(self):
+        erase = encode_erase_flash_page(0x1000, "dummy")
+        write = encode_write_flash(bytes(4), 0x1000, "dummy")
+        self.feed(
+            (erase, [1], 0, 1.0),
+            (self.ok, [0], 1, 1.2),
+            (write, [1], 0, 2.0),
+            (self.ok, [0], 1, 2.5),
+        )
+
+        time_spent = self.analyzer.report()["time_spent"]
+
+        self.assertAlmostEqual(0.2, time_spent["erase"])
+        self.assertAlmostEqual(0.5, time_spent["write"])
+        self.assertAlmostEqual(0.8, time_spent["idle"])
+
+    def test_time_spent_on_lost_answers_is_bounded(self):
+        self.analyzer.timeout = 0.5
+        self.feed((encode_ping(), [1], 0, 1.0), (encode_ping(), [2], 0, 3.0))
+
+        time_spent = self.analyzer.report()["time_spent"]
+
+        self.assertAlmostEqual(0.5, time_spent["ping"])
+        self.assertAlmostEqual(1.5, time_spent["idle"])
+
+    def test_bus_load(self):
+        self.analyzer.interval = 0.5
+        self.feed((encode_ping(), [1], 0, 1.0), (encode_ping(), [1], 0, 2.2))
+
+        report = self.analyzer.report()
+
+        self.assertEqual(3, len(report["bus_load"]))
+        self.assertGreater(report["bus_load"][0], 0)
+        self.assertEqual(0, report["bus_load"][1])
+        self.assertGreater(report["bus_load"][2], 0)
+
+    def test_format_report(self):
+        self.feed((encode_ping(), [1], 0, 1.0), (self.ok, [0], 1, 1.001))
+
+        text = format_report(self.analyzer.report())
+
+        self.assertIn("ping", text)
+        self.assertIn("node 1", text)
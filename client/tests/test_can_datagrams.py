@@ -1,4 +1,5 @@
 import unittest
+import tracemalloc
 from struct import unpack_from, pack
 from zlib import crc32
 from cvra_bootloader.can import *
@@ -77,6 +78,13 @@ class CanDatagramTestCase(unittest.TestCase):
         with self.assertRaises(ValueError):
             Frame(data=bytes(range(10)))
 
+    def test_frame_has_no_instance_dict(self):
+        """
+        Checks that frames use slots, keeping them compact.
+        """
+        with self.assertRaises(AttributeError):
+            Frame().foo = 0
+
     def assertBitSet(self, value, bit):
         value = value & (1 << bit)
         self.assertTrue(value, "Bit {} not set".format(bit))
@@ -132,6 +140,26 @@ class CanDatagramTestCase(unittest.TestCase):
 
         self.assertEqual(recomposed_data, list(dt))
 
+    def test_frames_do_not_copy(self):
+        """
+        Checks that frames are views on the datagram.
+        """
+        dt = encode_datagram(bytes(range(20)), [1])
+        frames = list(datagram_to_frames(dt, source=42))
+
+        self.assertEqual([8, 8, 8, 7], [len(f.data) for f in frames])
+        for f in frames:
+            self.assertIs(dt, f.data.obj)
+
+    def test_datagram_multiple_of_frame_size(self):
+        """
+        Checks that a datagram filling exactly its frames does not give an
+        empty trailing frame.
+        """
+        dt = encode_datagram(bytes(5), [1])
+        self.assertEqual(16, len(dt))
+        self.assertEqual(2, len(list(datagram_to_frames(dt, source=0))))
+
     def test_receive_datagram(self):
         """
         Checks that we can correctly decode data of a received datagram.
@@ -157,6 +185,13 @@ class CanDatagramTestCase(unittest.TestCase):
         dt = dt[:-1]  # remove end of datagram
         self.assertIsNone(decode_datagram(dt))
 
+    def test_receive_incomplete_destinations(self):
+        """
+        Checks that we return None if the destination list is incomplete.
+        """
+        dt = encode_datagram(bytes([1, 2, 3]), [1, 2, 3])
+        self.assertIsNone(decode_datagram(dt[:7]))
+
     def test_wrong_version_raise_exception(self):
         """
         Checks that receiving a datagram with wrong version raises an exception.
@@ -186,3 +221,83 @@ class CanDatagramTestCase(unittest.TestCase):
         """
         self.assertFalse(is_start_of_datagram(Frame(id=2)))
         self.assertTrue(is_start_of_datagram(Frame(id=2 + (1 << 7))))
+
+
+class DatagramReaderTestCase(unittest.TestCase):
+    """
+    Tests for the incremental datagram decoder.
+    """
+
+    def feed(self, reader, data, chunk_size=8):
+        """
+        Feeds the data in chunks, returning the result of each input.
+        """
+        return [
+            reader.input_bytes(data[i : i + chunk_size])
+            for i in range(0, len(data), chunk_size)
+        ]
+
+    def test_decode_in_chunks(self):
+        """
+        Checks that a datagram is only decoded once all chunks were received.
+        """
+        data = bytes(range(100))
+        results = self.feed(DatagramReader(), encode_datagram(data, [1, 2]))
+
+        self.assertEqual([None] * (len(results) - 1), results[:-1])
+        self.assertEqual((data, [1, 2]), results[-1])
+
+    def test_decode_byte_per_byte(self):
+        """
+        Checks that the header can be split anywhere.
+        """
+        data = bytes(range(10))
+        results = self.feed(DatagramReader(), encode_datagram(data, [3]), 1)
+        self.assertEqual((data, [3]), results[-1])
+
+    def test_decode_empty_datagram(self):
+        """
+        Checks that a datagram without data is decoded.
+        """
+        results = self.feed(DatagramReader(), encode_datagram(bytes(), [1]))
+        self.assertEqual((bytes(), [1]), results[-1])
+
+    def test_trailing_bytes_are_ignored(self):
+        """
+        Checks that bytes after a complete datagram are ignored, like in the
+        firmware.
+        """
+        reader = DatagramReader()
+        self.assertIsNotNone(reader.input_bytes(encode_datagram(bytes(3), [1])))
+        self.assertIsNone(reader.input_bytes(bytes(3)))
+
+    def test_wrong_version_raise_exception(self):
+        """
+        Checks that the version is checked as soon as it is received.
+        """
+        with self.assertRaises(VersionMismatchError):
+            DatagramReader().input_bytes(bytes([0]))
+
+    def test_wrong_crc_raise_exception(self):
+        """
+        Checks that a corrupted datagram raises an exception.
+        """
+        dt = encode_datagram(bytes([1, 2, 3]), [1])
+        dt = dt[:-1] + bytes([42])
+
+        with self.assertRaises(CRCMismatchError):
+            self.feed(DatagramReader(), dt)
+
+    def test_length_from_the_bus_is_not_allocated(self):
+        """
+        Checks that a stray header announcing a huge datagram does not
+        allocate it.
+        """
+        tracemalloc.start()
+        self.addCleanup(tracemalloc.stop)
+
+        reader = DatagramReader()
+        reader.input_bytes(bytes([1, 0, 0, 0, 0, 0, 0x40, 0]))
+        reader.input_bytes(bytes(8))
+
+        self.assertLess(tracemalloc.get_traced_memory()[1], 1 << 20)
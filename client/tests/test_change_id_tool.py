@@ -20,7 +20,15 @@ class BootloaderChangeIdTestCase(unittest.TestCase):
         main()
 
         command = cvra_bootloader.commands.encode_update_config({"ID": 2})
-        write_command.assert_any_call(open_connection.return_value, command, [1])
+        write_command.assert_any_call(
+            open_connection.return_value, command, [1], answer_ids=[2]
+        )
 
         command = cvra_bootloader.commands.encode_save_config()
         write_command.assert_any_call(open_connection.return_value, command, [2])
+
+    def test_buses_are_not_supported(self):
+        sys.argv = "test.py --bus can0=1 1 2".split()
+
+        with patch("sys.stderr"), self.assertRaises(SystemExit):
+            main()
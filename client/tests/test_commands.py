@@ -1,4 +1,5 @@
 import unittest
+from cvra_bootloader import compression
 from cvra_bootloader.commands import *
 from msgpack import Unpacker
 
@@ -149,3 +150,63 @@ class PingTestCase(unittest.TestCase):
 
     def test_ping(self):
         self.assertEqual(self.command[0], 5)
+
+
+class WriteCompressedCommandTestCase(unittest.TestCase):
+    """
+    Tests for the compressed write command.
+    """
+
+    def setUp(self):
+        self.data = b"xkcd" * 100
+        raw_packet = encode_write_flash_compressed(self.data, 0xDEADBEEF, "dummy")
+
+        unpacker = Unpacker()
+        unpacker.feed(raw_packet)
+        self.command = list(unpacker)[1:]
+
+    def test_command_index(self):
+        self.assertEqual(CommandType.WriteCompressed, self.command[0])
+
+    def test_arguments(self):
+        address, _, size, data = self.command[1]
+
+        self.assertEqual(0xDEADBEEF, address)
+        self.assertEqual(len(self.data), size)
+        self.assertEqual(self.data, compression.decompress(data, size))
+
+    def test_page_write_is_compressed_if_shorter(self):
+        command = encode_page_writes(self.data, 0xDEADBEEF, "dummy", compress=True)
+        self.assertEqual(
+            [encode_write_flash_compressed(self.data, 0xDEADBEEF, "dummy")], command
+        )
+
+        command = encode_page_writes(bytes(range(16)), 0x1000, "dummy", compress=True)
+        self.assertEqual(
+            [encode_write_flash(bytes(range(16)), 0x1000, "dummy")], command
+        )
+
+    def test_page_write_is_not_compressed_by_default(self):
+        command = encode_page_writes(self.data, 0xDEADBEEF, "dummy")
+        self.assertEqual([encode_write_flash(self.data, 0xDEADBEEF, "dummy")], command)
+
+    def test_compressed_blocks_are_limited(self):
+        """
+        Checks that the data is split in blocks the bootloader can decompress.
+        """
+        data = bytes(2048 + 100)
+        writes = encode_page_writes(data, 0x1000, "dummy", compress=True)
+
+        unpacker = Unpacker()
+        for write in writes:
+            unpacker.feed(write)
+        # Each command is made of the version, the index and the arguments
+        blocks = list(unpacker)[2::3]
+
+        self.assertEqual(
+            [(0x1000, 1024), (0x1400, 1024), (0x1800, 100)],
+            [(address, size) for address, _, size, _ in blocks],
+        )
+
+        with self.assertRaises(ValueError):
+            encode_write_flash_compressed(bytes(1025), 0x1000, "dummy")
@@ -0,0 +1,75 @@
+import os
+import unittest
+
+from cvra_bootloader.compression import *
+
+
+class CompressionTestCase(unittest.TestCase):
+    def assertRoundTrip(self, data):
+        compressed = compress(data)
+        self.assertEqual(data, decompress(compressed, len(data)))
+        return compressed
+
+    def test_empty(self):
+        self.assertEqual(bytes([0]), self.assertRoundTrip(b""))
+
+    def test_short_data_is_stored_as_literals(self):
+        self.assertEqual(b"\x40xkcd", self.assertRoundTrip(b"xkcd"))
+
+    def test_repetitive_data(self):
+        data = b"xkcd" * 20 + b"end of block"
+        compressed = self.assertRoundTrip(data)
+
+        self.assertEqual(b"\x4fxkcd\x04\x00", compressed[:7])
+        self.assertLess(len(compressed), 25)
+
+    def test_erased_flash(self):
+        compressed = self.assertRoundTrip(b"\xff" * 2048)
+        self.assertLess(len(compressed), 20)
+
+    def test_long_literals(self):
+        self.assertRoundTrip(os.urandom(1000))
+
+    def test_firmware_like_data(self):
+        # Functions differing by a single immediate
+        data = b"".join(
+            b"\x08\xb5\x4b" + bytes([i]) + b"\x98\x47\x00\xbf\x08\xbd\x70\x47"
+            for i in range(256)
+        )
+        compressed = self.assertRoundTrip(data)
+        self.assertLess(len(compressed), len(data) // 2)
+
+    def test_last_literals(self):
+        """
+        Checks that blocks end with 5 literals, as required by the LZ4 format.
+        """
+        compressed = compress(b"a" * 100)
+        self.assertEqual(b"\x50aaaaa", compressed[-6:])
+
+
+class DecompressionTestCase(unittest.TestCase):
+    def test_overlapping_match(self):
+        self.assertEqual(b"\xff" * 11, decompress(bytes([0x16, 0xFF, 1, 0]), 64))
+
+    def test_extended_lengths(self):
+        block = bytes([0x1F, ord("a"), 1, 0, 255, 1])
+        self.assertEqual(b"a" * 276, decompress(block, 300))
+
+    def test_max_size(self):
+        with self.assertRaises(ValueError):
+            decompress(bytes([0x16, 0xFF, 1, 0]), 10)
+
+        with self.assertRaises(ValueError):
+            decompress(b"\x40xkcd", 3)
+
+    def test_invalid_offset(self):
+        with self.assertRaises(ValueError):
+            decompress(bytes([0x10, ord("a"), 2, 0]), 64)
+
+        with self.assertRaises(ValueError):
+            decompress(bytes([0x10, ord("a"), 0, 0]), 64)
+
+    def test_truncated_block(self):
+        for block in (b"\x40xk", b"\x10a\x01", b"\xf0\xff"):
+            with self.assertRaises(ValueError):
+                decompress(block, 64)
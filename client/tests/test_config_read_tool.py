@@ -65,5 +65,5 @@ class ReadConfigToolTestCase(unittest.TestCase):
 
         main()
         write_command.assert_any_call(
-            open_conn.return_value, encode_ping(), list(range(1, 128))
+            open_conn.return_value, encode_ping(), list(range(1, 128)), 0
         )
@@ -26,6 +26,21 @@ class WriteConfigToolTestCase(unittest.TestCase):
         open_mock.assert_any_call("test.json")
         config_save.assert_any_call(open_conn.return_value, {"foo": 12}, [1, 2, 3])
 
+    @patch("cvra_bootloader.utils.config_update_and_save")
+    @patch("cvra_bootloader.utils.open_bus_connection")
+    @patch("builtins.open")
+    @patch("builtins.print")
+    def test_several_buses(self, print_mock, open_mock, open_bus, config_save):
+        sys.argv = "test.py -c test.json --bus can0=1,2 --bus can1=3".split()
+        open_mock.return_value = StringIO('{"foo":12}')
+        open_bus.side_effect = lambda args, bus: bus.device
+
+        main()
+
+        config_save.assert_any_call("can0", {"foo": 12}, [1, 2])
+        config_save.assert_any_call("can1", {"foo": 12}, [3])
+        print_mock.assert_any_call("can1: OK")
+
     @patch("builtins.open")
     @patch("builtins.print")
     def test_fails_on_ID_change(self, print_mock, open_mock):
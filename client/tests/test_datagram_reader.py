@@ -163,3 +163,23 @@ class CANDatagramReaderTestCase(unittest.TestCase):
         self.assertEqual(dt.decode("ascii"), "Hello world")
         self.assertEqual(dst, [1])
         self.assertEqual(src, 42)
+
+    def test_drop_frames_without_start(self):
+        """
+        Checks that frames of a datagram whose start was missed are dropped.
+        """
+        data = cvra_bootloader.can.encode_datagram(bytes(20), destinations=[1])
+        frames = list(cvra_bootloader.can.datagram_to_frames(data, source=42))
+
+        data = cvra_bootloader.can.encode_datagram(bytes(3), destinations=[2])
+        frames = frames[1:] + list(
+            cvra_bootloader.can.datagram_to_frames(data, source=42)
+        )
+
+        fdesc = Mock()
+        fdesc.receive_frame.side_effect = frames
+
+        dt, dst, src = next(read_can_datagrams(fdesc))
+
+        self.assertEqual(dt, bytes(3))
+        self.assertEqual(dst, [2])
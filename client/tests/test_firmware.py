@@ -0,0 +1,244 @@
+import os
+import struct
+import tempfile
+import unittest
+
+try:
+    from unittest.mock import *
+except ImportError:
+    from mock import *
+
+from cvra_bootloader import bootloader_flash
+from cvra_bootloader.can.simulation import simulated_fleet
+from cvra_bootloader.firmware import *
+
+
+def hex_record(kind, address, data):
+    record = bytes([len(data), address >> 8, address & 0xFF, kind]) + data
+    record += bytes([-sum(record) & 0xFF])
+    return ":" + record.hex().upper()
+
+
+def elf32(segments, encoding="<"):
+    """
+    Builds a minimal 32 bit ELF file loading the given (kind, address, data)
+    segments.
+    """
+    phoff, phentsize = 52, 32
+    offset = phoff + phentsize * len(segments)
+
+    header = b"\x7fELF" + bytes([1, 1 if encoding == "<" else 2, 1]) + bytes(9)
+    header += struct.pack(
+        encoding + "HHIIIIIHHHHHH",
+        *(2, 40, 1, 0, phoff, 0, 0, 52, phentsize, len(segments), 0, 0, 0)
+    )
+
+    program_headers, contents = b"", b""
+    for kind, address, data in segments:
+        program_headers += struct.pack(
+            encoding + "IIIIIIII",
+            kind,
+            offset + len(contents),
+            address + 0x10000000,  # virtual address, e.g. in RAM
+            address,
+            len(data),
+            len(data),
+            5,
+            4,
+        )
+        contents += data
+
+    return header + program_headers + contents
+
+
+class IntelHexTestCase(unittest.TestCase):
+    def test_data_records(self):
+        text = "\n".join(
+            [
+                hex_record(0x04, 0, bytes([0x08, 0x00])),
+                hex_record(0x00, 0x3800, bytes(range(16))),
+                hex_record(0x00, 0x3810, bytes(range(4))),
+                hex_record(0x00, 0x4000, bytes([42])),
+                hex_record(0x05, 0, bytes(4)),
+                hex_record(0x01, 0, bytes()),
+            ]
+        )
+
+        segments = parse_intel_hex(text)
+
+        self.assertEqual(
+            [
+                Segment(0x8003800, bytes(range(16)) + bytes(range(4))),
+                Segment(0x8004000, bytes([42])),
+            ],
+            segments,
+        )
+
+    def test_extended_segment_address(self):
+        text = "\n".join(
+            [hex_record(0x02, 0, bytes([0x10, 0x00])), hex_record(0x00, 4, b"ab")]
+        )
+
+        self.assertEqual([Segment(0x10004, b"ab")], parse_intel_hex(text))
+
+    def test_invalid_checksum(self):
+        line = hex_record(0x00, 0, b"ab")
+        line = line[:-2] + "00"
+
+        with self.assertRaises(ValueError):
+            parse_intel_hex(line)
+
+    def test_invalid_record(self):
+        with self.assertRaises(ValueError):
+            parse_intel_hex("hello")
+
+        with self.assertRaises(ValueError):
+            parse_intel_hex(":0011")
+
+
+class ElfTestCase(unittest.TestCase):
+    def test_load_segments(self):
+        data = elf32(
+            [
+                (PT_LOAD, 0x8003800, b"text"),
+                (PT_LOAD, 0x8010000, b"table"),
+                (PT_LOAD, 0x8003804, b"data"),  # initializers of .data
+                (2, 0x8000000, b"dynamic"),
+            ]
+        )
+
+        segments = parse_elf(data)
+
+        self.assertEqual(
+            [Segment(0x8003800, b"textdata"), Segment(0x8010000, b"table")], segments
+        )
+
+    def test_big_endian(self):
+        data = elf32([(PT_LOAD, 0x1000, b"text")], encoding=">")
+        self.assertEqual([Segment(0x1000, b"text")], parse_elf(data))
+
+    def test_empty_segments_are_skipped(self):
+        data = elf32([(PT_LOAD, 0x1000, b"")])
+        self.assertEqual([], parse_elf(data))
+
+    def test_truncated_file(self):
+        data = elf32([(PT_LOAD, 0x1000, b"text")])
+
+        with self.assertRaises(ValueError):
+            parse_elf(data[:-2])
+
+        with self.assertRaises(ValueError):
+            parse_elf(data[:20])
+
+    def test_not_an_elf_file(self):
+        with self.assertRaises(ValueError):
+            parse_elf(bytes(100))
+
+
+class FlattenTestCase(unittest.TestCase):
+    def test_gaps_are_erased(self):
+        firmware = flatten([Segment(0x1000, b"ab"), Segment(0x1008, b"cd")])
+
+        self.assertEqual(0x1000, firmware.base_address)
+        self.assertEqual(b"ab" + b"\xff" * 6 + b"cd", firmware.binary)
+        self.assertEqual(((0, 2), (8, 2)), firmware.spans)
+
+    def test_base_address(self):
+        firmware = flatten([Segment(0x1004, b"ab")], base_address=0x1000)
+
+        self.assertEqual(b"\xff" * 4 + b"ab", firmware.binary)
+        self.assertEqual(((4, 2),), firmware.spans)
+
+        with self.assertRaises(ValueError):
+            flatten([Segment(0x1004, b"ab")], base_address=0x1008)
+
+    def test_overlapping_segments(self):
+        with self.assertRaises(ValueError):
+            merge_segments([Segment(0x1000, b"abcd"), Segment(0x1002, b"ef")])
+
+    def test_segment_in_ram(self):
+        with self.assertRaises(ValueError):
+            flatten([Segment(0x8000000, b"ab"), Segment(0x20000000, b"cd")])
+
+    def test_data_pages(self):
+        self.assertEqual({0, 16, 64}, data_pages(((4, 20), (70, 2)), 72, 16))
+        self.assertEqual({0, 16, 32}, data_pages(None, 40, 16))
+
+
+class LoadFirmwareTestCase(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+
+    def write_file(self, name, data):
+        path = os.path.join(self.directory.name, name)
+        with open(path, "wb") as f:
+            f.write(data)
+        return path
+
+    def test_raw_binary(self):
+        path = self.write_file("firmware.bin", b":raw")
+
+        self.assertEqual(Firmware(0x1000, b":raw", None), load_firmware(path, 0x1000))
+
+        with self.assertRaises(ValueError):
+            load_firmware(path)
+
+    def test_elf(self):
+        path = self.write_file("firmware", elf32([(PT_LOAD, 0x1000, b"text")]))
+
+        self.assertEqual(Firmware(0x1000, b"text", ((0, 4),)), load_firmware(path))
+
+    def test_intel_hex(self):
+        text = hex_record(0x00, 0x1000, b"text") + "\n" + hex_record(0x01, 0, b"")
+        path = self.write_file("firmware.hex", text.encode())
+
+        self.assertEqual(Firmware(0x1000, b"text", ((0, 4),)), load_firmware(path))
+
+
+class SparseFlashTestCase(unittest.TestCase):
+    """
+    Flashes a sparse firmware to simulated boards.
+    """
+
+    def setUp(self):
+        self.bus = simulated_fleet([1, 2], device_class="dummy", page_size=64)
+        self.firmware = flatten(
+            [Segment(0x1000, bytes(range(100))), Segment(0x1000 + 640, b"table")]
+        )
+
+        # Board 2 still has an older, bigger firmware in the gap
+        self.bus.nodes[1].pages = {i: bytearray(64) for i in range(10)}
+
+    def test_only_dirty_gaps_are_erased(self):
+        firmware = self.firmware
+        dirty_pages = bootloader_flash.find_sparse_pages(
+            self.bus, firmware.binary, 0x1000, [1, 2], 64, firmware.spans
+        )
+
+        self.assertEqual([1, 2], dirty_pages[0])
+        self.assertEqual([1, 2], dirty_pages[640])
+        self.assertEqual([2], dirty_pages[128])
+        self.assertEqual(list(range(0, 704, 64)), sorted(dirty_pages))
+
+    def test_flash(self):
+        firmware = self.firmware
+
+        with patch("progressbar.ProgressBar"), patch("builtins.print"):
+            bootloader_flash.flash_binary(
+                self.bus,
+                firmware.binary,
+                firmware.base_address,
+                "dummy",
+                [1, 2],
+                page_size=64,
+                spans=firmware.spans,
+            )
+
+        valid = bootloader_flash.check_binary(
+            self.bus, firmware.binary, firmware.base_address, [1, 2]
+        )
+        self.assertEqual([1, 2], valid)
+
+        # Gap pages which were never written are left untouched on board 1
+        self.assertNotIn(5, self.bus.nodes[0].pages)
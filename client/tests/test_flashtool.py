@@ -8,13 +8,18 @@ except ImportError:
 from zlib import crc32
 
 from cvra_bootloader.bootloader_flash import *
+from cvra_bootloader import manifest
+from cvra_bootloader.can.simulation import simulated_fleet
 from cvra_bootloader.commands import *
 from cvra_bootloader.utils import *
 import msgpack
 
 from io import BytesIO
+from itertools import repeat
 
+import os
 import sys
+import tempfile
 
 
 @patch("cvra_bootloader.utils.write_command_retry")
@@ -125,6 +130,21 @@ class FlashBinaryTestCase(unittest.TestCase):
             write_cmd = encode_write_flash(bytes(16), addr, device_class)
             write.assert_any_call(self.fd, write_cmd, destinations)
 
+    def test_erased_spans_are_skipped(self, write):
+        """
+        Checks that erased (0xFF) regions of the binary are not written.
+        """
+        data = bytes(16) + b"\xff" * 2048 + bytes(16)
+
+        flash_binary(self.fd, data, 0x1000, "dummy", [1], page_size=1024)
+
+        written = [c[0][1] for c in write.call_args_list]
+        self.assertIn(encode_write_flash(bytes(16), 0x1000, "dummy"), written)
+        self.assertIn(encode_write_flash(bytes(16), 0x1810, "dummy"), written)
+
+        # 3 page erases, 2 writes, then the config update and save
+        self.assertEqual(7, len(written))
+
     @patch("cvra_bootloader.utils.config_update_and_save")
     def test_crc_is_updated(self, conf, write):
         """
@@ -173,6 +193,211 @@ class FlashBinaryTestCase(unittest.TestCase):
         c.assert_any_call("Boards 1, 2 failed during page write, aborting...")
 
 
+@patch("cvra_bootloader.utils.write_command_retry")
+class DifferentialFlashTestCase(unittest.TestCase):
+    fd = "port"
+
+    def setUp(self):
+        mock = lambda m: patch(m).start()
+        self.progressbar = mock("progressbar.ProgressBar")
+        self.print = mock("builtins.print")
+
+    def tearDown(self):
+        patch.stopall()
+
+    def crc_answers(self, device_pages):
+        """
+        Returns a side effect answering CRC region commands with the CRC of
+        the given per board flash content, and True to everything else.
+        """
+
+        def answer(fdesc, command, destinations):
+            _, index, args = list(msgpack.Unpacker(BytesIO(command)))
+            if index != CommandType.CRCReginon:
+                return {id: msgpack.packb(True) for id in destinations}
+
+            address, length = args
+            offset = address - 0x1000
+            return {
+                id: msgpack.packb(crc32(device_pages[id][offset : offset + length]))
+                for id in destinations
+            }
+
+        return answer
+
+    def test_read_page_crcs(self, write):
+        """
+        Checks that the CRC of every page is requested from every board.
+        """
+        flash = bytes(range(40))
+        write.side_effect = self.crc_answers({1: flash, 2: flash})
+
+        crcs = read_page_crcs(self.fd, 0x1000, 40, [1, 2], page_size=16)
+
+        expected = [crc32(flash[0:16]), crc32(flash[16:32]), crc32(flash[32:40])]
+        self.assertEqual({1: expected, 2: expected}, crcs)
+        write.assert_any_call(self.fd, encode_crc_region(0x1020, 8), [1, 2])
+
+    def test_find_dirty_pages(self, write):
+        """
+        Checks that only the pages which differ are reported, with the boards
+        needing them.
+        """
+        binary = bytes(48)
+        board1 = bytes(16) + bytes([1] * 16) + bytes(16)
+        board2 = bytes(32) + bytes([1] * 16)
+        write.side_effect = self.crc_answers({1: board1, 2: board2})
+
+        dirty = find_dirty_pages(self.fd, binary, 0x1000, [1, 2], page_size=16)
+
+        self.assertEqual({16: [1], 32: [2]}, dirty)
+
+    def test_only_dirty_pages_are_flashed(self, write):
+        """
+        Checks that pages which are already up to date are neither erased nor
+        written.
+        """
+        binary = bytes(32)
+        board = bytes(16) + bytes([1] * 16)
+        write.side_effect = self.crc_answers({1: board})
+
+        flash_binary(self.fd, binary, 0x1000, "dummy", [1], 16, differential=True)
+
+        write.assert_any_call(self.fd, encode_erase_flash_page(0x1010, "dummy"), [1])
+        write.assert_any_call(
+            self.fd, encode_write_flash(bytes(16), 0x1010, "dummy"), [1]
+        )
+
+        erase_first = call(self.fd, encode_erase_flash_page(0x1000, "dummy"), [1])
+        self.assertNotIn(erase_first, write.call_args_list)
+
+        write_first = call(self.fd, encode_write_flash(bytes(16), 0x1000, "dummy"), [1])
+        self.assertNotIn(write_first, write.call_args_list)
+
+
+@patch("cvra_bootloader.utils.config_update_and_save")
+@patch("cvra_bootloader.utils.read_can_datagrams")
+@patch("cvra_bootloader.utils.write_command")
+class PipelinedFlashTestCase(unittest.TestCase):
+    fd = "port"
+
+    def setUp(self):
+        mock = lambda m: patch(m).start()
+        self.progressbar = mock("progressbar.ProgressBar")
+        self.print = mock("builtins.print")
+
+    def tearDown(self):
+        patch.stopall()
+
+    def test_pages_are_flashed(self, write, read, conf):
+        """
+        Checks that every page is erased and written, and that the CRC is
+        updated.
+        """
+        read.return_value = repeat((msgpack.packb(True), [0], 1))
+        data = bytes(32)
+
+        flash_binary_pipelined(self.fd, data, 0x1000, "dummy", [1], page_size=16)
+
+        for addr in [0x1000, 0x1010]:
+            write.assert_any_call(
+                self.fd, encode_erase_flash_page(addr, "dummy"), [1], 0
+            )
+            write.assert_any_call(
+                self.fd, encode_write_flash(bytes(16), addr, "dummy"), [1], 0
+            )
+
+        expected_config = {"application_size": 32, "application_crc": crc32(data)}
+        conf.assert_any_call(self.fd, expected_config, [1])
+
+    @patch("logging.error")
+    def test_bad_board(self, error, write, read, conf):
+        """
+        Checks that a board failing a page write is quarantined while the
+        other boards are flashed.
+        """
+        ok, nok = msgpack.packb(True), msgpack.packb(False)
+        read.return_value = iter(
+            [(ok, [0], 1), (ok, [0], 2), (nok, [0], 1), (ok, [0], 2)]
+        )
+
+        flashed = flash_binary_pipelined(self.fd, bytes(10), 0x1000, "", [1, 2])
+
+        self.assertEqual([2], flashed)
+        error.assert_any_call("Boards 1 were quarantined")
+        conf.assert_any_call(self.fd, ANY, [2])
+
+
+class RepairTestCase(unittest.TestCase):
+    """
+    Finds and reflashes the bad pages of boards on a simulated bus.
+    """
+
+    def setUp(self):
+        mock = lambda m: patch(m).start()
+        self.progressbar = mock("progressbar.ProgressBar")
+        self.print = mock("builtins.print")
+        self.addCleanup(patch.stopall)
+
+        self.binary = bytes(range(256)) * 16
+        self.bus = simulated_fleet([1, 2, 3], device_class="dummy", page_size=64)
+        flash_binary(self.bus, self.binary, 0x1000, "dummy", [1, 2, 3], page_size=64)
+
+    def corrupt(self, id, offset):
+        node = self.bus.nodes[id - 1]
+        node.pages[offset // 64][offset % 64] ^= 0xFF
+
+    def test_find_bad_pages(self):
+        self.corrupt(1, 130)
+        self.corrupt(1, 4000)
+        self.corrupt(2, 4000)
+
+        with patch(
+            "cvra_bootloader.utils.write_command_retry", wraps=write_command_retry
+        ) as write:
+            bad_pages = find_bad_pages(self.bus, self.binary, 0x1000, [1, 2], 64)
+
+        self.assertEqual({128: [1], 3968: [1, 2]}, bad_pages)
+
+        # Bisecting 64 pages takes about two requests per level and bad page
+        self.assertLessEqual(write.call_count, 2 * 6 * 2)
+
+    def test_uneven_page_count(self):
+        binary = self.binary[:1000]
+        flash_binary(self.bus, binary, 0x1000, "dummy", [1], page_size=64)
+        self.corrupt(1, 999)
+
+        self.assertEqual({960: [1]}, find_bad_pages(self.bus, binary, 0x1000, [1], 64))
+
+    def test_repair(self):
+        self.corrupt(2, 10)
+        self.corrupt(3, 2000)
+
+        image = manifest.Image(self.binary, 0x1000, "dummy", [1, 2, 3], 64)
+        valid = check_images(self.bus, [image])
+        self.assertEqual([1], valid)
+
+        with patch(
+            "cvra_bootloader.utils.write_command_retry", wraps=write_command_retry
+        ) as write:
+            valid = repair_images(self.bus, [image], valid)
+
+        self.assertEqual([1, 2, 3], valid)
+
+        # Only the two bad pages were erased, the command index following the
+        # command set version
+        erases = [c for c in write.call_args_list if c[0][1][1] == CommandType.Erase]
+        self.assertEqual(2, len(erases))
+
+    def test_repair_gives_up(self):
+        image = manifest.Image(self.binary, 0x1000, "dummy", [1], 64)
+        self.bus.nodes[0].config["device_class"] = "other"
+        self.corrupt(1, 10)
+
+        with self.assertRaises(SystemExit):
+            repair_images(self.bus, [image], [])
+
+
 class ConfigTestCase(unittest.TestCase):
     fd = "port"
 
@@ -267,7 +492,8 @@ class MainTestCase(unittest.TestCase):
         self.open_conn.return_value = self.conn
 
         self.flash = mock("cvra_bootloader.bootloader_flash.flash_binary")
-        self.check = mock("cvra_bootloader.bootloader_flash.check_binary")
+        self.flash_images = mock("cvra_bootloader.bootloader_flash.flash_images")
+        self.check = mock("cvra_bootloader.bootloader_flash.check_images")
         self.run = mock("cvra_bootloader.bootloader_flash.run_application")
 
         self.check_online_boards = mock(
@@ -313,11 +539,23 @@ class MainTestCase(unittest.TestCase):
 
     def test_flash_binary(self):
         """
-        Checks that the binary file is flashed correctly.
+        Checks that the binary file is flashed correctly, without a journal
+        unless one is given.
         """
         main()
         self.flash.assert_any_call(
-            self.conn, self.binary_data, 0x1000, "dummy", [1, 2, 3], page_size=ANY
+            self.conn,
+            self.binary_data,
+            0x1000,
+            "dummy",
+            [1, 2, 3],
+            page_size=ANY,
+            differential=False,
+            progress=None,
+            spans=None,
+            journal=None,
+            resume=False,
+            compress=False,
         )
 
     def test_check(self):
@@ -325,16 +563,24 @@ class MainTestCase(unittest.TestCase):
         Checks that the flash is verified.
         """
         main()
-        self.check.assert_any_call(self.conn, self.binary_data, 0x1000, [1, 2, 3])
+
+        conn, [image] = self.check.call_args[0]
+        self.assertEqual(self.conn, conn)
+        self.assertEqual((self.binary_data, 0x1000), image[:2])
+        self.assertEqual([1, 2, 3], image.ids)
 
     def test_check_failed(self):
         """
         Checks that the program behaves correctly when verification fails.
         """
         self.check.return_value = [1]
-        with patch("cvra_bootloader.bootloader_flash.verification_failed") as failed:
+
+        with self.assertRaises(SystemExit):
             main()
-            failed.assert_any_call(set((2, 3)))
+
+        self.print.assert_any_call(
+            "Flashing failed: verification failed for nodes 2, 3"
+        )
 
     def test_do_not_run_by_default(self):
         """
@@ -357,7 +603,117 @@ class MainTestCase(unittest.TestCase):
         """
         sys.argv += ["--page-size=16"]
         main()
-        self.flash.assert_any_call(ANY, ANY, ANY, ANY, ANY, page_size=16)
+        self.flash.assert_any_call(
+            ANY,
+            ANY,
+            ANY,
+            ANY,
+            ANY,
+            page_size=16,
+            differential=ANY,
+            progress=None,
+            spans=None,
+            journal=ANY,
+            resume=False,
+            compress=False,
+        )
+
+    def test_differential(self):
+        """
+        Checks that we can ask for a differential flash.
+        """
+        sys.argv += ["--differential"]
+        main()
+        self.flash.assert_any_call(
+            ANY,
+            ANY,
+            ANY,
+            ANY,
+            ANY,
+            page_size=ANY,
+            differential=True,
+            progress=None,
+            spans=None,
+            journal=ANY,
+            resume=False,
+            compress=False,
+        )
+
+    def test_compress(self):
+        """
+        Checks that we can ask for a compressed transfer.
+        """
+        sys.argv += ["--compress"]
+        main()
+        self.flash.assert_any_call(
+            ANY,
+            ANY,
+            ANY,
+            ANY,
+            ANY,
+            page_size=ANY,
+            differential=False,
+            progress=None,
+            spans=None,
+            journal=ANY,
+            resume=False,
+            compress=True,
+        )
+
+    def test_repair(self):
+        """
+        Checks that boards failing verification are repaired if asked.
+        """
+        sys.argv += ["--repair"]
+        self.check.return_value = [1]
+
+        with patch("cvra_bootloader.bootloader_flash.repair_images") as repair:
+            repair.return_value = [1, 2, 3]
+            main()
+
+        repair.assert_any_call(self.conn, [ANY], {1}, compress=False, progress=None)
+        self.assertEqual([1, 2, 3], repair.call_args[0][1][0].ids)
+        self.print.assert_any_call("OK")
+
+    def test_pipeline(self):
+        """
+        Checks that we can ask for the pipelined scheduler.
+        """
+        sys.argv += ["--pipeline", "--window", "2"]
+        self.flash_images.return_value = [1, 2, 3]
+        main()
+        self.assertFalse(self.flash.called)
+        self.flash_images.assert_any_call(
+            self.conn,
+            [ANY],
+            differential=False,
+            window=2,
+            timeout=0.5,
+            progress=None,
+            journal=ANY,
+            resume=False,
+            compress=False,
+        )
+
+        image = self.flash_images.call_args[0][1][0]
+        self.assertEqual((self.binary_data, 0x1000, "dummy"), image[:3])
+        self.assertEqual([1, 2, 3], image.ids)
+
+    def test_quarantined_boards_fail_verification(self):
+        """
+        Checks that boards quarantined during a pipelined flash are not
+        verified and reported as failed.
+        """
+        sys.argv += ["--pipeline"]
+        self.flash_images.return_value = [1, 3]
+        self.check.return_value = [1, 3]
+
+        with self.assertRaises(SystemExit):
+            main()
+
+        [image] = self.check.call_args[0][1]
+        self.assertEqual([1, 3], image.ids)
+        self.print.assert_any_call("Flashing failed: verification failed for nodes 2")
 
     def test_verification_failed(self):
         """
@@ -420,6 +776,17 @@ class ArgumentParsingTestCase(unittest.TestCase):
             # Checked that we printed some kind of error
             error.assert_any_call(ANY)
 
+    def test_resume_requires_journal(self):
+        """
+        Checks that we cannot resume without the journal of the session.
+        """
+        commandline = "-b test.bin -a 0x1000 -p /dev/ttyUSB0 --resume -c dummy 1"
+
+        with patch("argparse.ArgumentParser.error") as error:
+            parse_commandline_args(commandline.split())
+
+            error.assert_any_call("--resume requires --journal")
+
     def test_page_size(self):
         """
         Checks that we can change the page size.
@@ -430,3 +797,89 @@ class ArgumentParsingTestCase(unittest.TestCase):
         )
         cmd += "--page-size 10".split()
         self.assertEqual(10, parse_commandline_args(cmd).page_size, "Invalid page size")
+
+
+class MultiBusTestCase(unittest.TestCase):
+    """
+    Flashes several simulated buses in parallel through main.
+    """
+
+    def setUp(self):
+        mock = lambda m: patch(m).start()
+        self.print = mock("builtins.print")
+        self.stderr = mock("sys.stderr")
+
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        binary_file = os.path.join(directory.name, "test.bin")
+        journal_file = os.path.join(directory.name, "journal")
+
+        self.binary_data = bytes(range(100))
+        with open(binary_file, "wb") as f:
+            f.write(self.binary_data)
+
+        from cvra_bootloader.can.simulation import simulated_fleet
+
+        self.buses = {
+            "can0": simulated_fleet([1, 2], device_class="dummy", page_size=64),
+            "can1": simulated_fleet([3], device_class="dummy", page_size=64),
+        }
+        self.open_bus = mock("cvra_bootloader.utils.open_bus_connection")
+        self.open_bus.side_effect = lambda args, bus: self.buses[bus.device]
+
+        sys.argv = (
+            "test.py -a 0x1000 -c dummy --page-size 64 --bus can0=1,2 --bus can1=3"
+        ).split()
+        sys.argv += ["-b", binary_file, "--journal", journal_file]
+
+    def tearDown(self):
+        patch.stopall()
+
+    def check_flashed(self, bus, ids):
+        valid = check_binary(self.buses[bus], self.binary_data, 0x1000, ids)
+        self.assertEqual(ids, valid)
+
+    def test_flash(self):
+        main()
+
+        self.check_flashed("can0", [1, 2])
+        self.check_flashed("can1", [3])
+        self.print.assert_any_call("can0: OK (1, 2)")
+        self.print.assert_any_call("can1: OK (3)")
+
+    def test_pipeline(self):
+        sys.argv += ["--pipeline"]
+        main()
+
+        self.check_flashed("can0", [1, 2])
+        self.check_flashed("can1", [3])
+
+    def test_offline_board(self):
+        """
+        Checks that a failing bus is reported without stopping the others.
+        """
+        sys.argv[sys.argv.index("can1=3")] = "can1=3,4"
+
+        with self.assertRaises(SystemExit):
+            main()
+
+        self.check_flashed("can0", [1, 2])
+        self.print.assert_any_call("can1: boards 4 are offline")
+
+    def test_ids_must_be_given_per_bus(self):
+        sys.argv += ["5"]
+
+        with self.assertRaises(SystemExit):
+            main()
+
+        self.assertFalse(self.open_bus.called)
+
+
+class CombinedProgressTestCase(unittest.TestCase):
+    def test_render(self):
+        output = Mock()
+        progress = CombinedProgress(["can0", "can1"], output=output)
+
+        progress.reporter("can1")("Writing pages", 50, 200)
+
+        output.write.assert_any_call("\rcan0: Waiting   0%  can1: Writing pages  25%")
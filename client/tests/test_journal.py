@@ -0,0 +1,294 @@
+import os
+import tempfile
+import unittest
+
+try:
+    from unittest.mock import *
+except ImportError:
+    from mock import *
+
+from cvra_bootloader import bootloader_flash, utils
+from cvra_bootloader.commands import CommandType
+from cvra_bootloader.can.simulation import simulated_fleet
+from cvra_bootloader.journal import *
+from cvra_bootloader.manifest import Image
+
+
+class FormatIdsTestCase(unittest.TestCase):
+    def test_ranges(self):
+        self.assertEqual("0-3,5,7-8", format_ids([8, 0, 1, 2, 3, 5, 7]))
+        self.assertEqual("", format_ids([]))
+
+    def test_parse_back(self):
+        ids = [0, 1, 2, 10, 12, 13]
+        self.assertEqual(ids, utils.parse_ids(format_ids(ids)))
+
+
+class FlashJournalTestCase(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+        self.path = os.path.join(self.directory.name, "journal")
+
+    def test_missing_file(self):
+        self.assertEqual({}, FlashJournal.open(self.path).pages("key"))
+
+    def test_save_and_open(self):
+        journal = FlashJournal.open(self.path)
+        journal.start("key", 16, {1: BoardPages({0, 16}, {0})})
+        journal.erased("key", [1], 32)
+        journal.written("key", [1], 16)
+        journal.save()
+
+        pages = FlashJournal.open(self.path).pages("key")
+
+        self.assertEqual({1: BoardPages({0, 16, 32}, {0, 16})}, pages)
+        self.assertEqual(["journal"], os.listdir(self.directory.name))
+
+    def test_start_forgets_other_images(self):
+        journal = FlashJournal.open(self.path)
+        journal.start("old", 16, {1: BoardPages({0}, {0}), 2: BoardPages({0}, {0})})
+        journal.start("new", 16, {1: BoardPages(set(), set())})
+
+        self.assertEqual([2], list(journal.pages("old")))
+        self.assertEqual([1], list(journal.pages("new")))
+
+    def test_empty_journal_is_removed(self):
+        journal = FlashJournal.open(self.path)
+        journal.start("key", 16, {1: BoardPages(set(), set())})
+        self.assertTrue(os.path.exists(self.path))
+
+        journal.forget([1])
+        self.assertFalse(os.path.exists(self.path))
+
+    def test_saves_are_throttled(self):
+        clock = Mock(return_value=0)
+        journal = FlashJournal.open(self.path, interval=1, clock=clock)
+        journal.start("key", 16, {1: BoardPages(set(), set())})
+
+        journal.erased("key", [1], 0)
+        self.assertEqual({1: BoardPages(set(), set())}, self.saved_pages())
+
+        clock.return_value = 2
+        journal.erased("key", [1], 16)
+        self.assertEqual({1: BoardPages({0, 16}, set())}, self.saved_pages())
+
+    def saved_pages(self):
+        return FlashJournal.open(self.path).pages("key")
+
+    def test_invalid_file_is_ignored(self):
+        with open(self.path, "w") as f:
+            f.write('{"images": 42}')
+
+        with patch("logging.warning") as warning:
+            journal = FlashJournal.open(self.path)
+
+        self.assertEqual({}, journal.images)
+        warning.assert_any_call(ANY)
+
+    @patch("logging.warning")
+    def test_save_errors_are_not_fatal(self, warning):
+        journal = FlashJournal(os.path.join(self.path, "missing", "journal"))
+        journal.start("key", 16, {1: BoardPages(set(), set())})
+
+        warning.assert_any_call(ANY)
+
+
+class OpenJournalTestCase(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+        self.path = os.path.join(self.directory.name, "journal")
+
+        self.image = Image(bytes(range(32)), 0x1000, "dummy", [1, 2], 16)
+        key = image_key(self.image.binary, 0x1000, "dummy", 16)
+
+        journal = FlashJournal(self.path, "can0")
+        journal.start(key, 16, {1: BoardPages({0}, {0})})
+
+    def open(self, images, interface="can0", resume=True):
+        return bootloader_flash.open_journal(self.path, resume, images, interface)
+
+    def test_interface_is_saved(self):
+        self.assertEqual("can0", FlashJournal.open(self.path).recorded_interface)
+
+    def test_resume(self):
+        journal = self.open([self.image])
+        self.assertEqual([1], list(journal.boards()))
+
+    def test_no_journal(self):
+        self.assertIsNone(bootloader_flash.open_journal(None, False, [], "can0"))
+
+    def test_new_session_starts_empty(self):
+        self.assertEqual({}, self.open([self.image], resume=False).images)
+
+    def test_other_interface_is_refused(self):
+        with self.assertRaises(ValueError):
+            self.open([self.image], interface="can1")
+
+    def test_other_firmware_is_refused(self):
+        image = self.image._replace(binary=bytes(32))
+
+        with self.assertRaises(ValueError):
+            self.open([image])
+
+    def test_other_boards_are_accepted(self):
+        image = self.image._replace(binary=bytes(32), ids=[2, 3])
+        self.assertIsNotNone(self.open([image]))
+
+
+class ResumeTestCase(unittest.TestCase):
+    """
+    Interrupts flash sessions on a simulated bus, then resumes them.
+    """
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.journal = FlashJournal.open(os.path.join(directory.name, "journal"))
+
+        self.bus = simulated_fleet([1, 2], device_class="dummy", page_size=16)
+        self.binary = bytes(range(160))
+
+        # Counts the erases each board receives
+        self.erases = {1: 0, 2: 0}
+        for node in self.bus.nodes:
+            node.handlers[CommandType.Erase] = self.counting_erase(node)
+
+        patch("progressbar.ProgressBar").start()
+        patch("builtins.print").start()
+        self.addCleanup(patch.stopall)
+
+    def counting_erase(self, node):
+        erase = node.erase_flash_page
+
+        def counting_erase(*args):
+            self.erases[node.id] += 1
+            return erase(*args)
+
+        return counting_erase
+
+    def flash(self, **kwargs):
+        bootloader_flash.flash_binary(
+            self.bus,
+            self.binary,
+            0x1000,
+            "dummy",
+            [1, 2],
+            page_size=16,
+            journal=self.journal,
+            **kwargs
+        )
+
+    def interrupted_flash(self, commands):
+        """
+        Starts flashing, but stops after the given number of commands.
+        """
+        write_command_retry = utils.write_command_retry
+        count = [0]
+
+        def interrupted(*args, **kwargs):
+            count[0] += 1
+            if count[0] > commands:
+                raise IOError
+            return write_command_retry(*args, **kwargs)
+
+        with patch("cvra_bootloader.utils.write_command_retry", interrupted):
+            with self.assertRaises(IOError):
+                self.flash()
+
+    def check(self):
+        valid = bootloader_flash.check_binary(self.bus, self.binary, 0x1000, [1, 2])
+        self.assertEqual([1, 2], valid)
+
+    def test_resume_during_write(self):
+        # Every page erased and 3 of them written
+        self.interrupted_flash(10 + 3)
+        self.erases = {1: 0, 2: 0}
+
+        self.flash(resume=True)
+
+        self.check()
+        self.assertEqual({1: 0, 2: 0}, self.erases)
+
+    def test_resume_during_erase(self):
+        self.interrupted_flash(4)
+        self.erases = {1: 0, 2: 0}
+
+        self.flash(resume=True)
+
+        self.check()
+        self.assertEqual({1: 6, 2: 6}, self.erases)
+
+    def test_journal_is_checked(self):
+        """
+        Checks that pages listed in the journal but modified since are
+        flashed again.
+        """
+        self.interrupted_flash(10 + 3)
+        self.bus.nodes[1].pages[1] = bytearray(16)
+        self.erases = {1: 0, 2: 0}
+
+        self.flash(resume=True)
+
+        self.check()
+        self.assertEqual({1: 0, 2: 1}, self.erases)
+
+    def test_without_resume(self):
+        self.interrupted_flash(10 + 3)
+        self.erases = {1: 0, 2: 0}
+
+        self.flash()
+
+        self.check()
+        self.assertEqual({1: 10, 2: 10}, self.erases)
+
+    def test_journal_is_cleared_after_flash(self):
+        self.flash()
+        self.assertEqual({}, self.journal.images)
+
+    def test_pipelined_resume(self):
+        """
+        Checks that a board quarantined by the pipelined scheduler resumes
+        where it stopped.
+        """
+        node = self.bus.nodes[1]
+        write_flash = node.handlers[CommandType.Write]
+        writes = [0]
+
+        def failing_write(*args):
+            writes[0] += 1
+            if writes[0] > 4:
+                return False, 0
+            return write_flash(*args)
+
+        node.handlers[CommandType.Write] = failing_write
+
+        with patch("logging.error"):
+            flashed = bootloader_flash.flash_binary_pipelined(
+                self.bus, self.binary, 0x1000, "dummy", [1, 2], 16, journal=self.journal
+            )
+
+        self.assertEqual([1], flashed)
+        self.assertEqual([2], list(self.journal.images.popitem()[1].boards))
+
+        node.handlers[CommandType.Write] = write_flash
+        self.erases = {1: 0, 2: 0}
+        self.journal = FlashJournal.open(self.journal.path)
+
+        flashed = bootloader_flash.flash_binary_pipelined(
+            self.bus,
+            self.binary,
+            0x1000,
+            "dummy",
+            [2],
+            16,
+            journal=self.journal,
+            resume=True,
+        )
+
+        self.assertEqual([2], flashed)
+        self.check()
+
+        # The fifth write failed once pages 0 to 5 were erased
+        self.assertEqual({1: 0, 2: 4}, self.erases)
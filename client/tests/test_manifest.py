@@ -0,0 +1,198 @@
+import json
+import os
+import sys
+import tempfile
+import unittest
+
+try:
+    from unittest.mock import *
+except ImportError:
+    from mock import *
+
+from cvra_bootloader.bootloader_flash import main, check_binary
+from cvra_bootloader.can.simulation import SimulatedNode, simulated_fleet
+from cvra_bootloader.manifest import *
+
+
+class ManifestFileTestCase(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+
+        self.write_file("motor.bin", bytes(range(100)))
+        self.write_file("sensor.bin", bytes(range(50, 120)))
+
+    def write_file(self, name, data):
+        path = os.path.join(self.directory.name, name)
+        with open(path, "wb") as f:
+            f.write(data)
+        return path
+
+    def write_manifest(self, images):
+        data = json.dumps({"images": images}).encode()
+        return self.write_file("manifest.json", data)
+
+
+class ManifestTestCase(ManifestFileTestCase):
+    def test_load(self):
+        path = self.write_manifest(
+            [
+                {
+                    "binary": "motor.bin",
+                    "base_address": "0x1000",
+                    "device_class": "motor",
+                    "ids": [1, 2],
+                },
+                {
+                    "binary": "sensor.bin",
+                    "base_address": 8192,
+                    "device_class": "sensor",
+                    "ids": "10-12",
+                    "page_size": 64,
+                },
+            ]
+        )
+
+        motor, sensor = load_manifest(path)
+
+        self.assertEqual(Image(bytes(range(100)), 0x1000, "motor", [1, 2], 2048), motor)
+        self.assertEqual(
+            Image(bytes(range(50, 120)), 0x2000, "sensor", [10, 11, 12], 64), sensor
+        )
+
+    def test_hex_file_without_base_address(self):
+        self.write_file("uwb.hex", b":040010007465787427\n:00000001FF\n")
+        path = self.write_manifest(
+            [{"binary": "uwb.hex", "device_class": "uwb", "ids": [20]}]
+        )
+
+        (uwb,) = load_manifest(path)
+
+        self.assertEqual(Image(b"text", 0x10, "uwb", [20], 2048, ((0, 4),)), uwb)
+
+    def test_identical_images_are_grouped(self):
+        image = {"binary": "motor.bin", "base_address": "0x1000", "device_class": "m"}
+        path = self.write_manifest([dict(image, ids=[1]), dict(image, ids=[3, 4])])
+
+        (motor,) = load_manifest(path)
+
+        self.assertEqual([1, 3, 4], motor.ids)
+
+    def test_board_in_several_images(self):
+        image = {"base_address": "0x1000", "device_class": "m", "ids": [1, 2]}
+        path = self.write_manifest(
+            [dict(image, binary="motor.bin"), dict(image, binary="sensor.bin")]
+        )
+
+        with self.assertRaises(ValueError):
+            load_manifest(path)
+
+    def test_missing_key(self):
+        path = self.write_manifest([{"binary": "motor.bin", "ids": [1]}])
+
+        with self.assertRaises(ValueError):
+            load_manifest(path)
+
+    def test_not_a_manifest(self):
+        path = self.write_file("manifest.json", b"[1, 2]")
+
+        with self.assertRaises(ValueError):
+            load_manifest(path)
+
+    def test_select_boards(self):
+        images = [
+            Image(b"a", 0, "motor", [1, 2], 16),
+            Image(b"b", 0, "sensor", [10], 16),
+        ]
+
+        self.assertEqual([images[0]._replace(ids=[2])], select_boards(images, [2]))
+
+        with self.assertRaises(ValueError):
+            select_boards(images, [2, 3])
+
+
+class ManifestFlashTestCase(ManifestFileTestCase):
+    """
+    Flashes boards of different kinds in one session through main.
+    """
+
+    def setUp(self):
+        super(ManifestFlashTestCase, self).setUp()
+        self.print = patch("builtins.print").start()
+        self.addCleanup(patch.stopall)
+
+        self.bus = simulated_fleet([1, 2], device_class="motor", page_size=64)
+        for id in (10, 11):
+            self.bus.add_node(SimulatedNode(id, device_class="sensor", page_size=64))
+
+        patch("cvra_bootloader.utils.open_connection", return_value=self.bus).start()
+
+        self.manifest = self.write_manifest(
+            [
+                {
+                    "binary": "motor.bin",
+                    "base_address": "0x1000",
+                    "device_class": "motor",
+                    "ids": [1, 2],
+                },
+                {
+                    "binary": "sensor.bin",
+                    "base_address": "0x1000",
+                    "device_class": "sensor",
+                    "ids": [10, 11],
+                },
+            ]
+        )
+        sys.argv = "test.py -p /dev/ttyUSB0 --page-size 64 -m".split()
+        sys.argv.append(self.manifest)
+        sys.argv += ["--journal", os.path.join(self.directory.name, "journal")]
+
+    def test_flash(self):
+        main()
+
+        self.assertEqual(
+            [1, 2], check_binary(self.bus, bytes(range(100)), 0x1000, [1, 2])
+        )
+        self.assertEqual(
+            [10, 11], check_binary(self.bus, bytes(range(50, 120)), 0x1000, [10, 11])
+        )
+        self.print.assert_any_call("OK")
+
+    def test_select_boards(self):
+        sys.argv += ["2", "10"]
+        main()
+
+        self.assertEqual([2], check_binary(self.bus, bytes(range(100)), 0x1000, [1, 2]))
+        self.assertEqual(
+            [10], check_binary(self.bus, bytes(range(50, 120)), 0x1000, [10, 11])
+        )
+
+    def test_differential(self):
+        sys.argv += ["--differential"]
+        main()
+        main()
+
+        self.assertEqual(
+            [10, 11], check_binary(self.bus, bytes(range(50, 120)), 0x1000, [10, 11])
+        )
+        self.print.assert_any_call("OK")
+
+    def test_offline_board(self):
+        self.bus.nodes = [n for n in self.bus.nodes if n.id != 11]
+
+        with self.assertRaises(SystemExit):
+            main()
+
+        self.print.assert_any_call("Flashing failed: boards 11 are offline")
+
+    def test_invalid_manifest(self):
+        sys.argv += ["3"]
+
+        with self.assertRaises(SystemExit):
+            main()
+
+    def test_binary_and_manifest_are_exclusive(self):
+        sys.argv += ["-b", "motor.bin"]
+
+        with patch("sys.stderr"), self.assertRaises(SystemExit):
+            main()
@@ -1,4 +1,5 @@
 import unittest
+from zlib import crc32
 from cvra_bootloader.page import *
 
 
@@ -23,3 +24,81 @@ class PaginationTestCase(unittest.TestCase):
         self.assertEqual(next(p), bytes(range(8, 12)))
         self.assertEqual(next(p), bytes(range(12, 16)))
         self.assertEqual(next(p), bytes([16]))
+
+    def test_pages_do_not_copy(self):
+        """
+        Tests that pages are views on the original data.
+        """
+        b = bytes(range(16))
+        pages = list(slice_into_pages(b, page_size=4))
+
+        self.assertEqual(4, len(pages))
+        self.assertEqual(bytes(range(12, 16)), pages[-1])
+        for p in pages:
+            self.assertIs(b, p.obj)
+
+    def test_empty_data(self):
+        """
+        Tests that empty data gives a single empty page.
+        """
+        self.assertEqual([bytes()], list(slice_into_pages(bytes(), page_size=4)))
+
+    def test_page_crcs(self):
+        """
+        Tests that the CRC of each page is computed.
+        """
+        b = bytes(range(10))
+        crcs = page_crcs(b, page_size=4)
+
+        self.assertEqual(crcs, [crc32(b[0:4]), crc32(b[4:8]), crc32(b[8:10])])
+
+
+class WrittenSpansTestCase(unittest.TestCase):
+    def spans(self, chunk, **kwargs):
+        return [
+            (offset, bytes(data)) for offset, data in written_spans(chunk, **kwargs)
+        ]
+
+    def test_programmed_chunk(self):
+        """
+        Tests that a chunk without erased runs is written as a whole.
+        """
+        b = bytes(range(20))
+        self.assertEqual([(0, b)], self.spans(b))
+
+    def test_erased_chunk(self):
+        """
+        Tests that an entirely erased chunk is not written at all.
+        """
+        self.assertEqual([], self.spans(b"\xff" * 2048))
+        self.assertEqual([], self.spans(b"\xff" * 3))
+
+    def test_erased_tail_and_head(self):
+        """
+        Tests that erased bytes at the ends of a chunk are not written, the
+        start of the span staying aligned.
+        """
+        b = b"\xff" * 20 + bytes(4) + b"\xff" * 10
+        self.assertEqual([(16, b"\xff" * 4 + bytes(4))], self.spans(b, alignment=8))
+
+    def test_long_erased_run_is_skipped(self):
+        """
+        Tests that a long erased run inside a chunk splits it in two spans.
+        """
+        b = bytes(10) + b"\xff" * 100 + bytes(10)
+        self.assertEqual(
+            [(0, bytes(10)), (104, b"\xff" * 6 + bytes(10))],
+            self.spans(b, min_run=64, alignment=8),
+        )
+
+    def test_short_erased_run_is_written(self):
+        """
+        Tests that erased runs shorter than a command are written anyway.
+        """
+        b = bytes(10) + b"\xff" * 20 + bytes(10)
+        self.assertEqual([(0, b)], self.spans(b, min_run=64))
+
+    def test_spans_do_not_copy(self):
+        b = bytes(10) + b"\xff" * 100 + bytes(10)
+        for _, data in written_spans(b):
+            self.assertIs(b, data.obj)
@@ -1,6 +1,15 @@
 import unittest
+
+try:
+    from unittest.mock import *
+except ImportError:
+    from mock import *
+
 import io
+import os
 import struct
+import tempfile
+import time
 from cvra_bootloader.can.frame import Frame
 from cvra_bootloader.can.pcap import *
 from socket import ntohl
@@ -54,3 +63,188 @@ class PCAPTest(unittest.TestCase):
         # host byte order before sending it
         self.assertEqual(data[4], ntohl(expected_id), "wrong can id")
         self.assertEqual(data[5], 5, "wrong frame length")
+
+
+class PcapWriterTest(unittest.TestCase):
+    def setUp(self):
+        self.outfile = io.BytesIO()
+        self.frame = Frame(0x42, "hello".encode())
+
+    def make_writer(self, **kwargs):
+        writer = PcapWriter(self.outfile, **kwargs)
+        self.addCleanup(writer.close)
+        return writer
+
+    def test_header_is_written_immediately(self):
+        self.make_writer()
+        self.assertEqual(24, len(self.outfile.getvalue()))
+
+    def test_frames_are_written_on_close(self):
+        """
+        Checks that no frame is lost when the writer is closed.
+        """
+        writer = self.make_writer(flush_interval=60)
+        for i in range(1000):
+            writer.write_frame(1000500000000 + i * 10**9, self.frame)
+        writer.close()
+
+        expected = io.BytesIO()
+        write_header(expected)
+        for i in range(1000):
+            write_frame(expected, 1000.5 + i, self.frame)
+
+        self.assertEqual(expected.getvalue(), self.outfile.getvalue())
+
+    def test_flush(self):
+        writer = self.make_writer(flush_interval=60)
+        writer.write_frame(1000500000000, self.frame)
+        writer.flush()
+
+        self.assertEqual(24 + 29, len(self.outfile.getvalue()))
+
+    def test_frames_are_batched(self):
+        """
+        Checks that queued frames are written in a single call.
+        """
+        writer = self.make_writer(flush_interval=60)
+        self.outfile.write = Mock(wraps=self.outfile.write)
+
+        for i in range(10):
+            writer.write_frame(1000500000000, self.frame)
+        writer.close()
+
+        self.outfile.write.assert_called_once_with(ANY)
+        self.assertEqual(24 + 10 * 29, len(self.outfile.getvalue()))
+
+    def test_buffer_is_written_when_full(self):
+        writer = self.make_writer(flush_interval=60, buffer_size=2 * 29)
+        self.outfile.write = Mock(wraps=self.outfile.write)
+
+        for i in range(4):
+            writer.write_frame(1000500000000, self.frame)
+        writer.close()
+
+        self.assertEqual(2, self.outfile.write.call_count)
+
+    def test_frames_are_written_periodically(self):
+        writer = self.make_writer(flush_interval=0.01)
+        writer.write_frame(1000500000000, self.frame)
+
+        for _ in range(100):
+            if len(self.outfile.getvalue()) > 24:
+                break
+            time.sleep(0.01)
+
+        self.assertEqual(24 + 29, len(self.outfile.getvalue()))
+
+    def test_close_twice(self):
+        writer = self.make_writer()
+        writer.close()
+        writer.close()
+
+    def test_write_errors_are_logged(self):
+        writer = self.make_writer()
+        self.outfile.close()
+
+        with patch("logging.error") as error:
+            writer.write_frame(1000500000000, self.frame)
+            writer.close()
+
+        error.assert_any_call(ANY)
+
+
+class PcapWriterRotationTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+        self.path = os.path.join(self.directory.name, "capture.pcap")
+        self.frame = Frame(0x42, "hello".encode())
+
+    def file_sizes(self):
+        return {
+            name: os.path.getsize(os.path.join(self.directory.name, name))
+            for name in os.listdir(self.directory.name)
+        }
+
+    def test_no_rotation(self):
+        writer = PcapWriter(self.path)
+        writer.write_frame(1000500000000, self.frame)
+        writer.close()
+
+        self.assertEqual({"capture.pcap": 24 + 29}, self.file_sizes())
+
+    def test_rotate_on_size(self):
+        writer = PcapWriter(self.path, max_size=24 + 2 * 29, buffer_size=29)
+        for i in range(5):
+            writer.write_frame(1000500000000, self.frame)
+        writer.close()
+
+        self.assertEqual(
+            {
+                "capture_00000.pcap": 24 + 2 * 29,
+                "capture_00001.pcap": 24 + 2 * 29,
+                "capture_00002.pcap": 24 + 29,
+            },
+            self.file_sizes(),
+        )
+
+    def test_rotate_on_age(self):
+        writer = PcapWriter(self.path, max_age=60)
+        writer.write_frame(1000500000000, self.frame)
+        writer.flush()
+
+        writer.file_start -= 60
+        writer.write_frame(1000500000000, self.frame)
+        writer.close()
+
+        self.assertEqual(
+            {"capture_00000.pcap": 24 + 29, "capture_00001.pcap": 24 + 29},
+            self.file_sizes(),
+        )
+
+    def test_rotation_requires_a_path(self):
+        with self.assertRaises(ValueError):
+            PcapWriter(io.BytesIO(), max_size=1000)
+
+
+class PcapReaderTest(unittest.TestCase):
+    def test_read_back_frames(self):
+        f = io.BytesIO()
+        write_header(f)
+        write_frame(f, 1000.5, Frame(0x123, bytes([1, 2, 3])))
+        write_frame(f, 1001.25, Frame(0x1234567, bytes(8), extended=True))
+        f.seek(0)
+
+        frames = list(read_frames(f))
+
+        self.assertEqual([0x123, 0x1234567], [frame.id for frame in frames])
+        self.assertEqual(bytes([1, 2, 3]), frames[0].data)
+        self.assertEqual([False, True], [frame.extended for frame in frames])
+        self.assertEqual(
+            [1000500000000, 1001250000000], [frame.timestamp for frame in frames]
+        )
+
+    def test_truncated_capture(self):
+        """
+        Checks that a capture cut while being written can still be read.
+        """
+        f = io.BytesIO()
+        write_header(f)
+        write_frame(f, 1000.5, Frame(0x123, bytes([1, 2, 3])))
+        write_frame(f, 1001.5, Frame(0x123, bytes([1, 2, 3])))
+
+        frames = list(read_frames(io.BytesIO(f.getvalue()[:-5])))
+
+        self.assertEqual(1, len(frames))
+
+    def test_not_a_pcap(self):
+        with self.assertRaises(ValueError):
+            list(read_frames(io.BytesIO(bytes(24))))
+
+    def test_read_capture_detects_format(self):
+        f = io.BytesIO()
+        write_header(f)
+        write_frame(f, 1000.5, Frame(0x123))
+        f.seek(0)
+
+        self.assertEqual([Frame(0x123)], list(read_capture(f)))
@@ -0,0 +1,185 @@
+import unittest
+import io
+import os
+import struct
+import tempfile
+
+from cvra_bootloader.can.frame import Frame
+from cvra_bootloader.can.pcap import read_capture
+from cvra_bootloader.can.pcapng import *
+
+
+def read_blocks(data):
+    """
+    Splits a pcapng capture into a list of (block type, body).
+    """
+    blocks = []
+    while data:
+        block_type, length = struct.unpack_from("=II", data)
+        trailer = struct.unpack_from("=I", data, length - 4)[0]
+        assert length == trailer, "block length mismatch"
+        assert length % 4 == 0, "block is not padded"
+        blocks.append((block_type, data[8 : length - 4]))
+        data = data[length:]
+    return blocks
+
+
+def read_options(data):
+    options = dict()
+    while data:
+        code, length = struct.unpack_from("=HH", data)
+        if code == OPT_ENDOFOPT:
+            break
+        options[code] = data[4 : 4 + length]
+        data = data[4 + length + (-length % 4) :]
+    return options
+
+
+class PcapngEncodingTest(unittest.TestCase):
+    def test_section_header(self):
+        (block,) = read_blocks(encode_section_header())
+        block_type, body = block
+
+        self.assertEqual(0x0A0D0D0A, block_type)
+        magic, major, minor, length = struct.unpack_from("=IHHq", body)
+        self.assertEqual(0x1A2B3C4D, magic)
+        self.assertEqual((1, 0), (major, minor))
+        self.assertEqual(-1, length)
+        self.assertEqual(b"cvra_bootloader", read_options(body[16:])[SHB_USERAPPL])
+
+    def test_interface_description(self):
+        (block,) = read_blocks(encode_interface_description("can0", "session"))
+        block_type, body = block
+
+        self.assertEqual(1, block_type)
+        linktype, _, snaplen = struct.unpack_from("=HHI", body)
+        self.assertEqual(227, linktype)
+        self.assertEqual(65535, snaplen)
+
+        options = read_options(body[8:])
+        self.assertEqual(bytes([9]), options[IF_TSRESOL], "not in nanoseconds")
+        self.assertEqual(b"can0", options[IF_NAME])
+        self.assertEqual(b"session", options[IF_DESCRIPTION])
+
+    def test_enhanced_packet(self):
+        timestamp = 1600000000123456789
+        frame = Frame(0x123, bytes([1, 2, 3]))
+
+        (block,) = read_blocks(encode_enhanced_packet(timestamp, frame))
+        block_type, body = block
+
+        self.assertEqual(6, block_type)
+        interface, high, low, caplen, origlen = struct.unpack_from("=5I", body)
+        self.assertEqual(0, interface)
+        self.assertEqual(timestamp, (high << 32) + low)
+        self.assertEqual((11, 11), (caplen, origlen))
+
+        can_id, dlc = struct.unpack_from("!LB", body, 20)
+        self.assertEqual(0x123, can_id)
+        self.assertEqual(3, dlc)
+        self.assertEqual(bytes([1, 2, 3]), body[28:31])
+
+
+class PcapngWriterTest(unittest.TestCase):
+    def test_write_session(self):
+        outfile = io.BytesIO()
+        writer = PcapngWriter(outfile, interface="can0")
+        writer.write_frame(1000, Frame(0x42, bytes(8)))
+        writer.write_frame(2000, Frame(0x43))
+        writer.close()
+
+        blocks = read_blocks(outfile.getvalue())
+        self.assertEqual([0x0A0D0D0A, 1, 6, 6], [b[0] for b in blocks])
+
+    def test_every_file_describes_the_session(self):
+        """
+        Checks that rotated files are valid captures on their own.
+        """
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "capture.pcapng")
+            writer = PcapngWriter(path, interface="can0", max_size=1, buffer_size=1)
+            writer.write_frame(1000, Frame(0x42))
+            writer.flush()
+            writer.write_frame(2000, Frame(0x42))
+            writer.close()
+
+            for name in ["capture_00000.pcapng", "capture_00001.pcapng"]:
+                with open(os.path.join(directory, name), "rb") as f:
+                    blocks = read_blocks(f.read())
+
+                self.assertEqual([0x0A0D0D0A, 1, 6], [b[0] for b in blocks])
+                self.assertEqual(b"can0", read_options(blocks[1][1][8:])[IF_NAME])
+
+
+class PcapngReaderTest(unittest.TestCase):
+    def test_read_back_frames(self):
+        data = encode_section_header() + encode_interface_description("can0")
+        data += encode_enhanced_packet(1600000000123456789, Frame(0x123, bytes([1])))
+        data += encode_enhanced_packet(
+            1600000000123456790, Frame(0x1234567, bytes(8), extended=True)
+        )
+
+        frames = list(read_frames(io.BytesIO(data)))
+
+        self.assertEqual([0x123, 0x1234567], [f.id for f in frames])
+        self.assertEqual(bytes([1]), frames[0].data)
+        self.assertTrue(frames[1].extended)
+        self.assertEqual(
+            [1600000000123456789, 1600000000123456790], [f.timestamp for f in frames]
+        )
+
+    def test_default_timestamp_resolution(self):
+        """
+        Checks that interfaces without if_tsresol have microsecond timestamps.
+        """
+        idb = encode_block(
+            INTERFACE_DESCRIPTION_BLOCK,
+            struct.pack("=HHI", LINKTYPE_CAN_SOCKETCAN, 0, 65535),
+        )
+        data = encode_section_header() + idb
+        data += encode_enhanced_packet(1000, Frame(0x123))
+
+        (frame,) = read_frames(io.BytesIO(data))
+
+        self.assertEqual(1000000, frame.timestamp)
+
+    def read_timestamp(self, tsresol, timestamp):
+        """
+        Reads back a frame captured by an interface with the given if_tsresol.
+        """
+        options = encode_options([(IF_TSRESOL, bytes([tsresol]))])
+        idb = encode_block(
+            INTERFACE_DESCRIPTION_BLOCK,
+            struct.pack("=HHI", LINKTYPE_CAN_SOCKETCAN, 0, 65535) + options,
+        )
+        data = encode_section_header() + idb
+        data += encode_enhanced_packet(timestamp, Frame(0x123))
+
+        (frame,) = read_frames(io.BytesIO(data))
+        return frame.timestamp
+
+    def test_epoch_timestamps_are_exact(self):
+        """
+        Checks that epoch timestamps keep all their digits, which a float
+        conversion would lose.
+        """
+        self.assertEqual(1700000000123456000, self.read_timestamp(6, 1700000000123456))
+        self.assertEqual(
+            1700000000123456780, self.read_timestamp(8, 170000000012345678)
+        )
+
+    def test_binary_timestamp_resolution(self):
+        # 2^-10 second units
+        self.assertEqual(
+            1700000000 * 10**9 + 999023437,
+            self.read_timestamp(0x80 | 10, 1700000000 * 1024 + 1023),
+        )
+
+    def test_read_capture_detects_format(self):
+        outfile = io.BytesIO()
+        writer = PcapngWriter(outfile)
+        writer.write_frame(1000, Frame(0x42))
+        writer.close()
+        outfile.seek(0)
+
+        self.assertEqual([Frame(0x42)], list(read_capture(outfile)))
@@ -23,3 +23,15 @@ class BootloaderRunApplicationTestCase(TestCase):
 
         command = commands.encode_jump_to_main()
         write_command.assert_any_call(open_connection.return_value, command, [1, 2])
+
+    @patch("cvra_bootloader.utils.write_command")
+    @patch("cvra_bootloader.utils.open_bus_connection")
+    def test_several_buses(self, open_bus, write_command):
+        sys.argv = "test.py --bus can0=1,2 --bus can1=3".split()
+        open_bus.side_effect = lambda args, bus: bus.device
+
+        main()
+
+        command = commands.encode_jump_to_main()
+        write_command.assert_any_call("can0", command, [1, 2])
+        write_command.assert_any_call("can1", command, [3])
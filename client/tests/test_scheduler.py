@@ -0,0 +1,200 @@
+import unittest
+
+try:
+    from unittest.mock import *
+except ImportError:
+    from mock import *
+
+from itertools import repeat
+
+import msgpack
+
+from cvra_bootloader.commands import *
+from cvra_bootloader.scheduler import *
+
+ok, nok = msgpack.packb(True), msgpack.packb(False)
+
+
+class FlashOperationsTestCase(unittest.TestCase):
+    def test_erase_is_interleaved_with_write(self):
+        """
+        Checks that the erase of page N+1 comes before the write of page N.
+        """
+        ops = flash_operations(bytes(40), 0x1000, "dummy", page_size=16)
+
+        kinds = [(op.kind, op.offset) for op in ops]
+        expected = [("erase", 0), ("erase", 16), ("write", 0)]
+        expected += [("erase", 32), ("write", 16), ("write", 32)]
+        self.assertEqual(expected, kinds)
+
+    def test_commands(self):
+        """
+        Checks that the operations carry the encoded commands.
+        """
+        ops = flash_operations(bytes(20), 0x1000, "dummy", page_size=16)
+
+        self.assertEqual(encode_erase_flash_page(0x1000, "dummy"), ops[0].command)
+        self.assertEqual(encode_write_flash(bytes(4), 0x1010, "dummy"), ops[3].command)
+
+    def test_erased_spans_are_not_written(self):
+        """
+        Checks that erased pages are erased but not written.
+        """
+        binary = bytes(16) + b"\xff" * 16 + bytes(8)
+        ops = flash_operations(binary, 0x1000, "dummy", page_size=16)
+
+        writes = [op.offset for op in ops if op.kind == "write"]
+        self.assertEqual([0, 32], writes)
+        self.assertEqual(3, len([op for op in ops if op.kind == "erase"]))
+
+    def test_restrict_to_offsets(self):
+        """
+        Checks that we can restrict the operations to some pages.
+        """
+        ops = flash_operations(bytes(48), 0x1000, "dummy", 16, offsets={16})
+        self.assertEqual([("erase", 16), ("write", 16)], [op[:2] for op in ops])
+
+
+@patch("cvra_bootloader.utils.read_can_datagrams")
+@patch("cvra_bootloader.utils.write_command")
+class FlashSchedulerTestCase(unittest.TestCase):
+    fd = "port"
+
+    def setUp(self):
+        self.ops = flash_operations(bytes(32), 0x1000, "dummy", page_size=16)
+
+    def test_single_board(self, write, read):
+        """
+        Checks that every operation is sent in order to a single board.
+        """
+        read.return_value = repeat((ok, [0], 1))
+
+        s = FlashScheduler(self.fd, {1: self.ops})
+        failed = s.run()
+
+        self.assertEqual({}, failed)
+        expected = [call(self.fd, op.command, [1], 0) for op in self.ops]
+        self.assertEqual(expected, write.call_args_list)
+
+    def test_boards_are_grouped(self, write, read):
+        """
+        Checks that boards at the same step get a single multicast command.
+        """
+        read.return_value = iter([(ok, [0], 1), (ok, [0], 2)] * len(self.ops))
+
+        s = FlashScheduler(self.fd, {1: self.ops, 2: self.ops})
+        s.run()
+
+        expected = [call(self.fd, op.command, [1, 2], 0) for op in self.ops]
+        self.assertEqual(expected, write.call_args_list)
+
+    def test_window(self, write, read):
+        """
+        Checks that several commands can be in flight for the same board.
+        """
+        read.return_value = repeat((ok, [0], 1))
+
+        s = FlashScheduler(self.fd, {1: self.ops}, window=2)
+        s._dispatch()
+
+        self.assertEqual(2, write.call_count)
+        self.assertEqual(2, len(s.boards[1].outstanding))
+
+    def test_progress(self, write, read):
+        """
+        Checks that progress is reported as operations complete.
+        """
+        read.return_value = repeat((ok, [0], 1))
+        progress = Mock()
+
+        s = FlashScheduler(self.fd, {1: self.ops})
+        s.run(progress=progress)
+
+        progress.assert_any_call(len(self.ops))
+        self.assertEqual(s.total, s.done)
+
+    def test_failed_board(self, write, read):
+        """
+        Checks that a failing board is reported and not scheduled anymore.
+        """
+        read.return_value = iter([(nok, [0], 1), (ok, [0], 2)] + [(ok, [0], 2)] * 3)
+
+        s = FlashScheduler(self.fd, {1: self.ops, 2: self.ops})
+        failed = s.run()
+
+        self.assertEqual({1: self.ops[0]}, failed)
+        write.assert_any_call(self.fd, self.ops[3].command, [2], 0)
+
+    def test_answers_to_other_sources_are_ignored(self, write, read):
+        """
+        Checks that answers addressed to another source are not counted.
+        """
+        answers = [(ok, [42], 1)] * 10 + [(ok, [0], 1)] * len(self.ops)
+        read.return_value = iter(answers)
+
+        s = FlashScheduler(self.fd, {1: self.ops})
+        s.run()
+
+        self.assertEqual(len(self.ops), write.call_count)
+
+    def test_retry(self, write, read):
+        """
+        Checks that unanswered operations are sent again once the board
+        deadline expired.
+        """
+        read.return_value = iter([None] + [(ok, [0], 1)] * len(self.ops))
+
+        s = FlashScheduler(self.fd, {1: self.ops}, timeout=0)
+        with patch("logging.warning") as w:
+            s.run()
+            w.assert_any_call(ANY)
+
+        first = call(self.fd, self.ops[0].command, [1], 0)
+        self.assertEqual([first, first], write.call_args_list[:2])
+
+    def test_quarantine_after_retry_limit(self, write, read):
+        """
+        Checks that a board is quarantined once it exhausted its retries,
+        without raising.
+        """
+        read.return_value = repeat(None)
+
+        s = FlashScheduler(self.fd, {1: self.ops}, retry_limit=2, timeout=0)
+        with patch("logging.warning"), patch("logging.error"):
+            failed = s.run()
+
+        self.assertEqual({1: self.ops[0]}, failed)
+        self.assertEqual(2 + 1, write.call_count)
+
+    def test_slow_board_does_not_stall_group(self, write, read):
+        """
+        Checks that a board which does not answer is retried by unicast while
+        the other boards carry on, then quarantined.
+        """
+        self.now = 0
+
+        def answers():
+            yield (ok, [0], 1)
+            yield (ok, [0], 2)
+            # Board 3 does not answer, then board 2 stops answering too
+            while True:
+                self.now += 1
+                yield None
+                yield (ok, [0], 1)
+
+        read.return_value = answers()
+
+        s = FlashScheduler(
+            self.fd, {1: self.ops, 2: self.ops, 3: self.ops}, clock=lambda: self.now
+        )
+        with patch("logging.warning"), patch("logging.error"):
+            failed = s.run()
+
+        self.assertEqual({2: self.ops[1], 3: self.ops[0]}, failed)
+
+        # Board 3 was retried alone, and board 1 carried on alone once board
+        # 2 was late too
+        write.assert_any_call(self.fd, self.ops[0].command, [3], 0)
+        write.assert_any_call(self.fd, self.ops[1].command, [1, 2], 0)
+        write.assert_any_call(self.fd, self.ops[2].command, [1], 0)
+        self.assertTrue(s.boards[1].finished)
@@ -0,0 +1,272 @@
+import unittest
+
+try:
+    from unittest.mock import *
+except ImportError:
+    from mock import *
+
+from zlib import crc32
+
+import msgpack
+
+from cvra_bootloader import bootloader_flash, commands, scheduler, utils
+from cvra_bootloader.can import Frame
+from cvra_bootloader.can.simulation import *
+
+
+class SimulatedNodeTestCase(unittest.TestCase):
+    def setUp(self):
+        self.bus = simulated_fleet([1, 2], device_class="dummy", page_size=16)
+        self.node = self.bus.nodes[0]
+
+    def command(self, command, destinations=[1]):
+        answers = utils.write_command_retry(self.bus, command, destinations)
+        return {id: msgpack.unpackb(a) for id, a in answers.items()}
+
+    def test_node_id_range(self):
+        with self.assertRaises(ValueError):
+            SimulatedNode(128)
+
+    def test_ping(self):
+        self.assertTrue(utils.ping_board(self.bus, 1))
+        self.assertFalse(utils.ping_board(self.bus, 3))
+
+    def test_multicast(self):
+        answers = self.command(commands.encode_ping(), [1, 2])
+        self.assertEqual({1: True, 2: True}, answers)
+
+    def test_erase_and_write(self):
+        """
+        Checks that a page can be erased then written, and read back.
+        """
+        self.command(commands.encode_erase_flash_page(0x1010, "dummy"))
+        self.command(commands.encode_write_flash(bytes(range(4)), 0x1010, "dummy"))
+
+        answer = self.command(commands.encode_read_flash(0x1010, 6))
+        self.assertEqual({1: bytes(range(4)) + b"\xff\xff"}, answer)
+
+    def test_write_only_clears_bits(self):
+        """
+        Checks that writing over non erased flash behaves like real flash.
+        """
+        self.command(commands.encode_write_flash(bytes([0x0F]), 0x1000, "dummy"))
+        self.command(commands.encode_write_flash(bytes([0xF1]), 0x1000, "dummy"))
+
+        self.assertEqual(bytes([0x01]), self.node.read_memory(0x1000, 1))
+
+    def test_compressed_write(self):
+        data = b"\x00\xbf" * 6 + b"\x70\x47"
+        command = commands.encode_write_flash_compressed(data, 0x1000, "dummy")
+
+        self.assertEqual({1: True}, self.command(command))
+        self.assertEqual(data, self.node.read_memory(0x1000, len(data)))
+
+    def test_compressed_write_is_checked(self):
+        """
+        Checks that invalid compressed data and data which does not fit in a
+        page are refused.
+        """
+        command = commands.encode_command(
+            commands.CommandType.WriteCompressed, 0x1000, "dummy", 4, b"\x10a\x02\x00"
+        )
+        self.assertEqual({1: False}, self.command(command))
+
+        command = commands.encode_write_flash_compressed(bytes(32), 0x1000, "dummy")
+        self.assertEqual({1: False}, self.command(command))
+        self.assertEqual(b"\xff", self.node.read_memory(0x1000, 1))
+
+    def test_device_class_is_checked(self):
+        answer = self.command(commands.encode_erase_flash_page(0x1000, "other"))
+        self.assertEqual({1: False}, answer)
+
+    def test_bootloader_is_protected(self):
+        answer = self.command(commands.encode_erase_flash_page(0x800, "dummy"))
+        self.assertEqual({1: False}, answer)
+
+    def test_crc_region(self):
+        answer = self.command(commands.encode_crc_region(0x1000, 10))
+        self.assertEqual({1: crc32(b"\xff" * 10)}, answer)
+
+    def test_config(self):
+        """
+        Checks that the config can be updated, saved and read back.
+        """
+        utils.config_update_and_save(self.bus, {"name": "arm"}, [1])
+
+        config = self.command(commands.encode_read_config())[1]
+        self.assertEqual("arm", config["name"])
+        self.assertEqual(2, config["update_count"])
+        self.assertEqual("arm", self.node.saved_config["name"])
+
+    def test_change_id(self):
+        """
+        Checks that a node answers with its new ID once it was changed.
+        """
+        utils.write_command_retry(
+            self.bus, commands.encode_update_config({"ID": 42}), [1], answer_ids=[42]
+        )
+        self.assertTrue(utils.ping_board(self.bus, 42))
+
+    def test_jump_to_application(self):
+        """
+        Checks that a node with a valid application stops answering once it
+        was asked to run it.
+        """
+        utils.write_command(self.bus, commands.encode_jump_to_main(), [1])
+        self.assertTrue(utils.ping_board(self.bus, 1))
+
+        utils.config_update_and_save(
+            self.bus, {"application_size": 0, "application_crc": crc32(b"")}, [1]
+        )
+        utils.write_command(self.bus, commands.encode_jump_to_main(), [1])
+        self.assertFalse(utils.ping_board(self.bus, 1))
+
+    def test_frames_are_dropped_while_busy(self):
+        """
+        Checks that the node only queues a few frames while executing a
+        command.
+        """
+        self.node.busy_until = 1.0
+        for _ in range(10):
+            self.node.receive(Frame(id=0), 0.5)
+
+        self.assertEqual(RX_FIFO_DEPTH, len(self.node.rx_fifo))
+        self.assertEqual(10 - RX_FIFO_DEPTH, self.node.overruns)
+
+
+class SimulatedBusTestCase(unittest.TestCase):
+    def test_timeout_advances_clock(self):
+        bus = SimulatedBus(read_timeout=0.5)
+        self.assertIsNone(bus.receive_frame())
+        self.assertEqual(0.5, bus.time)
+
+    def test_bitrate(self):
+        """
+        Checks that frames take longer at lower bitrates.
+        """
+        times = []
+        for bitrate in [1000000, 125000]:
+            bus = simulated_fleet([1], bitrate=bitrate)
+            utils.ping_board(bus, 1)
+            times.append(bus.stats["bus_busy_time"])
+
+        self.assertAlmostEqual(8, times[1] / times[0])
+
+    def test_late_answers_do_not_hold_the_bus(self):
+        """
+        Checks that a board can answer while another one is still busy.
+        """
+        bus = SimulatedBus([SimulatedNode(1, erase_time=1.0), SimulatedNode(2)])
+        dispatcher = utils.get_dispatcher(bus)
+
+        dispatcher.send(commands.encode_erase_flash_page(0x1000, "CVRA.dummy.v1"), [1])
+        self.assertTrue(utils.ping_board(bus, 2))
+        self.assertLess(bus.time, 0.1)
+
+    def test_frame_loss(self):
+        bus = simulated_fleet([1], loss=1.0)
+        self.assertFalse(utils.ping_board(bus, 1))
+        self.assertGreater(bus.stats["frames_lost"], 0)
+
+    def test_flash_fleet(self):
+        """
+        Checks that the flash tool works against a simulated fleet.
+        """
+        binary = bytes(range(256)) * 20
+        ids = list(range(1, 21))
+        bus = simulated_fleet(ids, device_class="dummy", page_size=2048)
+
+        with patch("progressbar.ProgressBar"), patch("builtins.print"):
+            bootloader_flash.flash_binary(bus, binary, 0x1000, "dummy", ids)
+
+        valid = bootloader_flash.check_binary(bus, binary, 0x1000, ids)
+        self.assertEqual(set(ids), set(valid))
+
+    def test_flash_sparse_binary(self):
+        """
+        Checks that a binary with erased gaps is flashed correctly, even over
+        a previous firmware.
+        """
+        binary = bytes(range(100)) + b"\xff" * 3000 + bytes(range(100))
+        bus = simulated_fleet([1], device_class="dummy", page_size=1024)
+        bus.nodes[0].pages = {i: bytearray(1024) for i in range(4)}
+
+        with patch("progressbar.ProgressBar"), patch("builtins.print"):
+            bootloader_flash.flash_binary(bus, binary, 0x1000, "dummy", [1], 1024)
+
+        self.assertEqual([1], bootloader_flash.check_binary(bus, binary, 0x1000, [1]))
+
+    def test_flash_compressed(self):
+        """
+        Checks that compressing the firmware reduces the traffic on the bus.
+        """
+        binary = b"".join(
+            b"\x08\xb5\x4b" + bytes([i % 256]) + b"\x98\x47\x08\xbd"
+            for i in range(1024)
+        )
+        frames = dict()
+
+        for compress in (False, True):
+            bus = simulated_fleet([1, 2], device_class="dummy", page_size=2048)
+
+            with patch("progressbar.ProgressBar"), patch("builtins.print"):
+                bootloader_flash.flash_binary(
+                    bus, binary, 0x1000, "dummy", [1, 2], compress=compress
+                )
+
+            valid = bootloader_flash.check_binary(bus, binary, 0x1000, [1, 2])
+            self.assertEqual([1, 2], valid)
+            frames[compress] = bus.stats["frames_sent"]
+
+        self.assertLess(frames[True], frames[False] * 0.6)
+
+    def test_flash_compressed_pipelined(self):
+        binary = bytes(range(64)) * 64
+        bus = simulated_fleet([1, 2], device_class="dummy", page_size=2048)
+
+        with patch("progressbar.ProgressBar"), patch("builtins.print"):
+            flashed = bootloader_flash.flash_binary_pipelined(
+                bus, binary, 0x1000, "dummy", [1, 2], compress=True
+            )
+
+        self.assertEqual([1, 2], flashed)
+        self.assertEqual(
+            [1, 2], bootloader_flash.check_binary(bus, binary, 0x1000, [1, 2])
+        )
+
+    def test_slow_board_does_not_hold_back_group(self):
+        """
+        Checks that the pipelined scheduler lets the fast boards finish
+        without waiting for a board which erases and writes slowly.
+        """
+        nodes = [SimulatedNode(id, device_class="dummy") for id in [1, 2, 3]]
+        nodes.append(
+            SimulatedNode(
+                4, device_class="dummy", erase_time=0.2, write_time_per_byte=200e-6
+            )
+        )
+        bus = SimulatedBus(nodes)
+
+        binary = bytes(range(256)) * 64
+        operations = scheduler.flash_operations(binary, 0x1000, "dummy")
+        finished = dict()
+
+        def on_done(id, index):
+            if index == len(operations) - 1:
+                finished[id] = bus.time
+
+        flash = scheduler.FlashScheduler(
+            bus,
+            {id: operations for id in [1, 2, 3, 4]},
+            clock=lambda: bus.time,
+            on_done=on_done,
+        )
+        self.assertEqual({}, flash.run())
+
+        for id in [1, 2, 3]:
+            self.assertLess(finished[id], finished[4] / 2)
+
+        self.assertEqual(
+            [1, 2, 3, 4],
+            bootloader_flash.check_binary(bus, binary, 0x1000, [1, 2, 3, 4]),
+        )
@@ -8,6 +8,8 @@ except ImportError:
 from cvra_bootloader.utils import *
 from itertools import repeat
 from collections import namedtuple
+import argparse
+import threading
 
 from cvra_bootloader import commands
 import msgpack
@@ -22,10 +24,12 @@ class BoardPingTestCase(unittest.TestCase):
     """
 
     def test_sends_correct_command(self, write_command, read_datagram):
+        read_datagram.return_value = iter([None])  # timeout
+
         port = object()
         ping_board(port, 1)
 
-        write_command.assert_any_call(port, commands.encode_ping(), [1])
+        write_command.assert_any_call(port, commands.encode_ping(), [1], 0)
 
     def test_answers_false_if_no_answer(self, write_command, read_datagram):
         read_datagram.return_value = iter([None])  # timeout
@@ -34,11 +38,17 @@ class BoardPingTestCase(unittest.TestCase):
         self.assertFalse(ping_board(port, 1))
 
     def test_answers_true_if_pong(self, write_command, read_datagram):
-        read_datagram.return_value = iter([(msgpack.packb(True), [0])])
+        read_datagram.return_value = iter([(msgpack.packb(True), [0], 1)])
 
         port = object()
         self.assertTrue(ping_board(port, 1))
 
+    def test_answers_false_if_other_board_answers(self, write_command, read_datagram):
+        read_datagram.return_value = iter([(msgpack.packb(True), [0], 2), None])
+
+        port = object()
+        self.assertFalse(ping_board(port, 1))
+
 
 @patch("time.sleep")
 class WriteCommandTestCase(unittest.TestCase):
@@ -55,8 +65,16 @@ class WriteCommandTestCase(unittest.TestCase):
         write_command(fdesc, data, dst)
 
         # Asserts writes are OK
-        for f in frames:
-            fdesc.send_frame.assert_any_call(f)
+        sent = list(fdesc.send_frames.call_args[0][0])
+        self.assertEqual(frames, sent)
+
+    def test_write_does_not_wait(self, sleep):
+        """
+        Checks that writing a command does not block, completion being driven
+        by the answers instead.
+        """
+        write_command(Mock(), bytes(range(3)), [1, 2])
+        sleep.assert_not_called()
 
 
 @patch("cvra_bootloader.utils.read_can_datagrams")
@@ -70,13 +88,13 @@ class CommandRetryTestCase(unittest.TestCase):
         write.assert_any_call(port, bytes([1, 2, 3]), [1], 10)
 
     def test_return_dict(self, write, read):
-        read.return_value = iter([(20, [10], 2), (10, [10], 1)])
+        read.return_value = iter([(20, [0], 2), (10, [0], 1)])
         res = write_command_retry(None, None, [1, 2])
         self.assertEqual(res, {1: 10, 2: 20})
 
     def test_retry(self, write, read):
         data = "hello"
-        read.return_value = iter([(20, [10], 2), None, (10, [10], 1)])
+        read.return_value = iter([(20, [0], 2), None, (10, [0], 1)])
 
         with patch("logging.warning") as w:
             write_command_retry(None, data, [1, 2])
@@ -102,12 +120,112 @@ class CommandRetryTestCase(unittest.TestCase):
             self.assertEqual(write.call_count, 2 + 1)
             critical.assert_any_call(ANY)
 
+    def test_answer_ids(self, write, read):
+        """
+        Checks that boards answering from another ID (e.g. after an ID change)
+        are retried using their destination ID.
+        """
+        read.return_value = iter([None, (10, [0], 2)])
+
+        with patch("logging.warning"):
+            res = write_command_retry(None, "hello", [1], answer_ids=[2])
+
+        self.assertEqual({2: 10}, res)
+        self.assertEqual([call(None, "hello", [1], 0)] * 2, write.call_args_list)
+
+
+@patch("cvra_bootloader.utils.read_can_datagrams")
+@patch("cvra_bootloader.utils.write_command")
+class DispatcherTestCase(unittest.TestCase):
+    def test_answers_are_routed_to_requests(self, write, read):
+        read.return_value = iter([(b"b", [0], 2), (b"a", [0], 1)])
+        dispatcher = Dispatcher(None)
+
+        futures = dispatcher.send(b"", [1, 2])
+
+        self.assertTrue(dispatcher.wait(futures.values()))
+        self.assertEqual(b"a", futures[1].result())
+        self.assertEqual(b"b", futures[2].result())
+
+    def test_answers_resolve_oldest_request(self, write, read):
+        """
+        Checks that several requests can be in flight to the same board.
+        """
+        read.return_value = iter([(b"a", [0], 1), (b"b", [0], 1)])
+        dispatcher = Dispatcher(None)
+
+        first = dispatcher.send(b"", [1])[1]
+        second = dispatcher.send(b"", [1])[1]
+        dispatcher.wait([first, second])
+
+        self.assertEqual(b"a", first.result())
+        self.assertEqual(b"b", second.result())
+
+    def test_answers_to_other_sources_are_dropped(self, write, read):
+        read.return_value = iter([(b"a", [42], 1), None])
+        dispatcher = Dispatcher(None)
+
+        futures = dispatcher.send(b"", [1])
+
+        self.assertFalse(dispatcher.wait(futures.values()))
+        self.assertFalse(futures[1].done())
+
+    def test_unexpected_answers_are_dropped(self, write, read):
+        read.return_value = iter([(b"a", [0], 1), (b"b", [0], 2)])
+        dispatcher = Dispatcher(None)
+
+        futures = dispatcher.send(b"", [2])
+        dispatcher.wait(futures.values())
+
+        self.assertEqual(b"b", futures[2].result())
+        self.assertEqual(1, dispatcher.unexpected_answers)
+
+    def test_cancelled_requests_do_not_get_answers(self, write, read):
+        read.return_value = iter([(b"b", [0], 1)])
+        dispatcher = Dispatcher(None)
+
+        stale = dispatcher.send(b"", [1])
+        dispatcher.cancel(stale.values())
+        futures = dispatcher.send(b"", [1])
+        dispatcher.wait(futures.values())
+
+        self.assertEqual(b"b", futures[1].result())
+        self.assertEqual({}, dispatcher.futures)
+
+    def test_one_dispatcher_per_connection(self, write, read):
+        conn = Mock()
+
+        self.assertIs(get_dispatcher(conn), get_dispatcher(conn))
+        self.assertIsNot(get_dispatcher(conn), get_dispatcher(Mock()))
+        read.assert_any_call(conn)
+
+    def test_datagrams_are_not_lost_between_calls(self, write, read):
+        """
+        Checks that answers received while waiting for another request are
+        kept for the request they belong to.
+        """
+        read.return_value = iter([(b"b", [0], 2), (b"a", [0], 1)])
+        dispatcher = Dispatcher(None)
+
+        futures = dispatcher.send(b"", [1, 2])
+        dispatcher.wait([futures[1]])
+
+        self.assertEqual(b"b", futures[2].result())
+
+    def test_source_mismatch(self, write, read):
+        conn = Mock()
+        get_dispatcher(conn, source=0)
+
+        with self.assertRaises(ValueError):
+            get_dispatcher(conn, source=1)
+
 
 class PCAPWrapperTestCase(unittest.TestCase):
     def setUp(self):
         self.underlying_conn = Mock()
         self.outfile = io.BytesIO()
         self.conn = PcapConnectionWrapper(self.underlying_conn, self.outfile)
+        self.addCleanup(self.conn.close)
 
     def test_write_header(self):
         """
@@ -121,6 +239,7 @@ class PCAPWrapperTestCase(unittest.TestCase):
         """
         f = cvra_bootloader.can.Frame(0, "hello".encode())
         self.conn.send_frame(f)
+        self.conn.close()
 
         # The frame should have been sent and logged to the file
         self.assertEqual(53, len(self.outfile.getvalue()), "no data in pcap")
@@ -134,29 +253,78 @@ class PCAPWrapperTestCase(unittest.TestCase):
         self.underlying_conn.receive_frame.return_value = f
 
         self.assertEqual(f, self.conn.receive_frame())
+        self.conn.close()
         self.assertEqual(53, len(self.outfile.getvalue()), "no data in pcap")
 
+    def test_send_frames(self):
+        """
+        Checks that batches of frames are logged and forwarded as a batch.
+        """
+        frames = [cvra_bootloader.can.Frame(0, "hello".encode())] * 2
+        self.conn.send_frames(iter(frames))
+        self.conn.close()
+
+        self.assertEqual(24 + 2 * 29, len(self.outfile.getvalue()))
+        self.underlying_conn.send_frames.assert_any_call(frames)
+
+    def test_receive_frame_uses_adapter_timestamp(self):
+        """
+        Checks that frames timestamped by the adapter keep their timestamp.
+        """
+        self.conn.writer = Mock()
+        f = cvra_bootloader.can.Frame(0, "hello".encode(), timestamp=1234)
+        self.underlying_conn.receive_frame.return_value = f
+
+        self.conn.receive_frame()
+
+        self.conn.writer.write_frame.assert_any_call(1234, f)
+
     def test_receive_frame_timeout(self):
         """
         Checks that read timeoutes are not logged in the pcap.
         """
         self.underlying_conn.receive_frame.return_value = None  # timeout
         self.assertIsNone(self.conn.receive_frame())
+        self.conn.close()
         self.assertEqual(
             24, len(self.outfile.getvalue()), "pcap should only contain header"
         )
 
 
 class OpenConnectionTestCase(unittest.TestCase):
-    Args = namedtuple("Args", ["serial_device", "can_interface", "pcap", "large_pages"])
+    Args = namedtuple(
+        "Args",
+        [
+            "serial_device",
+            "can_interface",
+            "replay",
+            "replay_realtime",
+            "pcap",
+            "pcap_max_size",
+            "pcap_max_age",
+            "large_pages",
+        ],
+    )
 
     def make_args(
-        self, serial_device=None, can_interface=None, pcap=None, large_pages=False
+        self,
+        serial_device=None,
+        can_interface=None,
+        replay=None,
+        replay_realtime=False,
+        pcap=None,
+        pcap_max_size=None,
+        pcap_max_age=None,
+        large_pages=False,
     ):
         return self.Args(
             serial_device=serial_device,
             can_interface=can_interface,
+            replay=replay,
+            replay_realtime=replay_realtime,
             pcap=pcap,
+            pcap_max_size=pcap_max_size,
+            pcap_max_age=pcap_max_age,
             large_pages=large_pages,
         )
 
@@ -167,19 +335,46 @@ class OpenConnectionTestCase(unittest.TestCase):
         """
         args = self.make_args(can_interface="can0")
         conn = open_connection(args)
-        create_socket.assert_any_call("can0", read_timeout=ANY)
+        create_socket.assert_any_call("can0", read_timeout=ANY, timestamps=False)
         self.assertEqual(conn, create_socket.return_value)
 
+    @patch("cvra_bootloader.can.adapters.PcapReplayConnection", autospec=True)
+    def test_open_replay(self, create_replay):
+        args = self.make_args(replay="capture.pcapng", replay_realtime=True)
+        conn = open_connection(args)
+        create_replay.assert_any_call("capture.pcapng", realtime=True, read_timeout=0.5)
+        self.assertEqual(conn, create_replay.return_value)
+
+    @patch("cvra_bootloader.can.pcap.PcapWriter", autospec=True)
     @patch("cvra_bootloader.can.adapters.SocketCANConnection", autospec=True)
-    def test_pcap_wrapper(self, create_socket):
+    def test_pcap_wrapper(self, create_socket, create_writer):
         """
         Check that we can open a socket CAN adapter.
         """
-        outfile = io.BytesIO()
-        args = self.make_args(can_interface="can0", pcap=outfile)
+        args = self.make_args(can_interface="can0", pcap="capture.pcap")
         conn = open_connection(args)
-        create_socket.assert_any_call("can0", ANY)
+        create_socket.assert_any_call("can0", read_timeout=ANY, timestamps=True)
+        create_writer.assert_any_call("capture.pcap")
         self.assertEqual(conn.conn, create_socket.return_value)
+        self.assertEqual(conn.writer, create_writer.return_value)
+
+    @patch("cvra_bootloader.can.pcapng.PcapngWriter", autospec=True)
+    @patch("cvra_bootloader.can.adapters.SocketCANConnection", autospec=True)
+    def test_pcapng_wrapper(self, create_socket, create_writer):
+        """
+        Checks that the capture format is chosen from the file extension.
+        """
+        args = self.make_args(
+            can_interface="can0",
+            pcap="capture.pcapng",
+            pcap_max_size=1.5,
+            pcap_max_age=3600,
+        )
+        conn = open_connection(args)
+        create_writer.assert_any_call(
+            "capture.pcapng", interface="can0", max_size=1500000, max_age=3600
+        )
+        self.assertEqual(conn.writer, create_writer.return_value)
 
 
 class ArgumentParserTestCase(unittest.TestCase):
@@ -188,3 +383,122 @@ class ArgumentParserTestCase(unittest.TestCase):
         args = parser.parse_args("-i can0".split())
 
         self.assertEqual("can0", args.can_interface)
+
+    def test_replay(self):
+        parser = ConnectionArgumentParser()
+        args = parser.parse_args("--replay capture.pcapng".split())
+
+        self.assertEqual("capture.pcapng", args.replay)
+
+    def test_connection_is_required(self):
+        parser = ConnectionArgumentParser()
+
+        with patch("sys.stderr"), self.assertRaises(SystemExit):
+            parser.parse_args([])
+
+    def test_single_connection(self):
+        parser = ConnectionArgumentParser()
+
+        with patch("sys.stderr"), self.assertRaises(SystemExit):
+            parser.parse_args("-i can0 --replay capture.pcapng".split())
+
+    def test_buses(self):
+        parser = ConnectionArgumentParser()
+        args = parser.parse_args("--bus can0=1,2 --bus /dev/ttyUSB0=3-5".split())
+
+        self.assertEqual(
+            [Bus("can0", [1, 2]), Bus("/dev/ttyUSB0", [3, 4, 5])], args.buses
+        )
+
+    def test_buses_can_be_disabled(self):
+        parser = ConnectionArgumentParser(buses=False)
+        self.assertIsNone(parser.parse_args("-i can0".split()).buses)
+
+        with patch("sys.stderr") as stderr, self.assertRaises(SystemExit):
+            parser.parse_args([])
+
+        message = "".join(call[0][0] for call in stderr.write.call_args_list)
+        self.assertNotIn("--bus", message.split("error:")[1])
+
+    def test_buses_are_exclusive_with_interface(self):
+        parser = ConnectionArgumentParser()
+
+        with patch("sys.stderr"), self.assertRaises(SystemExit):
+            parser.parse_args("-i can0 --bus can1=1".split())
+
+
+class BusTestCase(unittest.TestCase):
+    def test_parse_bus(self):
+        self.assertEqual(Bus("can0", [1, 2, 10, 11, 12]), parse_bus("can0=1,2,10-12"))
+
+    def test_parse_bus_without_ids(self):
+        self.assertEqual(Bus("can0", []), parse_bus("can0"))
+
+    def test_parse_invalid_bus(self):
+        for spec in ["=1,2", "can0=a", "can0=1-"]:
+            with self.assertRaises(argparse.ArgumentTypeError):
+                parse_bus(spec)
+
+    def test_serial_devices(self):
+        self.assertTrue(is_serial_device("/dev/ttyUSB0"))
+        self.assertTrue(is_serial_device("COM3"))
+        self.assertFalse(is_serial_device("can0"))
+
+    @patch("cvra_bootloader.utils.open_connection")
+    def test_open_bus_connection(self, open_conn):
+        args = argparse.Namespace(
+            serial_device=None,
+            can_interface=None,
+            buses=[Bus("can1", [1])],
+            pcap="capture.pcapng",
+        )
+
+        conn = open_bus_connection(args, Bus("can1", [1]))
+
+        opened = open_conn.call_args[0][0]
+        self.assertEqual("can1", opened.can_interface)
+        self.assertIsNone(opened.serial_device)
+        self.assertIsNone(opened.buses)
+        self.assertEqual("capture_can1.pcapng", opened.pcap)
+        self.assertEqual(open_conn.return_value, conn)
+
+        # The arguments of the other buses are left unchanged
+        self.assertEqual("capture.pcapng", args.pcap)
+
+    @patch("cvra_bootloader.utils.open_connection")
+    def test_open_serial_bus_connection(self, open_conn):
+        args = argparse.Namespace(
+            serial_device=None, can_interface=None, buses=None, pcap=None
+        )
+
+        open_bus_connection(args, Bus("/dev/ttyUSB0", [1]))
+
+        self.assertEqual("/dev/ttyUSB0", open_conn.call_args[0][0].serial_device)
+
+    @patch("cvra_bootloader.utils.open_connection")
+    def test_run_on_buses(self, open_conn):
+        """
+        Checks that the sessions run in parallel, and that the errors of a bus
+        are reported without affecting the others.
+        """
+        buses = [Bus("can0", [1]), Bus("can1", [2]), Bus("can2", [3])]
+        args = argparse.Namespace(
+            serial_device=None, can_interface=None, buses=buses, pcap=None
+        )
+        open_conn.side_effect = lambda args: args.can_interface
+        barrier = threading.Barrier(len(buses), timeout=5)
+
+        def session(conn, bus):
+            # Only returns once every session started
+            barrier.wait()
+
+            if conn == "can2":
+                raise IOError
+
+            return bus.ids
+
+        results = run_on_buses(args, session)
+
+        self.assertEqual([1], results["can0"])
+        self.assertEqual([2], results["can1"])
+        self.assertIsInstance(results["can2"], IOError)
@@ -6,6 +6,7 @@
 #include "boot_arg.h"
 #include "config.h"
 #include "command.h"
+#include "lz4_block.h"
 
 void command_erase_flash_page(int argc, cmp_ctx_t* args, cmp_ctx_t* out, bootloader_config_t* config)
 {
@@ -97,6 +98,71 @@ command_fail:
     return;
 }
 
+void command_write_flash_compressed(int argc, cmp_ctx_t* args, cmp_ctx_t* out, bootloader_config_t* config)
+{
+    void* address;
+    void* src;
+    uint8_t* dst;
+    uint64_t tmp = 0;
+    uint32_t size, compressed_size;
+    char device_class[64];
+
+    cmp_read_uinteger(args, &tmp);
+    address = (void*)(uintptr_t)tmp;
+
+    // refuse to overwrite bootloader or config pages
+    if (address < memory_get_app_addr()) {
+        goto command_fail;
+    }
+
+    // Refuse to erase past end of flash memory
+    if (address >= memory_get_app_addr() + memory_get_app_size()) {
+        goto command_fail;
+    }
+
+    size = 64;
+    cmp_read_str(args, device_class, &size);
+
+    if (strcmp(device_class, config->device_class) != 0) {
+        goto command_fail;
+    }
+
+    if (!cmp_read_uint(args, &size) || size > FLASH_PAGE_SIZE) {
+        goto command_fail;
+    }
+
+    if (!cmp_read_bin_size(args, &compressed_size)) {
+        goto command_fail;
+    }
+
+    /* Decompress straight from the datagram buffer. */
+    cmp_mem_access_t* cma = (cmp_mem_access_t*)(args->buf);
+    src = cmp_mem_access_get_ptr_at_pos(cma, cmp_mem_access_get_pos(cma));
+
+    /* The answer is a single bool written once the data is flashed, so the
+     * output buffer is free until then and holds the decompressed data. */
+    cmp_mem_access_t* out_cma = (cmp_mem_access_t*)(out->buf);
+    dst = cmp_mem_access_get_ptr_at_pos(out_cma, 0);
+
+    if (lz4_block_decompress(src, compressed_size, dst, size) != (int)size) {
+        goto command_fail;
+    }
+
+    flash_writer_unlock();
+
+    flash_writer_page_write(address, dst, size);
+
+    flash_writer_lock();
+
+    cmp_mem_access_set_pos(out_cma, 0);
+    cmp_write_bool(out, 1);
+    return;
+
+command_fail:
+    cmp_write_bool(out, 0);
+    return;
+}
+
 void command_read_flash(int argc, cmp_ctx_t* args, cmp_ctx_t* out, bootloader_config_t* config)
 {
     void* address;
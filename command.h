@@ -62,6 +62,16 @@ void command_erase_flash_page(int argc, cmp_ctx_t* args, cmp_ctx_t* out, bootloa
  */
 void command_write_flash(int argc, cmp_ctx_t* args, cmp_ctx_t* out, bootloader_config_t* config);
 
+/** Command used to write LZ4 compressed data to a flash page.
+ *
+ * The data is decompressed in the output buffer before being written, so it
+ * cannot be longer than FLASH_PAGE_SIZE once decompressed, and the output
+ * buffer must hold at least FLASH_PAGE_SIZE bytes.
+ *
+ * @note Should not be called directly but be a part of the commands given to protocol_execute_command.
+ */
+void command_write_flash_compressed(int argc, cmp_ctx_t* args, cmp_ctx_t* out, bootloader_config_t* config);
+
 /** Command used to read from flash.
  *
  *  @note Should not be called directly but be a part of the commands given to protocol_execute_command.
@@ -0,0 +1,82 @@
+#include <stdbool.h>
+#include <string.h>
+#include "lz4_block.h"
+
+#define LZ4_MIN_MATCH 4
+
+/* Adds the extra bytes of a length to it, until one is not 255. */
+static bool read_length(const uint8_t** src, const uint8_t* src_end, size_t* length)
+{
+    uint8_t byte;
+
+    do {
+        if (*src == src_end) {
+            return false;
+        }
+        byte = *(*src)++;
+        *length += byte;
+    } while (byte == 255);
+
+    return true;
+}
+
+int lz4_block_decompress(const uint8_t* src, size_t src_len, uint8_t* dst, size_t dst_len)
+{
+    const uint8_t* src_end = src + src_len;
+    size_t out = 0;
+    size_t length, offset, i;
+    uint8_t token;
+
+    while (src < src_end) {
+        token = *src++;
+
+        /* Literals */
+        length = token >> 4;
+        if (length == 15 && !read_length(&src, src_end, &length)) {
+            return -1;
+        }
+
+        if (length > (size_t)(src_end - src) || length > dst_len - out) {
+            return -1;
+        }
+
+        memcpy(&dst[out], src, length);
+        src += length;
+        out += length;
+
+        /* The last sequence only has literals */
+        if (src == src_end) {
+            break;
+        }
+
+        /* Match */
+        if (src_end - src < 2) {
+            return -1;
+        }
+
+        offset = src[0] | (src[1] << 8);
+        src += 2;
+
+        if (offset == 0 || offset > out) {
+            return -1;
+        }
+
+        length = token & 0x0f;
+        if (length == 15 && !read_length(&src, src_end, &length)) {
+            return -1;
+        }
+        length += LZ4_MIN_MATCH;
+
+        if (length > dst_len - out) {
+            return -1;
+        }
+
+        /* Copied byte per byte, as the match can overlap its output */
+        for (i = 0; i < length; i++) {
+            dst[out] = dst[out - offset];
+            out++;
+        }
+    }
+
+    return out;
+}
@@ -0,0 +1,29 @@
+#ifndef LZ4_BLOCK_H
+#define LZ4_BLOCK_H
+
+#include <stdint.h>
+#include <stddef.h>
+
+#ifdef __cplusplus
+extern "C" {
+#endif
+
+/** Decompresses a block in the LZ4 block format.
+ *
+ * Matches are copied from the output itself, so no memory is needed besides
+ * the destination buffer.
+ *
+ * @param [in] src The compressed data.
+ * @param [in] src_len Length of src.
+ * @param [out] dst Buffer receiving the decompressed data.
+ * @param [in] dst_len Length of dst.
+ * @returns The amount of bytes written to dst.
+ * @returns -1 if the block is invalid or does not fit in dst.
+ */
+int lz4_block_decompress(const uint8_t* src, size_t src_len, uint8_t* dst, size_t dst_len);
+
+#ifdef __cplusplus
+}
+#endif
+
+#endif /* LZ4_BLOCK_H */
@@ -351,3 +351,93 @@ TEST(PingTestGroup, PingCommand)
     CHECK_TRUE(success);
     CHECK_TRUE(result);
 }
+
+TEST_GROUP (CompressedFlashCommandTestGroup) {
+    cmp_mem_access_t command_cma;
+    cmp_ctx_t command_builder;
+    char command_data[1024];
+    bootloader_config_t config;
+
+    cmp_ctx_t out;
+    char out_data[1024];
+    cmp_mem_access_t out_cma;
+
+    // "xkcd" followed by a match of 8 bytes, 4 bytes back
+    const uint8_t block[7] = {0x44, 'x', 'k', 'c', 'd', 0x04, 0x00};
+
+    void setup()
+    {
+        cmp_mem_access_init(&command_builder, &command_cma, command_data, sizeof command_data);
+        memset(command_data, 0, sizeof command_data);
+
+        cmp_mem_access_init(&out, &out_cma, out_data, sizeof out_data);
+        memset(out_data, 0, sizeof out_data);
+
+        strcpy(config.device_class, "test.dummy");
+
+        memset(memory_mock_app, 0, sizeof(memory_mock_app));
+    }
+
+    void teardown()
+    {
+        mock().checkExpectations();
+        mock().clear();
+    }
+
+    bool write_compressed(const char* device_class, uint32_t size)
+    {
+        cmp_mem_access_set_pos(&command_cma, 0);
+        cmp_mem_access_set_pos(&out_cma, 0);
+
+        cmp_write_u64(&command_builder, (size_t)memory_mock_app);
+        cmp_write_str(&command_builder, device_class, strlen(device_class));
+        cmp_write_uint(&command_builder, size);
+        cmp_write_bin(&command_builder, block, sizeof block);
+
+        cmp_mem_access_set_pos(&command_cma, 0);
+        command_write_flash_compressed(1, &command_builder, &out, &config);
+
+        bool ret = false;
+        cmp_mem_access_set_pos(&out_cma, 0);
+        CHECK_TRUE(cmp_read_bool(&out, &ret));
+        return ret;
+    }
+};
+
+TEST(CompressedFlashCommandTestGroup, CanFlashCompressedData)
+{
+    mock("flash").expectOneCall("unlock");
+    mock("flash").expectOneCall("lock");
+    mock("flash").expectOneCall("page_write").withPointerParameter("page_adress", memory_mock_app).withIntParameter("size", 12);
+
+    CHECK_TRUE(write_compressed(config.device_class, 12));
+
+    MEMCMP_EQUAL("xkcdxkcdxkcd", memory_mock_app, 12);
+}
+
+TEST(CompressedFlashCommandTestGroup, CheckThatDeviceClassIsRespected)
+{
+    // No flash operation should occur
+    CHECK_FALSE(write_compressed("fail", 12));
+}
+
+TEST(CompressedFlashCommandTestGroup, CheckThatDecompressedSizeMatches)
+{
+    CHECK_FALSE(write_compressed(config.device_class, 11));
+    CHECK_FALSE(write_compressed(config.device_class, 13));
+}
+
+TEST(CompressedFlashCommandTestGroup, DoNotDecompressMoreThanOnePage)
+{
+    CHECK_FALSE(write_compressed(config.device_class, FLASH_PAGE_SIZE + 1));
+}
+
+TEST(CompressedFlashCommandTestGroup, CheckErrorHandlingWithIllFormatedArguments)
+{
+    command_write_flash_compressed(1, &command_builder, &out, &config);
+
+    bool ret = true;
+    cmp_mem_access_set_pos(&out_cma, 0);
+    cmp_read_bool(&out, &ret);
+    CHECK_FALSE(ret);
+}
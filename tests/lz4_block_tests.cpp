@@ -0,0 +1,91 @@
+#include <cstring>
+#include <CppUTest/TestHarness.h>
+#include "../lz4_block.h"
+
+TEST_GROUP (LZ4BlockTestGroup) {
+    uint8_t out[64];
+
+    void setup()
+    {
+        memset(out, 0, sizeof out);
+    }
+};
+
+TEST(LZ4BlockTestGroup, CanDecompressLiterals)
+{
+    const uint8_t block[] = {0x40, 'x', 'k', 'c', 'd'};
+
+    int len = lz4_block_decompress(block, sizeof block, out, sizeof out);
+
+    CHECK_EQUAL(4, len);
+    MEMCMP_EQUAL("xkcd", out, 4);
+}
+
+TEST(LZ4BlockTestGroup, CanDecompressMatch)
+{
+    // "xkcd" followed by a match of 8 bytes, 4 bytes back
+    const uint8_t block[] = {0x44, 'x', 'k', 'c', 'd', 0x04, 0x00, 0x10, '!'};
+
+    int len = lz4_block_decompress(block, sizeof block, out, sizeof out);
+
+    CHECK_EQUAL(13, len);
+    MEMCMP_EQUAL("xkcdxkcdxkcd!", out, 13);
+}
+
+TEST(LZ4BlockTestGroup, MatchCanOverlapItsOutput)
+{
+    // A single byte repeated by a match one byte back
+    const uint8_t block[] = {0x16, 0xff, 0x01, 0x00};
+
+    int len = lz4_block_decompress(block, sizeof block, out, sizeof out);
+
+    CHECK_EQUAL(11, len);
+    for (int i = 0; i < len; i++) {
+        BYTES_EQUAL(0xff, out[i]);
+    }
+}
+
+TEST(LZ4BlockTestGroup, CanDecompressExtendedLengths)
+{
+    // 1 literal and a match of 15 + 4 + 255 + 1 bytes
+    const uint8_t block[] = {0x1f, 'a', 0x01, 0x00, 255, 1};
+    uint8_t big_out[300];
+
+    int len = lz4_block_decompress(block, sizeof block, big_out, sizeof big_out);
+
+    CHECK_EQUAL(276, len);
+    BYTES_EQUAL('a', big_out[275]);
+}
+
+TEST(LZ4BlockTestGroup, RejectsOffsetBeforeStartOfOutput)
+{
+    const uint8_t block[] = {0x10, 'a', 0x02, 0x00};
+
+    CHECK_EQUAL(-1, lz4_block_decompress(block, sizeof block, out, sizeof out));
+}
+
+TEST(LZ4BlockTestGroup, RejectsZeroOffset)
+{
+    const uint8_t block[] = {0x10, 'a', 0x00, 0x00};
+
+    CHECK_EQUAL(-1, lz4_block_decompress(block, sizeof block, out, sizeof out));
+}
+
+TEST(LZ4BlockTestGroup, RejectsTruncatedBlock)
+{
+    const uint8_t literals[] = {0x40, 'x', 'k'};
+    const uint8_t offset[] = {0x10, 'a', 0x01};
+    const uint8_t length[] = {0xf0, 255};
+
+    CHECK_EQUAL(-1, lz4_block_decompress(literals, sizeof literals, out, sizeof out));
+    CHECK_EQUAL(-1, lz4_block_decompress(offset, sizeof offset, out, sizeof out));
+    CHECK_EQUAL(-1, lz4_block_decompress(length, sizeof length, out, sizeof out));
+}
+
+TEST(LZ4BlockTestGroup, DoNotWritePastEndOfOutput)
+{
+    const uint8_t block[] = {0x16, 0xff, 0x01, 0x00};
+
+    CHECK_EQUAL(-1, lz4_block_decompress(block, sizeof block, out, 10));
+    CHECK_EQUAL(-1, lz4_block_decompress(block, sizeof block, out, 0));
+}